@@ -0,0 +1,611 @@
+# Benchmarks for the hot paths of the Terra^2 simulation.
+# Run with `python benchmark.py <name>`, or `python benchmark.py --help` for the list.
+
+import argparse
+import copy
+import importlib.metadata
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import ensemble, kernels, simulation, world, terrans, spatial, tiles, topology, util
+
+def timed(func, repeat=3):
+    """Calls func repeat times and returns the best wall time in seconds."""
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def traced(func):
+    """Calls func once and returns the peak memory it allocated, in bytes."""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def make_world(size, seed=0):
+    rng = np.random.default_rng(seed)
+    terrain = world.Terrain(size, rng=rng)
+    weather = world.Weather(size, 0.01, 1, 0.2, 0.05, rng=rng)
+    return terrain, weather
+
+def bench_spatial(args):
+    """Tick time of TerranPop.update against population size, per spatial index."""
+    terrain, weather = make_world(args.size)
+    print("%8s %12s %12s %12s" % ("terrans", *spatial.indices))
+    for n in args.pops:
+        times = []
+        for kind in spatial.indices:
+            pop = terrans.TerranPop(terrain, weather, n, spawn_dist=args.size//2, index=kind, rng=np.random.default_rng(n))
+            # keep the population fixed so every index sees the same work
+            sustenance = terrain.sustenance.copy()
+            state = {name: getattr(pop, name).copy() for name in pop.columns}
+
+            def tick():
+                for name in pop.columns:
+                    setattr(pop, name, state[name].copy())
+                terrain.sustenance[:] = sustenance
+                pop.update()
+            times.append(timed(tick, args.repeat))
+        print("%8d %12s %12s %12s" % (n, *["%.4fs" % t for t in times]))
+
+def grow_vegetation_dense(terrain):
+    """The original full-map vegetation growth, kept as a reference."""
+    new_vegetation = world.proc_gen(terrain.size, int(terrain.points*terrain.v_sparsity), 0, terrain.rng)
+    new_vegetation = world.proc_filter(new_vegetation, terrain.climates, terrain.v_bounds)
+    new_vegetation = world.proc_filter(new_vegetation, terrain.heightmap, terrain.water_level+0.2)
+    new_vegetation = world.proc_smooth(new_vegetation, terrain.sigma/2)
+    new_vegetation = world.proc_filter(new_vegetation, terrain.heightmap, terrain.water_level)
+    terrain.vegetation += new_vegetation
+    terrain.vegetation[np.where(terrain.vegetation > 1.0)] = 1.0
+    terrain.sustenance[np.where((terrain.sustenance > 0.1) & (terrain.sustenance < terrain.vegetation))] += terrain.s_rate
+
+def bench_vegetation(args):
+    """Per-tick time and peak allocation of vegetation growth, dense against incremental."""
+    print("%6s %12s %12s %12s %12s" % ("size", "dense", "incremental", "dense mem", "incr. mem"))
+    for size in args.sizes:
+        terrain = make_world(size)[0]
+        dense = copy.deepcopy(terrain)
+        # one untimed tick of each, so no timing includes compiling kernels
+        grow_vegetation_dense(dense)
+        terrain.grow_vegetation()
+        times = [timed(lambda: grow_vegetation_dense(dense), args.repeat), timed(terrain.grow_vegetation, args.repeat)]
+        peaks = [traced(lambda: grow_vegetation_dense(dense)), traced(terrain.grow_vegetation)]
+        print("%6d %12s %12s %11.2fM %11.2fM" % (size, *["%.5fs" % t for t in times], *[p / 2**20 for p in peaks]))
+
+def run_precision(precision, args):
+    """Runs one simulation per seed under a precision policy and returns the
+       final vegetation maps, the run-averaged metrics and the layer memory."""
+    vegetation, metrics, memory = [], [], 0
+    for seed in range(args.seeds):
+        sim = simulation.Simulation(size=args.size, delay=10, num_terrans=40, spawn_dist=6, precision=precision, seed=seed)
+        rows = []
+        for i in range(args.ticks):
+            sim.tick()
+            rows.append(sim.metrics())
+        vegetation.append(sim.terrain.vegetation.astype(np.float64))
+        metrics.append({name: np.mean([row[name] for row in rows]) for name in ('population', 'energy', 'health')})
+        memory = sim.memory()
+    return vegetation, {name: np.mean([m[name] for m in metrics]) for name in metrics[0]}, memory
+
+def bench_precision(args):
+    """Layer memory per precision policy, and whether the outcomes of each
+       policy stay within tolerance of float64 over a few seeded runs."""
+    results = {precision: run_precision(precision, args) for precision in util.PRECISIONS}
+
+    names = sorted(results['float64'][2])
+    print("%-28s" % "layer" + "".join("%18s" % precision for precision in results))
+    for name in names:
+        cells = []
+        for precision in results:
+            dtype, shape, nbytes = results[precision][2].get(name, ('-', (), 0))
+            cells.append("%8s %8.1fK" % (dtype, nbytes / 2**10))
+        print("%-28s" % name + "".join("%18s" % cell for cell in cells))
+    print("%-28s" % "total" + "".join("%17.1fK" % (sum(r[2][n][2] for n in r[2]) / 2**10) for r in results.values()))
+
+    reference_vegetation, reference, memory = results['float64']
+    failed = False
+    for precision, (vegetation, metrics, memory) in results.items():
+        if precision == 'float64':
+            continue
+        error = max(np.abs(v - r).max() for v, r in zip(vegetation, reference_vegetation))
+        failed |= error > args.map_tolerance
+        print("%s: vegetation max error %.2e (%s)" % (precision, error, "ok" if error <= args.map_tolerance else "FAIL"))
+        for name, value in metrics.items():
+            relative = abs(value - reference[name]) / max(abs(reference[name]), 1e-12)
+            failed |= relative > args.tolerance
+            print("  %-12s %10.4f vs %10.4f  %6.1f%% (%s)" % (name, value, reference[name], 100 * relative,
+                                                            "ok" if relative <= args.tolerance else "FAIL"))
+    if failed:
+        sys.exit(1)
+
+def kernel_cases(size, n, rng):
+    """Returns, for every kernel, a function that runs it on random inputs
+       and returns its outputs (including any layer it writes to)."""
+    coords = rng.integers(0, size, (n, 2))
+    inmap = rng.random((size, size))
+    cells = rng.integers(0, size * size, n)
+    dests = rng.random((n, 2)) * size
+    stamp_x, stamp_y, stamp_w = world.gaussian_stamp(2)
+    cases = {
+        'paths': lambda: kernels.paths(dests, util.get_areas(coords, size)),
+        'paths_away': lambda: kernels.paths_away(dests, util.get_areas(coords, size)),
+        'torus_dist': lambda: kernels.torus_dist(coords, coords[::-1] + 0.5, size),
+        'stamp': lambda: kernels.stamp(coords[:, 0], coords[:, 1], inmap.flat[cells], stamp_x, stamp_y, stamp_w, size, cells),
+    }
+    for dtype in (np.float64, np.float32):
+        def consume(dtype=dtype):
+            layer = inmap.astype(dtype)
+            kernels.consume(layer, coords[:, 0], coords[:, 1], 0.2)
+            return layer
+        def splat(dtype=dtype):
+            layer = inmap.astype(dtype)
+            return layer, kernels.splat(layer, cells, inmap.flat[cells[::-1]])
+        cases['consume.' + np.dtype(dtype).name] = consume
+        cases['splat.' + np.dtype(dtype).name] = splat
+    return cases
+
+def bench_kernels(args):
+    """Checks that the Numba and NumPy kernels give identical results, and
+       times each of them."""
+    if not kernels.numba_available():
+        print("numba is not installed; only the numpy kernels are available")
+        return
+    cases = kernel_cases(args.size, args.pops[-1], np.random.default_rng(0))
+    print("%-16s %12s %12s %8s %s" % ("kernel", "numpy", "numba", "speedup", "parity"))
+    for name, case in cases.items():
+        results, times = [], []
+        for backend in ('numpy', 'numba'):
+            kernels.use(backend)
+            results.append(case())
+            times.append(timed(case, args.repeat))
+        same = all(np.array_equal(a, b) and np.asarray(a).dtype == np.asarray(b).dtype
+                   for a, b in zip(*(r if isinstance(r, tuple) else (r,) for r in results)))
+        print("%-16s %11.5fs %11.5fs %7.1fx %s" % (name, *times, times[0] / times[1], "ok" if same else "FAIL"))
+
+# the modules that are only loaded on the code paths that need them
+HEAVY = ('matplotlib', 'scipy', 'numba', 'asyncio')
+
+def bench_startup(args):
+    """Time to import each entry point in a fresh interpreter, to compile
+       every kernel (kernels.compile_all), to generate a world, and to run
+       its first tick, the tick Terrans spawn in and their first tick of
+       moving. The kernels are compiled up front so the ticks only measure
+       run time. Each is run with an empty Numba cache and again with the
+       cache filled. Also lists the heavy modules (HEAVY) that importing the
+       entry point loaded."""
+    script = ("import sys, time; start = time.perf_counter(); import %s; imported = time.perf_counter(); "
+              "heavy = [m for m in %r if m in sys.modules] or ['-']; "
+              "import kernels, simulation; kernels.BACKEND == 'numba' and kernels.compile_all(); compiled = time.perf_counter(); "
+              "sim = simulation.Simulation(size=%d, delay=1, seed=0); made = time.perf_counter(); "
+              "sim.tick(); ticked = time.perf_counter(); sim.tick(); spawned = time.perf_counter(); sim.tick(); moved = time.perf_counter(); "
+              "print(kernels.BACKEND, imported - start, compiled - imported, made - compiled, ticked - made, spawned - ticked, "
+              "moved - spawned, ','.join(heavy))")
+    print("%-10s %-6s %8s %10s %10s %10s %11s %11s %11s  %s" %
+          ("entry", "cache", "backend", "import", "compile", "world", "first tick", "spawn tick", "terran tick", "loaded at import"))
+    for entry in ('simulation', 'headless', 'sweep', 'main'):
+        with tempfile.TemporaryDirectory() as cache:
+            env = dict(os.environ, NUMBA_CACHE_DIR=cache)
+            for label in ('cold', 'warm'):
+                out = subprocess.run([sys.executable, '-c', script % (entry, HEAVY, args.size)], env=env, check=True,
+                                     capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+                backend, *times, heavy = out.split()
+                print("%-10s %-6s %8s %9.3fs %9.3fs %9.3fs %10.4fs %10.4fs %10.4fs  %s" % (entry, label, backend, *map(float, times), heavy))
+
+def manage_terrans_reference(pop):
+    """The original birth and death handling, which resolves mating in a
+       Python loop and reallocates every column each tick, kept as a reference."""
+    sustenance, x, y = pop.terrain.sustenance, pop.x, pop.y
+    eating = (pop.energy < 1.0) & (sustenance[x, y] > 0)
+    np.subtract.at(sustenance, (x[eating], y[eating]), pop.decay*2)
+    pop.energy[eating] += pop.decay*2
+    pop.health[pop.energy <= 0.0] -= pop.decay_h
+    storm = pop.weather.weathermap[x, y]
+    pop.health -= np.where(storm > 0, storm, 0.0)
+    alive = pop.health > 0.0
+    closest, closest_dist = pop.get_closest_terrans(radius=2)
+    near = closest >= 0
+    pop.social[near] += pop.decay_soc
+    pop.social[~near] -= pop.decay_soc
+    born_x, born_y = [], []
+    energy = pop.energy
+    for i in np.flatnonzero(near & (energy > pop.sex_th)):
+        j = closest[i]
+        if energy[j] > pop.sex_th and energy[i] > pop.sex_th:
+            born_x.append(x[i])
+            born_y.append(y[j])
+            energy[j] -= pop.sex_th
+            energy[i] -= pop.sex_th
+    energy[pop.social <= 0.0] -= pop.decay_h
+    energy -= pop.decay
+    columns = {name: getattr(pop, name)[alive] for name in pop.columns}
+    n = len(born_x)
+    new = {'id': np.arange(pop.next_id, pop.next_id + n), 'x': np.asarray(born_x, dtype=np.intp), 'y': np.asarray(born_y, dtype=np.intp),
+           'health': np.ones(n), 'energy': np.ones(n), 'social': np.ones(n),
+           'rogue': np.zeros(n, dtype=bool), 'infected': np.zeros(n, dtype=bool),
+           'temprange': np.tile(np.asarray(pop.base_temprange, dtype=float), (n, 1)), 'weights': np.ones((n, 2))}
+    pop.next_id += n
+    for name in pop.columns:
+        setattr(pop, name, np.concatenate((columns[name], new[name])))
+
+def bench_births(args):
+    """Time per Terran of a tick of births and deaths against population size,
+       the event pipeline against the reference. The Terrans are packed at the
+       same density at every size, with enough energy that most of them mate."""
+    print("%8s %8s %14s %14s" % ("terrans", "births", "pipeline", "reference"))
+    for n in args.pops:
+        size = max(64, int(np.sqrt(n) * 3))
+        terrain, weather = make_world(size)
+        pop = terrans.TerranPop(terrain, weather, n, spawn_dist=size//2, sex_th=0.3, rng=np.random.default_rng(n))
+        sustenance = terrain.sustenance.copy()
+        state = {name: getattr(pop, name).copy() for name in pop.columns}
+
+        def reset():
+            for name in pop.columns:
+                setattr(pop, name, state[name].copy())
+            terrain.sustenance[:] = sustenance
+
+        times = []
+        for manage in (pop.manage_terrans, lambda: manage_terrans_reference(pop)):
+            def tick():
+                reset()
+                manage()
+            times.append(timed(tick, args.repeat))
+        reset()
+        pop.manage_terrans()
+        print("%8d %8d %12.3fus %12.3fus" % (n, len(pop) - np.count_nonzero(state['health'] > 0), *[t / n * 1e6 for t in times]))
+
+def bench_fastforward(args):
+    """Time to advance an idle world (the warm-up before the Terrans spawn)
+       tick by tick and fast-forwarded, and how closely the fast-forwarded
+       worlds match on average over a few seeds."""
+    stats = {'vegetation': lambda sim: sim.terrain.vegetation.mean(),
+             'sustenance': lambda sim: sim.terrain.sustenance.mean(),
+             'storms': lambda sim: len(sim.weather.storm_str),
+             'storm cells': lambda sim: np.count_nonzero(sim.weather.weathermap)}
+    results = {}
+    for mode in ('ticks', 'fast'):
+        seconds, values = [], []
+        for seed in range(args.seeds):
+            sim = simulation.Simulation(size=args.size, delay=args.ticks, storm_chance=0.05, seed=seed)
+            start = time.perf_counter()
+            sim.run(args.ticks, fast=args.ticks if mode == 'fast' else None)
+            seconds.append(time.perf_counter() - start)
+            values.append([stat(sim) for stat in stats.values()])
+        results[mode] = (np.mean(seconds), np.mean(values, axis=0))
+
+    print("%d idle ticks: %.4fs tick by tick, %.4fs fast-forwarded (%.0fx)" %
+          (args.ticks, results['ticks'][0], results['fast'][0], results['ticks'][0] / results['fast'][0]))
+    for name, ticked, fast in zip(stats, results['ticks'][1], results['fast'][1]):
+        relative = abs(fast - ticked) / max(abs(ticked), 1e-12)
+        print("  %-12s %10.4f vs %10.4f  %6.1f%% (%s)" % (name, fast, ticked, 100 * relative,
+                                                        "ok" if relative <= args.tolerance else "FAIL"))
+
+def bench_ensemble(args):
+    """Time to generate and run many small worlds as one Ensemble against as
+       many separate Simulations built from the same seeds, whether every
+       member is the same world as its Simulation, and their mean metrics."""
+    start = time.perf_counter()
+    batch = ensemble.Ensemble(args.members, size=args.size, seed=0)
+    generated = time.perf_counter() - start
+    initial = {name: getattr(batch, name).copy() for name in ('heightmap', 'climates', 'vegetation')}
+    batch.run(args.ticks)
+    batched = (generated, time.perf_counter() - start)
+
+    generated, total, same = 0.0, time.perf_counter(), True
+    metrics = []
+    for i, seed in enumerate(batch.seeds):
+        start = time.perf_counter()
+        sim = simulation.Simulation(size=args.size, seed=seed)
+        generated += time.perf_counter() - start
+        same &= all(np.array_equal(getattr(sim.terrain, name), layers[i]) for name, layers in initial.items())
+        sim.run(args.ticks)
+        metrics.append(sim.metrics())
+    separate = (generated, time.perf_counter() - total)
+
+    print("%d worlds of %d, %d ticks: %.2fs as an ensemble, %.2fs separately (%.1fx)" %
+          (args.members, args.size, args.ticks, batched[1], separate[1], separate[1] / batched[1]))
+    print("  generation %.2fs vs %.2fs, worlds %s" % (batched[0], separate[0], "identical" if same else "DIFFER"))
+    summary = batch.metrics()
+    for name in ('population', 'storms', 'vegetation'):
+        print("  mean %-10s %10.4f vs %10.4f" % (name, np.mean(summary[name]), np.mean([m[name] for m in metrics])))
+
+def neighbour_table(size):
+    """Returns a (size*size, 9) table of the flat indices of the 3x3 area
+       around every cell, built in int32 - the full table topology.py
+       computes per batch instead of holding."""
+    line = np.arange(size, dtype=np.int32)
+    nx = (line[:, None] + topology.OFFSETS[:, 0].astype(np.int32)) % size
+    ny = (line[:, None] + topology.OFFSETS[:, 1].astype(np.int32)) % size
+    return (nx[:, None, :] * np.int32(size) + ny[None, :, :]).reshape(size * size, 9)
+
+def bench_topology(args):
+    """Time to look up the 3x3 areas of many cells and read a layer over
+       them, and to take the gradient of a whole map, computing the wrapped
+       neighbours per batch (as topology.py does) against gathering them
+       from a full neighbour table, and whether both agree everywhere."""
+    print("%8s %8s %12s %12s %12s %12s %s" % ("size", "cells", "areas", "(table)", "gradient", "(table)", "parity"))
+    for size in args.sizes:
+        rng = np.random.default_rng(size)
+        layer = rng.random((size, size))
+        coords = rng.integers(0, size, (args.pops[-1], 2))
+        lattice = topology.lattice(size)
+        start = time.perf_counter()
+        table = neighbour_table(size)
+        built = time.perf_counter() - start
+
+        def batched():
+            return lattice.gather(layer, lattice.areas(lattice.cells(coords[:, 0], coords[:, 1])))
+
+        def tabled():
+            return lattice.gather(layer, table[lattice.cells(coords[:, 0], coords[:, 1])])
+
+        def gradient_tabled():
+            return (layer.ravel()[table] - layer.ravel()[:, None]).reshape(size, size, 9)
+
+        same = np.array_equal(batched(), tabled()) and np.array_equal(lattice.gradient(layer), gradient_tabled())
+        times = [timed(f, args.repeat) for f in (batched, tabled, lambda: lattice.gradient(layer), gradient_tabled)]
+        print("%8d %8d %11.5fs %11.5fs %11.5fs %11.5fs %s (a table takes %.4fs and %.1f MB)" %
+              (size, len(coords), *times, "ok" if same else "FAIL", built, table.nbytes / 2**20))
+
+# the largest map the tiles benchmark also runs densely, for comparison
+DENSE_LIMIT = 2048
+
+def bench_tiles(args):
+    """Time and peak memory to generate a world, the memory its layers hold
+       afterwards and the time per tick, for dense layers against tiled
+       ones (tiles.py) paged to a temporary store with at most
+       args.resident chunks of each layer in memory. Maps above
+       DENSE_LIMIT are only run tiled. Where both run, checks that the
+       tiled run matches the dense one."""
+    print("%8s %-6s %10s %10s %10s %12s %s" % ("size", "layers", "generate", "peak", "resident", "tick", "parity"))
+    for size in args.sizes:
+        params = dict(size=size, delay=0, num_terrans=args.pops[0], spawn_dist=max(2, size // 16), storm_chance=0.05, seed=0)
+        results = {}
+        with tempfile.TemporaryDirectory() as store:
+            kinds = {'tiled': dict(tile=args.tile, store=store, resident=args.resident)}
+            if size <= DENSE_LIMIT:
+                kinds = dict({'dense': {}}, **kinds)
+            for kind, tiling in kinds.items():
+                made = []
+                start = time.perf_counter()
+                peak = traced(lambda: made.append(simulation.Simulation(**params, **tiling)))
+                generated = time.perf_counter() - start
+                sim = made[0]
+                start = time.perf_counter()
+                sim.run(args.ticks)
+                tick = (time.perf_counter() - start) / args.ticks
+                resident = sum(nbytes for dtype, shape, nbytes in sim.memory().values())
+                results[kind] = (sim.metrics(), np.asarray(sim.terrain.sustenance) if 'dense' in kinds else None)
+                parity = "-"
+                if kind == 'tiled' and 'dense' in results:
+                    parity = "ok" if (results['dense'][0] == results['tiled'][0]
+                                      and np.array_equal(results['dense'][1], results['tiled'][1])) else "FAIL"
+                print("%8d %-6s %9.3fs %8.1fMB %8.1fMB %11.5fs %s" %
+                      (size, kind, generated, peak / 2**20, resident / 2**20, tick, parity))
+                del made, sim
+
+def bench_parallel(args):
+    """Time per tick of a large, crowded world run serially and in 1 to N
+       bands on a thread pool, and whether every threaded run ends in
+       exactly the serial world."""
+    def run(threads):
+        sim = simulation.Simulation(size=args.size, delay=0, species=[{'num_terrans': args.pops[-1], 'spawn_dist': args.size // 2}],
+                                    seed=0, threads=threads)
+        sim.tick()
+        start = time.perf_counter()
+        sim.run(args.ticks)
+        pop = sim.pops[0]
+        return (time.perf_counter() - start) / args.ticks, (pop.x.copy(), pop.y.copy(), pop.energy.copy(), np.array(sim.terrain.sustenance))
+
+    serial, reference = run(None)
+    print("%d terrans on a %d map, %d ticks on %d cores: %.4fs per tick serially" %
+          (args.pops[-1], args.size, args.ticks, os.cpu_count(), serial))
+    print("%8s %12s %8s %s" % ("threads", "per tick", "speedup", "parity"))
+    for threads in range(1, args.threads + 1):
+        seconds, state = run(threads)
+        same = all(np.array_equal(a, b) for a, b in zip(state, reference))
+        print("%8d %11.4fs %7.2fx %s" % (threads, seconds, serial / seconds, "ok" if same else "FAIL"))
+
+# presets of Simulation parameters the suite runs every case under; each
+# stresses a different subsystem ('empty' never spawns any Terrans)
+SCENARIOS = {'default': {},
+             'storm-heavy': {'storm_chance': 0.5, 'storm_decay': 0.02, 'storm_speed': 3.0},
+             'population-boom': {'sex_th': 0.15, 'decay': 0.02},
+             'empty': {'delay': 10**9}}
+
+def scenario_sim(scenario, size, pop, seed=0):
+    """Returns a seeded simulation of a scenario, with pop Terrans spread
+       over the map (unless the scenario is empty), ticked until they spawn
+       and have moved once."""
+    params = dict(SCENARIOS[scenario])
+    species = None
+    if 'delay' not in params:
+        params['delay'] = 0
+        species = [{'num_terrans': pop, 'spawn_dist': size // 2}]
+    sim = simulation.Simulation(size=size, species=species, seed=seed, **params)
+    sim.run(2)
+    return sim
+
+def measure(prepare, run, repeat=3):
+    """Times run(state) on a fresh state from prepare() (which isn't timed),
+       returning the best wall time in seconds, and, from one more call
+       traced by tracemalloc, the peak memory it allocated and the number of
+       memory blocks it allocated and kept."""
+    best = float('inf')
+    for i in range(repeat):
+        state = prepare()
+        start = time.perf_counter()
+        run(state)
+        best = min(best, time.perf_counter() - start)
+
+    state = prepare()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    run(state)
+    peak = tracemalloc.get_traced_memory()[1] - current
+    blocks = sum(stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(before, 'filename'))
+    tracemalloc.stop()
+    return {'seconds': best, 'peak': peak, 'blocks': blocks}
+
+def suite_cases(args):
+    """Yields the name and the (prepare, run, per) functions of every case of
+       the suite, where run takes per calls of the measured function."""
+    for size in args.sizes:
+        rng = np.random.default_rng(size)
+        points = np.zeros((size, size))
+        points.flat[rng.choice(size * size, size * 12)] = 1.0
+        layer = rng.random((size, size))
+        yield 'proc_gen@%d' % size, (lambda: np.random.default_rng(0), lambda r, size=size: world.proc_gen(size, size * 12, 4, r), 1)
+        yield 'proc_smooth@%d' % size, (lambda: None, lambda s, points=points: world.proc_smooth(points, 4), 1)
+        yield 'proc_filter@%d' % size, (lambda layer=layer: layer.copy(), lambda m, layer=layer: world.proc_filter(m, layer, 0.5), 1)
+        yield 'get_gradient@%d' % size, (lambda: None, lambda s, layer=layer: util.get_gradient(layer), 1)
+
+    for scenario in args.scenarios:
+        populated = 'delay' not in SCENARIOS[scenario]
+        for size in args.sizes:
+            # the densest population sensible on the map, and none at all in an empty world
+            pops = [n for n in args.pops if n <= size * size // 8] if populated else [0]
+            for n in pops:
+                sim = scenario_sim(scenario, size, n)
+                prepare = lambda sim=sim: copy.deepcopy(sim)
+                key = '[%s]@%dx%d' % (scenario, size, n)
+                if n == pops[0]:
+                    yield 'Weather.update' + key, (prepare, lambda s: s.weather.update(), 1)
+                if populated:
+                    def move(s):
+                        s.census.record(s.pops)
+                        s.pops[0].move_terrans()
+                    yield 'TerranPop.move_terrans' + key, (prepare, move, 1)
+                    yield 'TerranPop.manage_terrans' + key, (prepare, lambda s: s.pops[0].manage_terrans(), 1)
+                yield 'tick' + key, (prepare, lambda s: s.run(args.window), args.window)
+
+def git_commit():
+    """Returns the commit the working tree is at, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def numba_version():
+    """Returns the version of Numba installed, without importing it, or None."""
+    try:
+        return importlib.metadata.version('numba')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def write_json(path, value):
+    """Writes value to a JSON file, atomically replacing any file there."""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def regressions(results, baseline, threshold):
+    """Returns (case, measure, value, baseline value) for every time or peak
+       memory in results that is more than threshold (relative) worse than
+       the baseline. Small absolute differences are ignored as noise."""
+    floors = {'seconds': 1e-4, 'peak': 64 * 1024}
+    worse = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        for name, floor in floors.items():
+            value, base = result[name], baseline[case][name]
+            if value > base * (1 + threshold) and value - base > floor:
+                worse.append((case, name, value, base))
+    return worse
+
+def bench_suite(args):
+    """Seeded suite timing every hot path (generation, smoothing, filtering,
+       gradients, the weather, Terran movement and management, and full
+       ticks) at every map and population size, under every scenario. Each
+       run is appended to a JSON history, and compared with a baseline run,
+       flagging regressions (the exit status is 1 if any is found)."""
+    run = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'backend': kernels.BACKEND,
+           'python': sys.version.split()[0], 'numpy': np.__version__, 'numba': numba_version(), 'cpus': os.cpu_count(),
+           'sizes': args.sizes, 'pops': args.pops, 'scenarios': args.scenarios, 'window': args.window,
+           'repeat': args.repeat, 'results': {}}
+    print("%-52s %12s %12s %10s" % ("case", "per call", "peak", "blocks"))
+    for case, (prepare, func, per) in suite_cases(args):
+        result = measure(prepare, func, args.repeat)
+        result['seconds'] /= per
+        run['results'][case] = result
+        print("%-52s %11.5fs %10.2fMB %10d" % (case, result['seconds'], result['peak'] / 2**20, result['blocks']), flush=True)
+
+    if args.history:
+        history = []
+        if os.path.exists(args.history):
+            with open(args.history) as f:
+                history = json.load(f)
+        write_json(args.history, history + [run])
+
+    worse = []
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        worse = regressions(run['results'], baseline['results'], args.regression)
+        print("\ncompared with the baseline of %s (commit %s): %d regressions" % (baseline['date'], baseline['commit'], len(worse)))
+        for case, name, value, base in worse:
+            print("  REGRESSION %-50s %-8s %12.6g vs %12.6g (+%.0f%%)" % (case, name, value, base, 100 * (value / base - 1)))
+    if args.baseline and args.save_baseline:
+        write_json(args.baseline, run)
+        print("\nsaved as the baseline in %s" % args.baseline)
+    if worse:
+        sys.exit(1)
+
+benchmarks = {'spatial': bench_spatial, 'vegetation': bench_vegetation, 'precision': bench_precision,
+              'kernels': bench_kernels, 'startup': bench_startup, 'births': bench_births,
+              'fastforward': bench_fastforward, 'ensemble': bench_ensemble,
+              'topology': bench_topology, 'tiles': bench_tiles, 'parallel': bench_parallel, 'suite': bench_suite}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the Terra^2 simulation.")
+    parser.add_argument('name', choices=sorted(benchmarks), help="the benchmark to run")
+    parser.add_argument('--size', type=int, default=128, help="the map size")
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+                        help="the map sizes (default: 64 256 1024 2048 for the suite, 64 256 1024 4096 otherwise)")
+    parser.add_argument('--pops', type=int, nargs='+', default=None,
+                        help="the population sizes (default: 10 1000 10000 100000 for the suite, 100 300 1000 3000 otherwise)")
+    parser.add_argument('--ticks', type=int, default=300, help="the number of ticks per run")
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help="the most threads to scale up to")
+    parser.add_argument('--members', type=int, default=256, help="the number of worlds in an ensemble")
+    parser.add_argument('--seeds', type=int, default=6, help="the number of seeded runs to average over")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="the largest relative difference of run-averaged metrics from float64")
+    parser.add_argument('--map-tolerance', type=float, default=1e-3,
+                        help="the largest absolute difference of the final vegetation from float64")
+    parser.add_argument('--tile', type=int, default=256, help="the tile size of tiled layers")
+    parser.add_argument('--resident', type=int, default=16, help="the most chunks of each tiled layer kept in memory")
+    parser.add_argument('--repeat', type=int, default=3, help="the number of timed repeats (the best is reported)")
+    parser.add_argument('--scenarios', nargs='+', default=sorted(SCENARIOS), choices=sorted(SCENARIOS),
+                        help="the scenario presets the suite runs")
+    parser.add_argument('--window', type=int, default=10, help="the number of ticks each full-tick case of the suite runs")
+    parser.add_argument('--history', default=None, metavar='PATH', help="a JSON file every suite run is appended to")
+    parser.add_argument('--baseline', default=None, metavar='PATH', help="a JSON file of the suite run to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="save this suite run as the baseline instead")
+    parser.add_argument('--regression', type=float, default=0.25,
+                        help="the largest relative slowdown or memory growth from the baseline that isn't flagged")
+    args = parser.parse_args()
+    # the suite measures every scale by default; the other benchmarks compare
+    # implementations, some of which (e.g. the brute-force index) can't go as far
+    if args.sizes is None:
+        args.sizes = [64, 256, 1024, 2048] if args.name == 'suite' else [64, 256, 1024, 4096]
+    if args.pops is None:
+        args.pops = [10, 1000, 10000, 100000] if args.name == 'suite' else [100, 300, 1000, 3000]
+    benchmarks[args.name](args)
@@ -0,0 +1,215 @@
+# Checkpointing of full Terra^2 world state, so runs can be paused, resumed and forked.
+#
+# A checkpoint is a directory holding a state.json record (parameters, storms,
+# RNG state, ...) and one .npy file per array, grouped by object:
+#
+#     state.json
+#     terrain/heightmap.npy, terrain/vegetation.npy, ...
+#     weather/weathermap.npy, ...
+#     census/occupancy.npy, ...
+#     pop0/x.npy, pop0/energy.npy, ...
+#
+# Loading memory-maps the arrays, so a large world is available at once and
+# layers that never change (the heightmap, climates, gradients) are never
+# copied into memory. Layers that do change are mapped copy-on-write, so
+# several simulations can be forked from the same checkpoint on disk.
+#
+# Tiled layers (see tiles.py) are saved as a directory holding one .npy file
+# per allocated chunk, terrain/vegetation/3_5.npy, ..., and each chunk is
+# only read back when the loaded simulation first uses it.
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+import spatial, terrans, tiles, world
+from simulation import Observer, Simulation
+
+VERSION = 8
+
+# arrays that are never written to after generation, which are mapped read-only
+STATIC = ('heightmap', 'climates', 'gradient_c_centre', 'gradient_c_mean', 'land', 'fertile', 'stamp_x', 'stamp_y', 'stamp_w')
+
+def _encode(value, refs):
+    """Converts an attribute into something JSON can store."""
+    if id(value) in refs:
+        return {'ref': refs[id(value)]}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(v, refs) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v, refs) for v in value]
+    if isinstance(value, dict):
+        return {'dict': {k: _encode(v, refs) for k, v in value.items()}}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError("Can't checkpoint a value of type %s" % type(value).__name__)
+
+def _decode(value, refs):
+    if isinstance(value, list):
+        return [_decode(v, refs) for v in value]
+    if isinstance(value, dict):
+        if 'ref' in value:
+            return refs[value['ref']]
+        if 'tuple' in value:
+            return tuple(_decode(v, refs) for v in value['tuple'])
+        return {k: _decode(v, refs) for k, v in value['dict'].items()}
+    return value
+
+def _save_object(obj, path, refs, skip=()):
+    """Saves the arrays of obj as .npy files under path and returns the rest
+       of its attributes as a JSON-able dict."""
+    os.makedirs(path)
+    state = {}
+    for name, value in vars(obj).items():
+        if name in skip:
+            continue
+        if isinstance(value, np.ma.MaskedArray):
+            np.save(os.path.join(path, name + '.npy'), np.ma.getdata(value))
+            np.save(os.path.join(path, name + '.mask.npy'), np.ma.getmaskarray(value))
+            state[name] = {'masked': True}
+        elif isinstance(value, np.ndarray):
+            np.save(os.path.join(path, name + '.npy'), value)
+            state[name] = {'array': True}
+        elif isinstance(value, tiles.ChunkedLayer):
+            value.save_chunks(os.path.join(path, name))
+            state[name] = {'chunked': {'size': value.size, 'chunk': value.chunk, 'dtype': value.dtype.str,
+                                       'fill': value.fill, 'store': value.store, 'resident': value.resident,
+                                       'name': value.name}}
+        elif isinstance(value, spatial.SpatialIndex):
+            np.save(os.path.join(path, name + '.npy'), value.points)
+            if value.labels is not None:
+                np.save(os.path.join(path, name + '.labels.npy'), value.labels)
+            kind = [k for k, cls in spatial.indices.items() if type(value) is cls][0]
+            state[name] = {'index': kind, 'labels': value.labels is not None}
+        else:
+            state[name] = _encode(value, refs)
+    return state
+
+def _load_array(path, name, mmap):
+    filename = os.path.join(path, name + '.npy')
+    if not mmap:
+        return np.load(filename)
+    try:
+        return np.load(filename, mmap_mode='r' if name in STATIC else 'c')
+    except ValueError:
+        # empty arrays can't be memory-mapped
+        return np.load(filename)
+
+def _load_object(cls, state, path, refs, mmap):
+    """Rebuilds an object of class cls from a state saved by _save_object."""
+    obj = cls.__new__(cls)
+    for name, value in state.items():
+        if isinstance(value, dict) and value.get('array'):
+            value = _load_array(path, name, mmap)
+        elif isinstance(value, dict) and value.get('masked'):
+            value = np.ma.masked_array(_load_array(path, name, mmap), mask=np.load(os.path.join(path, name + '.mask.npy')))
+        elif isinstance(value, dict) and 'chunked' in value:
+            layer = tiles.ChunkedLayer(**value['chunked'])
+            layer.load_chunks(os.path.join(path, name))
+            value = layer
+        elif isinstance(value, dict) and 'index' in value:
+            index = spatial.make_index(value['index'], refs['terrain'].size)
+            labels = np.load(os.path.join(path, name + '.labels.npy')) if value.get('labels') else None
+            index.rebuild(np.load(os.path.join(path, name + '.npy')), labels)
+            value = index
+        else:
+            value = _decode(value, refs)
+        setattr(obj, name, value)
+    return obj
+
+def save(sim, path):
+    """Saves the full state of a Simulation to the directory at path,
+       replacing any checkpoint already there. Observers and profilers
+       aren't saved.
+
+       The checkpoint is written next to path first and then moved into
+       place, so an interrupted save never leaves a half-written checkpoint.
+       """
+    path = os.path.abspath(path)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+
+    refs = {id(sim.terrain): 'terrain', id(sim.weather): 'weather', id(sim.census): 'census', id(sim.rng): 'rng'}
+    state = {'version': VERSION,
+             'rng': sim.rng.bit_generator.state,
+             'simulation': _save_object(sim, tmp, refs, skip=('rng', 'terrain', 'weather', 'census', 'pops', 'observers', 'profiler')),
+             'terrain': _save_object(sim.terrain, os.path.join(tmp, 'terrain'), refs),
+             'weather': _save_object(sim.weather, os.path.join(tmp, 'weather'), refs),
+             # the cached gradients are also held by the populations that use them
+             'census': _save_object(sim.census, os.path.join(tmp, 'census'), refs, skip=('gradients',)),
+             'pops': [_save_object(pop, os.path.join(tmp, 'pop%d' % i), refs) for i, pop in enumerate(sim.pops)]}
+
+    with open(os.path.join(tmp, 'state.json'), 'w') as f:
+        json.dump(state, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+def load(path, mmap=True, seed=None):
+    """Loads a Simulation from the checkpoint directory at path.
+
+       Keyword arguments:
+       path -- the checkpoint directory.
+       mmap -- whether to memory-map the arrays rather than read them into memory.
+               Tiled layers always read each chunk from the checkpoint when it
+               is first used, so the checkpoint must be kept until the
+               simulation is done with it.
+       seed -- if supplied, the loaded simulation draws from a new Generator
+               built from this seed instead of resuming the saved one, which
+               forks a different branch from the same world.
+       """
+    with open(os.path.join(path, 'state.json')) as f:
+        state = json.load(f)
+    if state['version'] != VERSION:
+        raise ValueError("Unsupported checkpoint version %s" % state['version'])
+
+    if seed is None:
+        bit_generator = getattr(np.random, state['rng']['bit_generator'])()
+        bit_generator.state = state['rng']
+        rng = np.random.Generator(bit_generator)
+    else:
+        rng = np.random.default_rng(seed)
+
+    refs = {'rng': rng}
+    refs['terrain'] = _load_object(world.Terrain, state['terrain'], os.path.join(path, 'terrain'), refs, mmap)
+    refs['weather'] = _load_object(world.Weather, state['weather'], os.path.join(path, 'weather'), refs, mmap)
+    refs['census'] = _load_object(terrans.Census, state['census'], os.path.join(path, 'census'), refs, mmap)
+    refs['census'].gradients = {}
+
+    sim = _load_object(Simulation, state['simulation'], path, refs, mmap)
+    sim.rng, sim.terrain, sim.weather, sim.census = rng, refs['terrain'], refs['weather'], refs['census']
+    sim.pops = [_load_object(terrans.TerranPop, pop, os.path.join(path, 'pop%d' % i), refs, mmap)
+                for i, pop in enumerate(state['pops'])]
+    sim.observers = []
+    sim.profiler = None
+    return sim
+
+class Autosave(Observer):
+    """Saves a checkpoint of the simulation every few ticks.
+
+       Keyword arguments:
+       root -- the directory the checkpoints are saved in.
+       every -- the number of ticks between checkpoints.
+       keep -- the number of most recent checkpoints to keep.
+       """
+
+    def __init__(self, root, every=1000, keep=1):
+        self.root = root
+        self.every = every
+        self.keep = keep
+        self.saved = []
+        os.makedirs(root, exist_ok=True)
+
+    def update(self, sim):
+        if sim.step % self.every == 0:
+            path = os.path.join(self.root, 'tick%08d' % sim.step)
+            save(sim, path)
+            self.saved.append(path)
+            while len(self.saved) > self.keep:
+                shutil.rmtree(self.saved.pop(0), ignore_errors=True)
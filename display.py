@@ -1,55 +1,238 @@
 # This class defines the user interface for Terra^2.
 # Ethan Block, 10-3-2018
+#
+# The map is drawn by a Renderer, which creates its images once and then
+# only swaps the data of the layers that change (vegetation, Terrans and
+# storms); the terrain and climate layers are drawn once. TerraSquaredUI
+# shows the map in an interactive window, and FrameWriter renders it
+# offscreen with Agg straight to PNG files or an MP4 video.
+
+import os
+import queue
+import threading
 
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
+from matplotlib.animation import FFMpegWriter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
 
 import util
+from simulation import Observer
 
 def handle_close(evt):
     exit()
 
-class TerraSquaredUI:
-
-    def __init__(self, terrain, weather):
+def snapshot(sim):
+    """Returns a copy of the layers of a simulation that change between
+       ticks, which a renderer can draw while the simulation moves on."""
+    pops = [pop.get_positions()[0] for pop in sim.pops] if sim.spawned else []
+    return {'step': sim.step,
+            'vegetation': np.array(sim.terrain.vegetation),
+            'pops': pops,
+            'weathermap': np.ma.filled(sim.weather.weathermap, 0.0).copy()}
 
-        fig = plt.figure()
-        fig.canvas.mpl_connect('close_event', handle_close)
+class Renderer:
 
-        plt.xlabel("$x$")
-        plt.ylabel("$y$")
-
-        bounds = np.array([terrain.v_bounds[0], terrain.v_bounds[1]*0.15, terrain.v_bounds[1]*0.7, terrain.v_bounds[1]*1.4])
-        self.norm = colors.BoundaryNorm(boundaries=bounds, ncolors=4)
+    def __init__(self, terrain, weather, fig):
+        """Draws a Terra^2 world onto a matplotlib figure. The images are
+           created once, and render only swaps in the data of the layers
+           that change.
 
+           Keyword arguments:
+           terrain -- the Terrain to draw.
+           weather -- the Weather to draw.
+           fig -- the figure to draw onto.
+           """
         self.fig = fig
         self.terrain = terrain
         self.weather = weather
 
+        ax = fig.add_subplot()
+        ax.set_xlabel("$x$")
+        ax.set_ylabel("$y$")
+        self.ax = ax
+
+        bounds = np.array([terrain.v_bounds[0], terrain.v_bounds[1]*0.15, terrain.v_bounds[1]*0.7, terrain.v_bounds[1]*1.4])
+        self.norm = colors.BoundaryNorm(boundaries=np.sort(bounds), ncolors=4)
+
+        # static layers, drawn once
+        heightmap = np.asarray(terrain.heightmap)
+        ax.imshow(np.max(heightmap) - heightmap, cmap='Blues', interpolation='nearest', zorder=0)
+        ax.imshow(util.mask(np.asarray(terrain.climates), 0.1), cmap='Oranges', interpolation='none', alpha=0.3, zorder=2)
+
+        # dynamic layers, updated with set_data
+        self.vegetation = ax.imshow(self.norm(util.mask(terrain.vegetation, 1e-8)), cmap='Greens', alpha=0.8,
+                                    vmin=0, vmax=3, zorder=1)
+        self.storms = ax.imshow(np.zeros((terrain.size, terrain.size)), cmap='Purples', interpolation='none',
+                                alpha=0.6, visible=False, zorder=4)
+        self.pops = []
+
+    def _pop_image(self, i):
+        while len(self.pops) <= i:
+            # the first population keeps the original colours, the rest get one of their own
+            n = len(self.pops)
+            cmap = 'Spectral' if n == 0 else colors.ListedColormap([plt.get_cmap('tab10')(n % 10)])
+            self.pops.append(self.ax.imshow(np.zeros((self.terrain.size, self.terrain.size)), cmap=cmap,
+                                            interpolation='none', visible=False, zorder=3))
+        return self.pops[i]
+
+    def render(self, frame):
+        """Updates the images with a frame returned by snapshot."""
+        vegetation = frame['vegetation']
+        self.vegetation.set_data(self.norm(np.ma.masked_less(vegetation, 1e-8)))
+
+        for i, pmap in enumerate(frame['pops']):
+            image = self._pop_image(i)
+            image.set_data(np.ma.masked_less(pmap, 0.1))
+            image.autoscale()
+            image.set_visible(True)
+        for image in self.pops[len(frame['pops']):]:
+            image.set_visible(False)
+
+        weathermap = frame['weathermap']
+        if weathermap.max() > 0.1:
+            self.storms.set_data(np.ma.masked_less(weathermap, 0.1))
+            self.storms.autoscale()
+            self.storms.set_visible(True)
+        else:
+            self.storms.set_visible(False)
+
+    def close(self):
+        pass
+
+class TerraSquaredUI(Renderer):
+
+    def __init__(self, terrain, weather):
+        """Shows a Terra^2 world in an interactive window."""
+        fig = plt.figure()
+        fig.canvas.mpl_connect('close_event', handle_close)
+        super().__init__(terrain, weather, fig)
+        plt.show(block=False)
+
+    def render(self, frame):
+        super().render(frame)
+        self.fig.canvas.draw_idle()
+        self.fig.canvas.flush_events()
+
     def update(self, pops=None):
         """Master update function for the UI - redraw the visuals each update.
            """
-        plt.clf()
-        bg = np.max(self.terrain.heightmap) - self.terrain.heightmap
-        plt.imshow(bg, cmap='Blues', interpolation='nearest')
+        self.render({'vegetation': self.terrain.vegetation,
+                     'pops': [pop.get_positions()[0] for pop in pops or []],
+                     'weathermap': np.ma.filled(self.weather.weathermap, 0.0)})
+
+class FrameWriter(Renderer):
+
+    def __init__(self, terrain, weather, path, fps=30, dpi=100, figsize=(6.4, 4.8)):
+        """Renders a Terra^2 world offscreen with Agg and writes every frame
+           to disk, without opening a window.
+
+           Keyword arguments:
+           terrain -- the Terrain to draw.
+           weather -- the Weather to draw.
+           path -- an .mp4 file to encode the frames into (with ffmpeg), or a
+                   pattern for PNG files such as frames/%06d.png, which is
+                   formatted with the step of each frame. A path with no
+                   placeholder gets _%06d appended before its extension.
+           fps -- the frame rate of a video.
+           dpi, figsize -- the resolution and size of each frame.
+           """
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        super().__init__(terrain, weather, fig)
+        if not path.endswith('.mp4'):
+            try:
+                path % 0
+            except (TypeError, ValueError):
+                root, ext = os.path.splitext(path.replace('%', '%%'))
+                path = root + '_%06d' + (ext or '.png')
+        self.path = path
+        self.frames = 0
+
+        self.video = None
+        if path.endswith('.mp4'):
+            if not FFMpegWriter.isAvailable():
+                raise RuntimeError("Writing MP4 video requires ffmpeg")
+            self.video = FFMpegWriter(fps=fps)
+            self.video.setup(fig, path, dpi=dpi)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def render(self, frame):
+        super().render(frame)
+        if self.video is not None:
+            self.video.grab_frame()
+        else:
+            self.fig.savefig(self.path % frame['step'])
+        self.frames += 1
+
+    def close(self):
+        if self.video is not None:
+            self.video.finish()
+            self.video = None
+
+class RenderObserver(Observer):
+    """Draws a simulation with a Renderer every few ticks.
+
+       With threaded set, frames are snapshotted on the simulation thread
+       and drawn by a background thread from a bounded queue, so the
+       simulation only waits for rendering when the queue is full (or never,
+       if drop is set, in which case the oldest waiting frame is dropped).
+       Interactive windows must be drawn from the main thread, so threaded
+       rendering is meant for FrameWriter.
+
+       Keyword arguments:
+       ui -- the Renderer to draw with.
+       every -- the number of ticks between frames.
+       threaded -- whether to draw on a background thread.
+       queue_size -- the number of frames that may wait to be drawn.
+       drop -- whether to drop frames rather than wait when the queue is full.
+       """
 
-        vmap = util.mask(self.terrain.vegetation, 1e-8)
+    def __init__(self, ui, every=1, threaded=False, queue_size=8, drop=False):
+        self.ui = ui
+        self.every = every
+        self.drop = drop
+        self.dropped = 0
+        self.queue = None
+        self.thread = None
+        if threaded:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self._draw, daemon=True)
+            self.thread.start()
 
-        plt.imshow(self.norm(vmap), cmap='Greens', alpha=0.8)
-        plt.imshow(util.mask(self.terrain.climates, 0.1), cmap='Oranges', interpolation='none', alpha=0.3)
+    def _draw(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            self.ui.render(frame)
 
-        # render Terran populations
-        if pops is not None:
-            for i in range(len(pops)):
-                if len(pops[i].terrans) > 0:
-                    pmap = pops[i].get_positions()[0]
-                    pmap = util.mask(pmap, 0.1)
-                    plt.imshow(pmap, cmap='Spectral', interpolation='none')
+    def update(self, sim):
+        if sim.step % self.every:
+            return
+        frame = snapshot(sim)
+        if self.queue is None:
+            self.ui.render(frame)
+            return
 
-        # render storms
-        if np.max(self.weather.weathermap) > 0:
-            plt.imshow(util.mask(self.weather.weathermap, 0.1), cmap='Purples', interpolation='none', alpha=0.6)
+        while self.drop:
+            try:
+                self.queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+        self.queue.put(frame)
 
-        plt.draw()
-        plt.pause(0.0001)
+    def close(self, sim):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.ui.close()
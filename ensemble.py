@@ -0,0 +1,384 @@
+# Ensembles of many small, independent Terra^2 worlds stepped together.
+#
+# An Ensemble stacks the layers of B worlds into (B, size, size) arrays and
+# keeps the storms and Terrans of every world in flat arrays tagged with the
+# world they belong to, so vegetation growth, storm rasterization, smoothing
+# and the Terran update each run as one batched pass over every member
+# rather than once per world. The worlds never interact: stamps are offset
+# into their own layer, and neighbour queries only see their own world.
+#
+#     ensemble = Ensemble(256, size=64, seed=1)
+#     ensemble.run(500)
+#     ensemble.metrics()['population']  # one entry per world
+
+import numpy as np
+
+import kernels, spatial, terrans, topology, util, world
+
+def _smooth(layers, sigma):
+    """Smooths every layer of a (B, size, size) stack as proc_smooth does."""
+    from scipy import ndimage
+    return ndimage.gaussian_filter(layers, [0, sigma, sigma], mode='constant')
+
+def _normalize(layers, bounds=(0, 1)):
+    """Normalizes every layer of a stack on its own, as util.normalize does."""
+    return util.normalize(layers, layers.min(axis=(1, 2), keepdims=True), layers.max(axis=(1, 2), keepdims=True), bounds)
+
+class Ensemble:
+
+    def __init__(self, members, size=64, points=None, delay=100, num_terrans=4, spawn_dist=2, temprange=(0.0, 1.0),
+                 storm_chance=0.01, storm_int=0.2, storm_decay=0.05, storm_speed=2.0, sex_th=0.3, decay=0.1,
+                 decay_h=0.25, decay_soc=0.005, sigma=4, num_climates=10, v_sparsity=0.02, v_bounds=(0.2, 0.8),
+                 water_level=0.5, s_rate=0.05, storm_sigma=2, seed=None):
+        """A batch of independent Terra^2 worlds of the same size and
+           parameters, each with a single population, stepped together.
+
+           Each member world is generated from its own child of the seed
+           (see seeds), and is the same world Simulation(size, seed=seeds[i])
+           generates. Their dynamics are driven by one further Generator
+           shared by every member, so a member's run matches a Simulation's
+           in distribution but not draw for draw. A single member draws
+           from it in the order a Simulation does, so starting it from the
+           state of the Simulation's Generator gives an identical run
+           (tests/test_ensemble.py checks this).
+
+           Keyword arguments:
+           members -- the number of worlds.
+           size, points, delay, num_terrans, spawn_dist, temprange, storm_chance,
+           storm_int, storm_decay, storm_speed, sex_th, decay -- as for Simulation.
+           decay_h, decay_soc -- as for TerranPop.
+           sigma, num_climates, v_sparsity, v_bounds, water_level, s_rate -- as for Terrain.
+           storm_sigma -- the smoothing factor of the storms (Weather's sigma).
+           seed -- an integer seed or a numpy SeedSequence.
+           """
+        if points is None:
+            points = size*12
+        self.members = members
+        self.size = size
+        self.points = points
+        self.delay = delay
+        self.num_terrans = num_terrans
+        self.spawn_dist = spawn_dist
+        self.temprange = temprange
+        self.storm_chance = storm_chance
+        self.storm_int = storm_int
+        self.storm_decay = storm_decay
+        self.storm_speed = storm_speed
+        self.sex_th = sex_th
+        self.decay = decay
+        self.decay_h = decay_h
+        self.decay_soc = decay_soc
+        self.v_sparsity = v_sparsity
+        self.water_level = water_level
+        self.s_rate = s_rate
+
+        sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.seeds = sequence.spawn(members)
+        self.rng = np.random.default_rng(sequence.spawn(1)[0])
+        self.generate(sigma, num_climates, v_bounds)
+
+        # the flat index of the first cell of each world in the flattened layers
+        self.base = np.arange(members, dtype=np.intp) * size**2
+
+        # storms, as parallel arrays tagged with their world
+        self.storm_world = np.zeros(0, dtype=np.intp)
+        self.storm_pos = np.zeros((0, 2))
+        self.storm_vel = np.zeros((0, 2))
+        self.storm_str = np.zeros(0)
+        self.weathermap = np.zeros((members, size, size))
+        self.storm_cells = np.zeros(0, dtype=np.intp)
+        self.storm_stamp = world.gaussian_stamp(storm_sigma)
+        self.storm_index = spatial.GridIndex(size, layers=members)
+
+        # Terrans, as columns tagged with their world
+        self.world = np.zeros(0, dtype=np.intp)
+        self.x = np.zeros(0, dtype=np.intp)
+        self.y = np.zeros(0, dtype=np.intp)
+        self.health = np.zeros(0)
+        self.energy = np.zeros(0)
+        self.social = np.zeros(0)
+        self.births = np.zeros(members, dtype=np.int64) # in the last tick, per world
+        self.deaths = np.zeros(members, dtype=np.int64)
+        self.occupancy = np.zeros((members, size, size), dtype=bool)
+        self.index = spatial.GridIndex(size, layers=members)
+        self.coords = np.zeros((0, 3), dtype=np.intp) # x, y, world
+        self.spawned = False
+        self.step = 0
+
+    def generate(self, sigma, num_climates, v_bounds):
+        """Generates the layers of every member, drawing each world's points
+           from its own seed in the order Terrain does, but smoothing and
+           normalizing every world in one pass."""
+        size, points = self.size, self.points
+        rngs = [np.random.default_rng(seed) for seed in self.seeds]
+
+        # every world draws its height points, then its climate points
+        heights = np.zeros((self.members, size * size))
+        climates = np.zeros((self.members, size * size))
+        for i, rng in enumerate(rngs):
+            heights[i, rng.choice(size * size, size=int(points))] = 1.0
+            climates[i, rng.choice(size * size, size=int(num_climates))] = 1.0
+        heightmap = _normalize(_smooth(heights.reshape(-1, size, size), sigma))
+        climates = _normalize(_smooth(climates.reshape(-1, size, size), sigma))*4
+        climates[:, 0:int(size/4)] = 0.0
+        climates[:, -int(size/4):-1] = 0.0
+        climates = _normalize(_smooth(climates, sigma*4), bounds=(v_bounds[0]*0.75, v_bounds[1]*1.25))
+
+        # ...and then its vegetation seeds, on the cells suitable for them
+        seeds = np.zeros((self.members, size * size))
+        suitable = ((climates >= v_bounds[0]) & (climates <= v_bounds[1]) & (heightmap >= self.water_level)).reshape(self.members, -1)
+        for i, rng in enumerate(rngs):
+            cells = np.flatnonzero(suitable[i])
+            if len(cells) > 0:
+                seeds[i, rng.choice(cells, size=int(points * self.v_sparsity))] = 1.0
+        vegetation = _smooth(seeds.reshape(-1, size, size), sigma/2)
+        vegetation[heightmap <= self.water_level] = 0.0
+
+        self.heightmap = heightmap
+        self.climates = climates
+        self.vegetation = vegetation
+        self.sustenance = vegetation.copy()
+        self.land = heightmap > self.water_level
+        self.fertile = (climates >= v_bounds[0]) & (climates <= v_bounds[1]) & (heightmap > self.water_level+0.2)
+        self.stamp = world.gaussian_stamp(sigma/2)
+
+    def __len__(self):
+        return len(self.x)
+
+    def tick(self):
+        """Advances every world by a single step."""
+        self.grow_vegetation()
+        self.update_weather()
+        if not self.spawned:
+            if self.step >= self.delay:
+                self.spawn()
+        else:
+            self.record_positions()
+            self.move_terrans()
+            self.manage_terrans()
+        self.step += 1
+
+    def run(self, ticks):
+        for i in range(ticks):
+            self.tick()
+        return self
+
+    def grow_vegetation(self):
+        """Grows vegetation on every world (see Terrain.grow_vegetation) and
+           regrows sustenance, over the whole stack at once."""
+        size = self.size
+        seeds = self.rng.integers(0, size * size, size=(self.members, int(self.points*self.v_sparsity)))
+        seeds = (self.base[:, None] + seeds).ravel()
+        seeds = np.unique(seeds[self.fertile.flat[seeds]])
+        if len(seeds) > 0:
+            base, seeds = np.divmod(seeds, size**2)
+            sx, sy = np.divmod(seeds, size)
+            cells, weights = kernels.stamp(sx, sy, np.ones(len(seeds)), *self.stamp, size, base * size**2)
+            on_land = self.land.flat[cells]
+            vegetation = self.vegetation.reshape(-1)
+            cells = kernels.splat(vegetation, cells[on_land], weights[on_land])
+            vegetation[cells] = np.minimum(vegetation[cells], 1.0)
+
+        sustenance = self.sustenance
+        regrow = (sustenance > 0.1) & (sustenance < self.vegetation)
+        np.add(sustenance, self.s_rate, out=sustenance, where=regrow)
+
+    def update_weather(self):
+        """Moves, decays, draws and forms the storms of every world (see
+           Weather.update)."""
+        if len(self.storm_cells) > 0:
+            self.weathermap.flat[self.storm_cells] = 0.0
+            self.storm_cells = np.zeros(0, dtype=np.intp)
+
+        if len(self.storm_str) > 0:
+            self.storm_pos += self.storm_vel
+            np.mod(self.storm_pos, self.size, out=self.storm_pos)
+            self.storm_pos[self.storm_pos >= self.size] = 0.0
+
+            self.storm_str *= (1 - self.storm_decay)
+            self.rasterize()
+
+            alive = self.storm_str > 0.1
+            self.storm_world = self.storm_world[alive]
+            self.storm_pos = self.storm_pos[alive]
+            self.storm_vel = self.storm_vel[alive]
+            self.storm_str = self.storm_str[alive]
+
+        # each world forms at most one storm a tick, behind its others
+        formed = np.flatnonzero(self.rng.random(self.members) < self.storm_chance)
+        if len(formed) > 0:
+            self.storm_world = np.append(self.storm_world, formed)
+            self.storm_pos = np.vstack((self.storm_pos, self.rng.integers(0, self.size, (len(formed), 2))))
+            self.storm_vel = np.vstack((self.storm_vel, self.rng.uniform(-self.storm_speed, self.storm_speed, (len(formed), 2))))
+            self.storm_str = np.append(self.storm_str, np.ones(len(formed)))
+
+        self.storm_index.rebuild(self.storm_pos, self.storm_world)
+
+    def rasterize(self):
+        """Draws the storms of every world onto its weathermap (see
+           Weather.rasterize), clearing each world against its own average."""
+        size = self.size
+        cells = self.storm_pos.astype(np.intp)
+        ids = self.storm_world * size**2 + cells[:, 0] * size + cells[:, 1]
+
+        # when storms share a cell, the last one wins
+        last = len(ids) - 1 - np.unique(ids[::-1], return_index=True)[1]
+        stamped, weights = kernels.stamp(cells[last, 0], cells[last, 1], self.storm_str[last], *self.storm_stamp,
+                                         size, self.base[self.storm_world[last]])
+
+        weathermap = self.weathermap.reshape(-1)
+        owner = stamped // size**2
+        threshold = np.bincount(owner, weights, minlength=self.members) / size**2 * 1.2
+        stamped = kernels.splat(weathermap, stamped, weights)
+
+        owner = stamped // size**2
+        values = weathermap[stamped]
+        peak = np.zeros(self.members)
+        np.maximum.at(peak, owner, values)
+        clear = (values < threshold[owner]) & (peak > threshold)[owner]
+        weathermap[stamped[clear]] = 0.0
+        self.storm_cells = stamped
+
+    def spawn(self):
+        """Spawns the population of every world around a spawn point found
+           as TerranPop does, and builds each world's climate gradients."""
+        size, members = self.size, self.members
+        index = np.arange(members)
+        point = np.full((members, 2), int(size/2))
+        peak = self.vegetation.max(axis=(1, 2))
+        while True:
+            x, y = point[:, 0], point[:, 1]
+            climate = self.climates[index, x, y]
+            bad = ((climate < self.temprange[0]) | (climate > self.temprange[1]) |
+                   (self.heightmap[index, x, y] <= self.water_level) | (self.vegetation[index, x, y] < peak/2))
+            if not bad.any():
+                break
+            point[bad] = self.rng.integers(0, size, (np.count_nonzero(bad), 2))
+
+        gradients = [terrans.climate_gradient_layers(climates, self.temprange) for climates in self.climates]
+        self.gradient_c_centre = np.stack([g['gradient_c_centre'] for g in gradients])
+        self.gradient_c_mean = np.stack([g['gradient_c_mean'] for g in gradients])
+
+        n = self.num_terrans
+        offsets = self.rng.integers(-self.spawn_dist, self.spawn_dist, (2, members, n), endpoint=True)
+        self.world = np.repeat(index, n)
+        self.x = ((point[:, 0, None] + offsets[0]) % size).ravel().astype(np.intp)
+        self.y = ((point[:, 1, None] + offsets[1]) % size).ravel().astype(np.intp)
+        self.health = np.ones(members * n)
+        self.energy = np.ones(members * n)
+        self.social = np.ones(members * n)
+        self.spawned = True
+
+    def record_positions(self):
+        """Rebuilds the occupancy grids and spatial index over the current
+           coordinates of every Terran (see Census.record)."""
+        old = self.coords
+        self.occupancy[old[:, 2], old[:, 0], old[:, 1]] = False
+        self.coords = np.column_stack((self.x, self.y, self.world))
+        self.occupancy[self.world, self.x, self.y] = True
+        self.index.rebuild(self.coords[:, :2], self.world)
+
+    def closest_terrans(self, radius=None):
+        """Returns the index of and distance to the closest other Terran of
+           the same world for every Terran (see TerranPop.get_closest_terrans)."""
+        queries = np.column_stack((self.x, self.y))
+        exclude = np.arange(len(self))
+        if radius is None:
+            closest, closest_dist = self.index.nearest(queries, exclude=exclude, label=self.world)
+            return closest[:, 0], closest_dist[:, 0]
+        return self.index.nearest_within(queries, radius, exclude=exclude, label=self.world)
+
+    def move_terrans(self):
+        """Moves every Terran of every world one step (see TerranPop.move_terrans)."""
+        coords = self.coords[:, :2]
+        if len(coords) == 0:
+            return
+
+        lattice = topology.lattice(self.size)
+        w = self.world
+        rows = np.arange(len(coords))
+        cells = lattice.cells(coords[:, 0], coords[:, 1])
+        area = lattice.areas(cells)
+        # the same cells in the flattened stacks of layers
+        offset = self.base[w]
+        cells, stacked = offset + cells, offset[:, None] + area
+
+        g_sust = lattice.gather(self.sustenance, stacked) - lattice.gather(self.sustenance, cells)[:, None]
+        g_cli = lattice.gather(self.gradient_c_mean, stacked) - lattice.gather(self.gradient_c_centre, cells)[:, None]
+        grad = (g_sust + g_cli) / 2
+        area = lattice.coords(area)
+        dest = area[rows, np.argmax(grad, axis=1)].astype(float)
+
+        closest = self.closest_terrans()[0]
+        target = coords[closest]
+        lonely = (closest >= 0) & (self.social < 0.2)
+        crowded = (closest >= 0) & (self.social > 0.8)
+        dest[lonely] = (dest[lonely] + util.paths(target[lonely], area[lonely])) / 2
+        dest[crowded] = (dest[crowded] + util.paths_away(target[crowded], area[crowded])) / 2
+
+        in_storm = np.flatnonzero(lattice.gather(self.weathermap, cells) > 0)
+        storm = self.storm_index.nearest(coords[in_storm], label=w[in_storm])[0][:, 0]
+        in_storm, storm = in_storm[storm >= 0], storm[storm >= 0]
+        if len(storm) > 0:
+            dest[in_storm] = (dest[in_storm] + util.paths_away(self.storm_pos[storm], area[in_storm])) / 2
+
+        dest = dest.astype(np.int32)
+
+        dest_area = offset[:, None] + lattice.areas(lattice.cells(dest[:, 0], dest[:, 1]))
+        free = ~lattice.gather(self.occupancy, dest_area) & (lattice.gather(self.heightmap, dest_area) > self.water_level)
+        move = free.any(axis=1)
+        self.x[move] = dest[move, 0]
+        self.y[move] = dest[move, 1]
+
+    def manage_terrans(self):
+        """Updates the Terrans of every world and resolves their births and
+           deaths (see TerranPop.manage_terrans). Survivors keep their order
+           and newborns are appended behind them, so within each world the
+           order is the same as a population's."""
+        size = self.size
+        w, x, y = self.world, self.x, self.y
+
+        # the sustenance stack, seen as one tall map, so consume handles every world at once
+        eating = (self.energy < 1.0) & (self.sustenance[w, x, y] > 0)
+        kernels.consume(self.sustenance.reshape(-1, size), w[eating] * size + x[eating], y[eating], self.decay*2)
+        self.energy[eating] += self.decay*2
+
+        self.health[self.energy <= 0.0] -= self.decay_h
+        storm = self.weathermap[w, x, y]
+        self.health -= np.where(storm > 0, storm, 0.0)
+        alive = self.health > 0.0
+
+        closest, closest_dist = self.closest_terrans(radius=2)
+        near = closest >= 0
+        self.social[near] += self.decay_soc
+        self.social[~near] -= self.decay_soc
+
+        # pairs never span worlds, so resolving them in one pass matches resolving each world's
+        energy = self.energy
+        candidates = np.flatnonzero(near & (energy > self.sex_th))
+        mated = np.empty(len(candidates), dtype=np.int64)
+        parents = mated[:kernels.mate(candidates, closest, energy, self.sex_th, mated)]
+
+        energy[self.social <= 0.0] -= self.decay_h
+        energy -= self.decay
+
+        self.births = np.bincount(w[parents], minlength=self.members)
+        self.deaths = np.bincount(w[~alive], minlength=self.members)
+        born = len(parents)
+        self.world = np.concatenate((w[alive], w[parents]))
+        self.x = np.concatenate((x[alive], x[parents]))
+        self.y = np.concatenate((y[alive], y[closest[parents]]))
+        self.health = np.concatenate((self.health[alive], np.ones(born)))
+        self.energy = np.concatenate((energy[alive], np.ones(born)))
+        self.social = np.concatenate((self.social[alive], np.ones(born)))
+
+    def metrics(self, coverage_th=0.1):
+        """Returns the summary of Simulation.metrics for every world, as one
+           array per metric with an entry per world."""
+        population = np.bincount(self.world, minlength=self.members)
+        with np.errstate(invalid='ignore'):
+            energy = np.nan_to_num(np.bincount(self.world, self.energy, self.members) / population)
+            health = np.nan_to_num(np.bincount(self.world, self.health, self.members) / population)
+        return {'step': np.full(self.members, self.step), 'population': population, 'energy': energy, 'health': health,
+                'storms': np.bincount(self.storm_world, minlength=self.members),
+                'vegetation': np.count_nonzero(self.vegetation > coverage_th, axis=(1, 2)) / self.size**2}
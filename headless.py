@@ -0,0 +1,124 @@
+# Lightweight headless command line for Terra^2.
+#
+# Runs a Simulation without a window, and without ever importing matplotlib,
+# asyncio or the other modules only the interactive front end (main.py) needs.
+# Every Simulation parameter is a flag, and the recorder, profiler and
+# checkpointing are only loaded when asked for:
+#
+#     python -m headless --size 256 --seed 1 --ticks 1000 --storm-chance 0.05 --report-every 100
+
+import argparse
+import ast
+import inspect
+import time
+
+from simulation import Observer, Simulation
+
+def literal(value):
+    """Parses a flag value as a Python literal, or keeps it as a string."""
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+def number(value):
+    """Parses a numeric flag value as an int if it is written as one, and as
+       a float otherwise, so parameters that default to an int (such as
+       storm_size) still accept fractions."""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def parse_species(species):
+    """Parses one ';'-separated list of parameters per population, e.g.
+       "temprange=(0.2, 0.6); sex_th=0.4", into a list of dicts."""
+    if not species:
+        return None
+    return [{name.strip(): ast.literal_eval(value.strip())
+             for name, value in (p.split('=', 1) for p in params.split(';') if p.strip())}
+            for params in species]
+
+def add_parameters(parser, cls=Simulation, skip=('species',)):
+    """Adds a --flag for every keyword argument of the constructor of cls,
+       defaulting to the constructor's default."""
+    for name, param in inspect.signature(cls.__init__).parameters.items():
+        if name == 'self' or name in skip or param.default is inspect.Parameter.empty:
+            continue
+        default = param.default
+        if isinstance(default, bool) or not isinstance(default, (int, float)):
+            kind = literal
+        else:
+            kind = float if isinstance(default, float) else number
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, type=kind, default=default,
+                            help="the Simulation's %s (default: %%(default)s)" % name)
+
+class Reporter(Observer):
+    """Prints the metrics of a simulation every few ticks, and the speed of
+       the run when it ends.
+
+       Keyword arguments:
+       every -- the number of ticks between reports (0 for none).
+       step -- the step the run starts from.
+       """
+
+    def __init__(self, every, step=0):
+        self.every = every
+        self.first = step
+        self.start = time.perf_counter()
+
+    def update(self, sim):
+        if self.every and sim.step % self.every == 0:
+            print(" ".join("%s=%s" % (name, round(value, 4)) for name, value in sim.metrics().items()), flush=True)
+
+    def close(self, sim):
+        ticks, elapsed = sim.step - self.first, time.perf_counter() - self.start
+        print("%d ticks in %.2fs (%.1f ticks/s)" % (ticks, elapsed, ticks / elapsed if elapsed else 0.0))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m headless', description="Run a headless Terra^2 simulation.")
+    add_parameters(parser)
+    parser.add_argument('--species', nargs='+', default=None, metavar='PARAMS',
+                        help="one population per argument, given as ';'-separated parameters, "
+                             "e.g. \"temprange=(0.2, 0.6); sex_th=0.4\"")
+    parser.add_argument('--ticks', type=int, default=1000, help="the number of steps to run for")
+    parser.add_argument('--fast-forward', type=int, default=None, metavar='K',
+                        help="advance up to K ticks at a time while there are no Terrans")
+    parser.add_argument('--report-every', type=int, default=100, help="the number of ticks between printed metrics (0 for none)")
+    parser.add_argument('--stream', default=None, metavar='DIR', help="stream per-tick metrics to a directory (see recorder.load)")
+    parser.add_argument('--trajectories', type=int, default=None, metavar='N', help="also stream the trajectory of every Nth Terran")
+    parser.add_argument('--profile', action='store_true', help="print a per-phase breakdown of tick time")
+    parser.add_argument('--resume', default=None, metavar='DIR', help="resume from a checkpoint instead of generating a world")
+    parser.add_argument('--save', default=None, metavar='DIR', help="save a checkpoint when the run ends")
+    args = parser.parse_args(argv)
+
+    if args.resume:
+        import checkpoint
+        sim = checkpoint.load(args.resume)
+    else:
+        params = {name: getattr(args, name) for name in inspect.signature(Simulation.__init__).parameters if name != 'self'}
+        params['species'] = parse_species(args.species)
+        sim = Simulation(**params)
+
+    if args.profile:
+        import profiler
+        sim.profiler = profiler.Profiler()
+        sim.attach(profiler.ProfileReporter(args.report_every or 100))
+    recording = None
+    if args.stream:
+        import recorder
+        recording = sim.attach(recorder.Recorder(args.stream, trajectories=args.trajectories))
+    sim.attach(Reporter(args.report_every, sim.step))
+
+    try:
+        sim.run(args.ticks, fast=args.fast_forward)
+    finally:
+        if recording is not None:
+            recording.finish()
+    if args.save:
+        import checkpoint
+        checkpoint.save(sim, args.save)
+    return sim
+
+if __name__ == '__main__':
+    main()
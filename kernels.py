@@ -0,0 +1,267 @@
+# Compiled kernels for the hot loops of the Terra^2 simulation.
+#
+# Every kernel has two implementations that give identical results: a loop
+# compiled by Numba in nopython mode (@njit(cache=True, nogil=True), with
+# explicit array signatures, so it is compiled - or loaded from the on-disk
+# cache - once, the first time it is called) and a pure-NumPy fallback used
+# when Numba isn't installed. Set TERRA_KERNELS=numpy to force the fallback,
+# or switch at runtime with use().
+#
+# The public functions below normalize their arguments to the dtypes the
+# signatures expect, so callers can pass any integer or float arrays. Looking
+# up the 3x3 area of a cell is done by topology.py, not a kernel.
+
+import importlib.util
+import math
+import os
+import threading
+
+import numpy as np
+
+# imported the first time a kernel is compiled, so importing this module (or
+# running on the NumPy backend) never pays for loading Numba
+numba = None
+
+# NumPy implementations
+
+def _nearest_cells_numpy(dests, areas, away):
+    diff = dests[:, None, :] - areas
+    dist = np.sqrt(diff[..., 0]**2 + diff[..., 1]**2)
+    best = np.argmax(dist, axis=1) if away else np.argmin(dist, axis=1)
+    return areas[np.arange(len(areas)), best]
+
+def _torus_dist_numpy(p1, p2, size):
+    d = np.abs(p1 - p2)
+    d = np.minimum(d, size - d)
+    return np.hypot(d[:, 0], d[:, 1])
+
+def _consume_numpy(layer, x, y, amount):
+    np.subtract.at(layer, (x, y), amount)
+
+def _mate_numpy(candidates, closest, energy, threshold, out):
+    partners = closest[candidates]
+    pairs = np.arange(len(candidates))
+    # the first pair each Terran takes part in; a pair that is the first for
+    # both of its Terrans only depends on their energy before any mating
+    first = np.full(len(energy), len(candidates))
+    np.minimum.at(first, np.concatenate((candidates, partners)), np.concatenate((pairs, pairs)))
+    independent = (first[candidates] == pairs) & (first[partners] == pairs)
+
+    mated = independent & (energy[partners] > threshold) & (energy[candidates] > threshold)
+    energy[partners[mated]] -= threshold
+    energy[candidates[mated]] -= threshold
+    # the rest share a Terran with an earlier pair, so are resolved in order
+    for k in np.flatnonzero(~independent):
+        i, j = candidates[k], partners[k]
+        if energy[j] > threshold and energy[i] > threshold:
+            energy[j] -= threshold
+            energy[i] -= threshold
+            mated[k] = True
+    n = np.count_nonzero(mated)
+    out[:n] = candidates[mated]
+    return n
+
+def _stamp_numpy(cx, cy, strengths, stamp_x, stamp_y, stamp_w, size, base):
+    x = cx[:, None] + stamp_x
+    y = cy[:, None] + stamp_y
+    inside = (x >= 0) & (x < size) & (y >= 0) & (y < size)
+    return (base[:, None] + x * size + y)[inside], (strengths[:, None] * stamp_w)[inside]
+
+def _splat_numpy(flat, cells, weights):
+    np.add.at(flat, cells, weights)
+
+# loop implementations, compiled by Numba
+
+def _nearest_cells_loop(dests, areas, away):
+    cells = np.empty((areas.shape[0], 2), dtype=np.int64)
+    for i in range(areas.shape[0]):
+        best = 0
+        best_dist = 0.0
+        for z in range(9):
+            dx = dests[i, 0] - areas[i, z, 0]
+            dy = dests[i, 1] - areas[i, z, 1]
+            dist = np.sqrt(dx*dx + dy*dy)
+            if z == 0 or (dist > best_dist if away else dist < best_dist):
+                best = z
+                best_dist = dist
+        cells[i, 0] = areas[i, best, 0]
+        cells[i, 1] = areas[i, best, 1]
+    return cells
+
+def _torus_dist_loop(p1, p2, size):
+    dist = np.empty(p1.shape[0])
+    for i in range(p1.shape[0]):
+        dx = abs(p1[i, 0] - p2[i, 0])
+        dy = abs(p1[i, 1] - p2[i, 1])
+        dist[i] = math.hypot(min(dx, size - dx), min(dy, size - dy))
+    return dist
+
+def _consume_loop(layer, x, y, amount):
+    for i in range(x.shape[0]):
+        layer[x[i], y[i]] -= amount
+
+def _mate_loop(candidates, closest, energy, threshold, out):
+    n = 0
+    for k in range(candidates.shape[0]):
+        i = candidates[k]
+        j = closest[i]
+        if energy[j] > threshold and energy[i] > threshold:
+            energy[j] -= threshold
+            energy[i] -= threshold
+            out[n] = i
+            n += 1
+    return n
+
+def _stamp_loop(cx, cy, strengths, stamp_x, stamp_y, stamp_w, size, base):
+    n = 0
+    cells = np.empty(cx.shape[0] * stamp_x.shape[0], dtype=np.int64)
+    weights = np.empty(cx.shape[0] * stamp_x.shape[0])
+    for i in range(cx.shape[0]):
+        for s in range(stamp_x.shape[0]):
+            x = cx[i] + stamp_x[s]
+            y = cy[i] + stamp_y[s]
+            if x >= 0 and x < size and y >= 0 and y < size:
+                cells[n] = base[i] + x * size + y
+                weights[n] = strengths[i] * stamp_w[s]
+                n += 1
+    return cells[:n].copy(), weights[:n].copy()
+
+def _splat_loop(flat, cells, weights):
+    for i in range(cells.shape[0]):
+        flat[cells[i]] += weights[i]
+
+NUMPY = {'nearest_cells': _nearest_cells_numpy,
+         'torus_dist': _torus_dist_numpy, 'consume': _consume_numpy, 'mate': _mate_numpy, 'stamp': _stamp_numpy,
+         'splat': _splat_numpy}
+
+LOOPS = {'nearest_cells': _nearest_cells_loop,
+         'torus_dist': _torus_dist_loop, 'consume': _consume_loop, 'mate': _mate_loop, 'stamp': _stamp_loop,
+         'splat': _splat_loop}
+
+def _signatures():
+    """Returns the signatures each kernel is compiled for. Arrays a kernel
+       only reads are typed read-only, so memory-mapped static layers (and
+       any writable array) can be passed straight in."""
+    t = numba.types
+    def ro(dtype, ndim):
+        return t.Array(dtype, ndim, 'A', readonly=True)
+    def out(dtype, ndim):
+        return t.Array(dtype, ndim, 'C')
+    def rw(dtype, ndim, layout='A'):
+        return t.Array(dtype, ndim, layout)
+    i8, f8, f4 = t.int64, t.float64, t.float32
+    return {
+        'nearest_cells': [out(i8, 2)(ro(f8, 2), ro(i8, 3), t.boolean)],
+        'torus_dist': [out(f8, 1)(ro(f8, 2), ro(f8, 2), f8)],
+        'consume': [t.void(rw(dtype, 2), ro(i8, 1), ro(i8, 1), dtype) for dtype in (f8, f4)],
+        'mate': [i8(ro(i8, 1), ro(i8, 1), rw(f8, 1), f8, rw(i8, 1))],
+        'stamp': [t.Tuple((out(i8, 1), out(f8, 1)))(ro(i8, 1), ro(i8, 1), ro(f8, 1), ro(i8, 1), ro(i8, 1), ro(f8, 1), i8, ro(i8, 1))],
+        'splat': [t.void(rw(dtype, 1, 'C'), ro(i8, 1), ro(dtype, 1)) for dtype in (f8, f4)],
+    }
+
+def numba_available():
+    """Whether Numba is installed, without importing it."""
+    return importlib.util.find_spec('numba') is not None
+
+def _compile(name):
+    global numba
+    if numba is None:
+        import numba
+    return numba.njit(_signatures()[name], cache=True, nogil=True)(LOOPS[name])
+
+_compiling = threading.Lock()
+
+class _Compiled(dict):
+    """The loop kernels compiled so far, by name. Each is compiled (or
+       loaded from Numba's cache) the first time it is called, so a run
+       only pays for the kernels it uses. The kernels release the GIL, so
+       threads (see parallel.py) can run them at once."""
+
+    def __missing__(self, name):
+        with _compiling:
+            if not dict.__contains__(self, name):
+                self[name] = _compile(name)
+        return dict.__getitem__(self, name)
+
+COMPILED = _Compiled()
+
+def compile_all():
+    """Compiles (or loads from Numba's cache) every loop kernel now, rather
+       than on first use, returning them by name."""
+    for name in LOOPS:
+        COMPILED[name]
+    return COMPILED
+
+BACKEND = None
+_kernels = None
+
+def use(backend):
+    """Switches every kernel to the 'numba' or 'numpy' backend."""
+    global BACKEND, _kernels
+    if backend == 'numba':
+        if not numba_available():
+            raise ImportError("The numba backend requires numba to be installed")
+        _kernels = COMPILED
+    elif backend == 'numpy':
+        _kernels = NUMPY
+    else:
+        raise ValueError("Unknown kernel backend '%s'" % backend)
+    BACKEND = backend
+
+use('numba' if numba_available() and os.environ.get('TERRA_KERNELS', 'numba') == 'numba' else 'numpy')
+
+# the kernels
+
+def paths(dests, areas):
+    """Returns, for every row, the cell of the (N, 9, 2) areas closest to the
+       matching row of the (N, 2) destinations (the first on ties)."""
+    return _kernels['nearest_cells'](np.asarray(dests, dtype=np.float64).reshape(-1, 2),
+                                     np.asarray(areas, dtype=np.int64), False)
+
+def paths_away(ndests, areas):
+    """Returns, for every row, the cell of the (N, 9, 2) areas furthest from
+       the matching row of the (N, 2) destinations (the first on ties)."""
+    return _kernels['nearest_cells'](np.asarray(ndests, dtype=np.float64).reshape(-1, 2),
+                                     np.asarray(areas, dtype=np.int64), True)
+
+def torus_dist(p1, p2, size):
+    """Returns the distances between matching rows of two (N, 2) arrays of
+       coordinates on a map that wraps around at its edges."""
+    return _kernels['torus_dist'](np.asarray(p1, dtype=np.float64).reshape(-1, 2),
+                                  np.asarray(p2, dtype=np.float64).reshape(-1, 2), np.float64(size))
+
+def consume(layer, x, y, amount):
+    """Subtracts amount from layer at every cell (x, y), once per repeat."""
+    layer = np.asarray(layer)
+    _kernels['consume'](layer, np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64), layer.dtype.type(amount))
+
+def mate(candidates, closest, energy, threshold, out):
+    """Resolves mating pairs in order: for each candidate i in turn, if both
+       i and its closest neighbour closest[i] have more than threshold
+       energy, both spend threshold and i is written to out. Returns the
+       number of pairs that mated. energy is updated in place, and out must
+       have room for every candidate."""
+    return int(_kernels['mate'](np.asarray(candidates, dtype=np.int64), np.asarray(closest, dtype=np.int64),
+                                energy, np.float64(threshold), out))
+
+def stamp(cx, cy, strengths, stamp_x, stamp_y, stamp_w, size, base=None):
+    """Places a kernel (offsets stamp_x, stamp_y and weights stamp_w) at each
+       of the cells (cx, cy), scaled by strengths, and returns the flat map
+       indices and weights of every stamped cell that falls on the map. If
+       supplied, base[i] is added to the indices of the cells stamped around
+       (cx[i], cy[i]), e.g. to address one of a stack of maps."""
+    cx = np.asarray(cx, dtype=np.int64)
+    base = np.zeros(len(cx), dtype=np.int64) if base is None else np.asarray(base, dtype=np.int64)
+    return _kernels['stamp'](cx, np.asarray(cy, dtype=np.int64),
+                             np.asarray(strengths, dtype=np.float64), np.asarray(stamp_x, dtype=np.int64),
+                             np.asarray(stamp_y, dtype=np.int64), np.asarray(stamp_w, dtype=np.float64), np.int64(size), base)
+
+def splat(layer, cells, weights):
+    """Adds weights to the flat cells of layer, accumulating repeated cells,
+       and returns the sorted unique cells that were touched."""
+    flat = np.asarray(layer).reshape(-1)
+    cells = np.asarray(cells, dtype=np.int64)
+    _kernels['splat'](flat, cells, np.asarray(weights, dtype=flat.dtype))
+    # NumPy's sort is much faster than Numba's, so both backends dedupe here
+    cells = np.sort(cells)
+    return cells[np.concatenate(([True], cells[1:] != cells[:-1]))] if len(cells) else cells
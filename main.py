@@ -1,14 +1,19 @@
 # Main class of Terra^2
 # Ethan Block, 10-3-2018
 
-import display, terrans, world
-import msvcrt
+import argparse
 
-class TerraSquared:
+import util
+from headless import parse_species
+from simulation import Simulation, KeyboardListener
+
+class TerraSquared(Simulation):
 
     def __init__(self, size=32, points=None, delay=100, num_terrans=4, spawn_dist=2, temprange=(0.0, 1.0),
-                 storm_chance=0.01, storm_size=1, storm_int=0.2, storm_decay=0.05, storm_var=(0.8, 1.2), storm_speed=2.0):
-        """The main class for the Terra^2 simulation.
+                 storm_chance=0.01, storm_size=1, storm_int=0.2, storm_decay=0.05, storm_var=(0.8, 1.2), storm_speed=2.0,
+                 species=None, precision='float64', seed=None, threads=None, render_every=1, record=None):
+        """The main class for the Terra^2 simulation: a Simulation that is
+           drawn after every step and stops when escape is pressed.
 
            Keyword arguments:
            size -- the size of the generated terrain.
@@ -17,44 +22,85 @@ class TerraSquared:
            num_terrans -- the initial amount of Terrans to spawn.
            spawn_dist -- the maximum distance from the spawn point a Terran may be placed.
            temprange -- the survivable temperature range for Terrans.
+           species -- a list of per-population parameters (see Simulation).
+           precision -- the precision policy of the map layers (see util.PRECISIONS).
+           seed -- an integer seed or a numpy random Generator.
+           threads -- the number of bands to run each tick in (see Simulation).
+           render_every -- the number of steps between frames.
+           record -- if supplied, an .mp4 file or PNG pattern (see display.FrameWriter)
+                     to record the run to offscreen, instead of opening a window.
            """
 
-        if points is None:
-            points = size*12
-
-        self.delay = delay
-        self.num_terrans = num_terrans
-        self.spawn_dist = spawn_dist
-        self.temprange = temprange
-
-        self.spawned = False
-        self.terrain = world.Terrain(size, points=points)
-        self.weather = world.Weather(size, storm_chance, storm_size, storm_int, storm_decay, storm_var=storm_var, storm_speed=storm_speed)
-        self.ui = display.TerraSquaredUI(self.terrain, self.weather)
-
-    def run(self):
-        step = 0
-        while True:
-            self.terrain.update()
-            self.weather.update()
-
-            if not self.spawned:
-                if step >= self.delay:
-                    self.tpop = terrans.TerranPop(self.terrain, self.weather, self.num_terrans, temprange=self.temprange, spawn_dist=self.spawn_dist, sex_th=0.3)
-                    self.spawned = True
-                self.ui.update()
-            else:
-                self.ui.update(pops=[self.tpop])
-                self.tpop.update()
-
-            # increment step counter
-            step += 1
-
-            # check for terminating keystroke
-            if msvcrt.kbhit():
-                if ord(msvcrt.getch()) == 27:
-                    break
+        super().__init__(size=size, points=points, delay=delay, num_terrans=num_terrans, spawn_dist=spawn_dist,
+                         temprange=temprange, storm_chance=storm_chance, storm_size=storm_size, storm_int=storm_int,
+                         storm_decay=storm_decay, storm_var=storm_var, storm_speed=storm_speed, species=species, precision=precision, seed=seed,
+                         threads=threads)
+        # matplotlib is only loaded once there is something to draw
+        import display
+        if record is None:
+            self.ui = display.TerraSquaredUI(self.terrain, self.weather)
+            self.attach(display.RenderObserver(self.ui, every=render_every))
+        else:
+            self.ui = display.FrameWriter(self.terrain, self.weather, record)
+            self.attach(display.RenderObserver(self.ui, every=render_every, threaded=True))
+        self.attach(KeyboardListener())
+
+    @property
+    def tpop(self):
+        return self.pops[0]
 
 if __name__ == '__main__':
-    tsq = TerraSquared(size=64)
-    tsq.run()
+    parser = argparse.ArgumentParser(description="Run the Terra^2 simulation.")
+    parser.add_argument('--size', type=int, default=64, help="the size of the generated terrain")
+    parser.add_argument('--seed', type=int, default=None, help="the random seed")
+    parser.add_argument('--species', nargs='+', default=None, metavar='PARAMS',
+                        help="one population per argument, given as ';'-separated parameters, "
+                             "e.g. \"temprange=(0.2, 0.6); sex_th=0.4\"")
+    parser.add_argument('--precision', default='float64', choices=sorted(util.PRECISIONS),
+                        help="the precision policy of the map layers")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="run Terran movement, eating and regrowth in this many bands on a thread pool")
+    parser.add_argument('--render-every', type=int, default=1, help="the number of steps between frames")
+    parser.add_argument('--record', default=None, metavar='PATH',
+                        help="record offscreen to an .mp4 file or PNG pattern (e.g. frames/%%06d.png) instead of opening a window")
+    parser.add_argument('--ticks', type=int, default=None, help="the number of steps to run for (until escape is pressed if omitted)")
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help="run headless and serve the live state to clients on this port (see server.py)")
+    parser.add_argument('--serve-fps', type=float, default=30, help="the most frames per second taken for clients")
+    parser.add_argument('--stream', default=None, metavar='DIR',
+                        help="stream per-tick metrics to a directory (see recorder.load)")
+    parser.add_argument('--trajectories', type=int, default=None, metavar='N',
+                        help="also stream the trajectory of every Nth Terran")
+    parser.add_argument('--fast-forward', type=int, default=None, metavar='K',
+                        help="advance up to K ticks at a time while there are no Terrans (during the warm-up or after they die out)")
+    parser.add_argument('--profile', action='store_true', help="print a rolling per-phase breakdown of tick time")
+    parser.add_argument('--profile-every', type=int, default=100, help="the number of ticks between breakdowns")
+    parser.add_argument('--profile-allocs', action='store_true', help="also record the peak memory allocated by each phase")
+    parser.add_argument('--profile-out', default=None, help="a path prefix to export the profile to when the run ends")
+    args = parser.parse_args()
+
+    species = parse_species(args.species)
+
+    if args.serve is not None:
+        tsq = Simulation(size=args.size, species=species, precision=args.precision, seed=args.seed, threads=args.threads)
+    else:
+        tsq = TerraSquared(size=args.size, species=species, precision=args.precision, seed=args.seed, threads=args.threads,
+                           render_every=args.render_every, record=args.record)
+    if args.profile or args.profile_out:
+        import profiler
+        tsq.profiler = profiler.Profiler(allocations=args.profile_allocs)
+        tsq.attach(profiler.ProfileReporter(args.profile_every, export=args.profile_out))
+    recording = None
+    if args.stream:
+        import recorder
+        recording = tsq.attach(recorder.Recorder(args.stream, trajectories=args.trajectories))
+    try:
+        if args.serve is not None:
+            import asyncio, server
+            started = lambda s: print("serving on port %d" % s.port)
+            asyncio.run(server.serve(tsq, args.ticks, port=args.serve, max_fps=args.serve_fps, started=started, fast=args.fast_forward))
+        else:
+            tsq.run(args.ticks, fast=args.fast_forward)
+    finally:
+        if recording is not None:
+            recording.finish()
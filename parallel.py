@@ -0,0 +1,50 @@
+# Band decomposition of the Terra^2 map for multi-core ticks.
+#
+# With Simulation(threads=N) the map is split into N horizontal bands of rows,
+# and the per-Terran and per-cell work of a tick runs band by band on a
+# shared thread pool: Terran movement, eating (the writes to
+# terrain.sustenance) and sustenance regrowth. A band reads the cells of its
+# rows plus a one-row halo on either side (the 3x3 areas around its cells,
+# through topology.py), but only ever writes to its own rows or its
+# own Terrans, so bands never race. The heavy lifting is done by NumPy
+# operations and Numba kernels compiled with nogil, which release the GIL.
+#
+# Each band returns its results rather than applying them, and the merge
+# applies them in band order, so a threaded tick gives exactly the same world
+# as a serial one however the threads are scheduled: Terrans that moved across
+# a band boundary simply belong to the other band from the next tick on, and
+# Terrans that head for the same cell do so just as they would serially.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+_pools = {}
+
+def pool(threads):
+    """Returns a thread pool of the supplied size, shared by every caller."""
+    if threads not in _pools:
+        _pools[threads] = ThreadPoolExecutor(threads, thread_name_prefix='terra-band')
+    return _pools[threads]
+
+def bands(size, count):
+    """Returns the (start, stop) rows of count horizontal bands of a map of
+       the supplied size, as even as possible."""
+    edges = np.linspace(0, size, count + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+def partition(rows, size, count):
+    """Splits the indices of the supplied rows (e.g. the x coordinates of
+       every Terran) by the band they fall in, returning one ascending index
+       array per band."""
+    band = np.asarray(rows, dtype=np.intp) * count // size
+    order = np.argsort(band, kind='stable')
+    splits = np.searchsorted(band[order], np.arange(1, count))
+    return np.split(order, splits)
+
+def run(func, parts, threads):
+    """Calls func on every part on a pool of threads (in the calling thread
+       if threads is None or 1) and returns the results in order."""
+    if not threads or threads == 1 or len(parts) == 1:
+        return [func(part) for part in parts]
+    return list(pool(threads).map(func, parts))
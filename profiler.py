@@ -0,0 +1,175 @@
+# Per-phase tick instrumentation for the Terra^2 simulation.
+#
+# A Profiler attached to a Simulation (sim.profiler = Profiler()) records,
+# for every tick, the wall time and call count of each phase (terrain,
+# weather, move, manage and each observer), the number of Terrans and
+# storms and, optionally, the peak memory allocated by each phase. With no
+# profiler attached, a phase costs one attribute check and an empty with block.
+
+import collections
+import csv
+import json
+import sys
+import time
+import tracemalloc
+
+from simulation import Observer
+
+class _Phase:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.allocations:
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        allocated = tracemalloc.get_traced_memory()[1] - self.base if self.profiler.allocations else 0
+        record = self.profiler.current['phases'].setdefault(self.name, [0.0, 0, 0])
+        record[0] += elapsed
+        record[1] += 1
+        record[2] = max(record[2], allocated)
+        return False
+
+class Profiler:
+
+    def __init__(self, allocations=False, history=100000):
+        """Records per-phase timings of every tick of a simulation.
+
+           Keyword arguments:
+           allocations -- whether to also record the peak memory allocated by
+                          each phase (with tracemalloc, which slows ticks down).
+           history -- the number of most recent ticks to keep.
+           """
+        self.allocations = allocations
+        self.ticks = collections.deque(maxlen=history)
+        self.current = None
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def phase(self, name):
+        """Returns a context manager that times the named phase."""
+        return _Phase(self, name)
+
+    def start_tick(self, sim):
+        self.current = {'tick': sim.step, 'start': time.perf_counter(), 'phases': {}}
+
+    def _closed(self, sim):
+        """Returns the record of the current tick, timed up to now."""
+        tick = {name: value for name, value in self.current.items() if name != 'start'}
+        tick['phases'] = {name: list(record) for name, record in self.current['phases'].items()}
+        tick['seconds'] = time.perf_counter() - self.current['start']
+        tick['agents'] = sum(len(pop) for pop in sim.pops)
+        tick['storms'] = len(sim.weather.storm_str)
+        return tick
+
+    def end_tick(self, sim):
+        self.ticks.append(self._closed(sim))
+        self.current = None
+
+    def window(self, window=None, sim=None):
+        """Returns the last window recorded ticks (all of them if None). If
+           sim is supplied while one of its ticks is in progress (e.g. from an
+           observer), that tick, timed up to now, is the last of them."""
+        ticks = list(self.ticks)
+        if sim is not None and self.current is not None:
+            ticks.append(self._closed(sim))
+        return ticks[-window:] if window else ticks
+
+    def breakdown(self, window=None, sim=None):
+        """Returns the mean seconds per tick, calls per tick and peak bytes of
+           every phase over the last window ticks (all recorded ticks if None),
+           including the tick in progress if sim is supplied."""
+        return self._breakdown(self.window(window, sim))
+
+    def _breakdown(self, ticks):
+        totals = collections.OrderedDict()
+        for tick in ticks:
+            for name, (seconds, calls, allocated) in tick['phases'].items():
+                total = totals.setdefault(name, [0.0, 0, 0])
+                total[0] += seconds
+                total[1] += calls
+                total[2] = max(total[2], allocated)
+        n = max(len(ticks), 1)
+        return collections.OrderedDict((name, (seconds / n, calls / n, allocated))
+                                       for name, (seconds, calls, allocated) in totals.items())
+
+    def report(self, window=None, sim=None):
+        """Returns a printable table of the breakdown over the last window
+           ticks, including the tick in progress if sim is supplied."""
+        ticks = self.window(window, sim)
+        if not ticks:
+            return "no ticks recorded"
+        tick_time = sum(tick['seconds'] for tick in ticks) / len(ticks)
+        lines = ["ticks %d-%d: %.3f ms/tick, %.0f agents, %.1f storms" %
+                 (ticks[0]['tick'], ticks[-1]['tick'], tick_time * 1e3,
+                  sum(tick['agents'] for tick in ticks) / len(ticks), sum(tick['storms'] for tick in ticks) / len(ticks))]
+        for name, (seconds, calls, allocated) in self._breakdown(ticks).items():
+            line = "  %-16s %9.3f ms %6.1f%% %6.1f calls" % (name, seconds * 1e3, 100 * seconds / tick_time if tick_time else 0, calls)
+            if self.allocations:
+                line += " %9.2f MB peak" % (allocated / 2**20)
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_csv(self, path):
+        """Writes one row per tick and phase to a CSV file."""
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('tick', 'phase', 'seconds', 'calls', 'peak_bytes', 'agents', 'storms'))
+            for tick in self.ticks:
+                for name, (seconds, calls, allocated) in tick['phases'].items():
+                    writer.writerow((tick['tick'], name, seconds, calls, allocated, tick['agents'], tick['storms']))
+
+    def to_json(self, path):
+        """Writes every recorded tick to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(list(self.ticks), f)
+
+    def to_collapsed(self, path):
+        """Writes the total time of each phase in the collapsed-stack format
+           read by flame graph tools (e.g. flamegraph.pl, speedscope), in
+           microseconds."""
+        totals = collections.OrderedDict()
+        for tick in self.ticks:
+            phases = 0.0
+            for name, (seconds, calls, allocated) in tick['phases'].items():
+                totals[name] = totals.get(name, 0.0) + seconds
+                phases += seconds
+            totals[None] = totals.get(None, 0.0) + tick['seconds'] - phases
+        with open(path, 'w') as f:
+            for name, seconds in totals.items():
+                stack = 'tick' if name is None else 'tick;' + name
+                f.write("%s %d\n" % (stack, round(seconds * 1e6)))
+
+class ProfileReporter(Observer):
+    """Prints the rolling per-phase breakdown of a profiled simulation every
+       few ticks.
+
+       Keyword arguments:
+       every -- the number of ticks between reports (and the rolling window).
+       out -- the stream to print to.
+       export -- if supplied, a path prefix the recorded ticks are written to
+                 when the run ends (as .csv, .json and .collapsed files).
+       """
+
+    def __init__(self, every=100, out=None, export=None):
+        self.every = every
+        self.out = out or sys.stderr
+        self.export = export
+
+    def update(self, sim):
+        if sim.profiler is not None and sim.step % self.every == 0:
+            # observers run before the tick is closed, so include it as it stands
+            print(sim.profiler.report(self.every, sim), file=self.out)
+
+    def close(self, sim):
+        if sim.profiler is not None and self.export:
+            sim.profiler.to_csv(self.export + '.csv')
+            sim.profiler.to_json(self.export + '.json')
+            sim.profiler.to_collapsed(self.export + '.collapsed')
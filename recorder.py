@@ -0,0 +1,212 @@
+# Streaming of per-tick metrics and Terran trajectories to disk.
+#
+# A Recorder attached to a Simulation writes each table of a run as a
+# directory of append-only columns, one raw binary file per column, plus a
+# meta.json recording the dtype of each column and how many rows
+# have been written in full:
+#
+#     run/ticks/meta.json, run/ticks/population.bin, ...
+#     run/trajectories/meta.json, run/trajectories/x.bin, ...
+#
+# Rows are buffered on the simulation thread and appended by a background
+# thread, which only updates meta.json after the rows are written, so load()
+# can memory-map a run while it is still being recorded.
+
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from simulation import Observer
+
+VERSION = 1
+
+# the per-tick aggregates, summed or averaged over every population
+TICK_COLUMNS = (('step', np.int64), ('population', np.int64), ('births', np.int64), ('deaths', np.int64),
+                ('energy', np.float64), ('health', np.float64), ('social', np.float64), ('storms', np.int64),
+                ('vegetation_total', np.float64), ('sustenance_total', np.float64))
+
+# the sampled per-Terran rows
+TRAJECTORY_COLUMNS = (('step', np.int64), ('pop', np.int64), ('id', np.int64), ('x', np.int64), ('y', np.int64),
+                      ('energy', np.float64), ('health', np.float64), ('social', np.float64))
+
+class ColumnStore:
+
+    def __init__(self, path, columns):
+        """An append-only table stored as one binary file per column.
+
+           Keyword arguments:
+           path -- the directory to write the table to (replacing any table there).
+           columns -- the (name, dtype) of every column.
+           """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.columns = [(name, np.dtype(dtype)) for name, dtype in columns]
+        self.rows = 0
+        self.files = {name: open(os.path.join(path, name + '.bin'), 'wb') for name, dtype in self.columns}
+        self.commit()
+
+    def append(self, chunk):
+        """Appends a dict of equal-length column arrays to the table."""
+        n = len(chunk[self.columns[0][0]])
+        for name, dtype in self.columns:
+            self.files[name].write(np.ascontiguousarray(chunk[name], dtype=dtype).tobytes())
+            self.files[name].flush()
+        self.rows += n
+        self.commit()
+
+    def commit(self):
+        """Records the number of rows written in full, atomically, so readers
+           never see rows that are only partly written."""
+        meta = {'version': VERSION, 'rows': self.rows, 'columns': [[name, dtype.str] for name, dtype in self.columns]}
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+def load_table(path):
+    """Returns the columns of a table written by a ColumnStore, memory-mapped
+       up to the last committed row."""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != VERSION:
+        raise ValueError("Unsupported recording version %s" % meta['version'])
+    columns = {}
+    for name, dtype in meta['columns']:
+        if meta['rows'] == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r', shape=(meta['rows'],))
+    return columns
+
+def load(path):
+    """Returns every table of a recorded run (e.g. load(path)['ticks']['population']),
+       which may still be in progress."""
+    return {name: load_table(os.path.join(path, name)) for name in sorted(os.listdir(path))
+            if os.path.exists(os.path.join(path, name, 'meta.json'))}
+
+class _Buffer:
+    """Rows of one table waiting to be handed to the writer thread."""
+
+    def __init__(self, columns):
+        self.columns = [name for name, dtype in columns]
+        self.chunks = []
+        self.rows = 0
+
+    def add(self, chunk):
+        self.chunks.append(chunk)
+        self.rows += np.size(chunk[self.columns[0]])
+
+    def take(self):
+        chunk = {name: np.concatenate([np.atleast_1d(c[name]) for c in self.chunks]) for name in self.columns}
+        self.chunks = []
+        self.rows = 0
+        return chunk
+
+class Recorder(Observer):
+    """Streams per-tick aggregates, and optionally sampled Terran
+       trajectories, of a simulation to disk (see load).
+
+       Keyword arguments:
+       path -- the directory to record the run to.
+       trajectories -- if supplied, every Terran whose id is a multiple of
+                       this is recorded (1 records them all).
+       trajectory_every -- the number of ticks between trajectory samples.
+       buffer -- the number of rows of a table to collect before writing them.
+       interval -- the most seconds rows are held back before being written,
+                   so readers see a slow run progress.
+       queue_size -- the number of buffers that may wait to be written; the
+                     simulation only waits for the disk when this is full.
+       """
+
+    def __init__(self, path, trajectories=None, trajectory_every=1, buffer=1024, interval=1.0, queue_size=16):
+        self.path = path
+        self.trajectories = trajectories
+        self.trajectory_every = trajectory_every
+        self.buffer = buffer
+        self.interval = interval
+        self.error = None
+
+        tables = {'ticks': TICK_COLUMNS}
+        if trajectories:
+            tables['trajectories'] = TRAJECTORY_COLUMNS
+        self.stores = {name: ColumnStore(os.path.join(path, name), columns) for name, columns in tables.items()}
+        self.buffers = {name: _Buffer(columns) for name, columns in tables.items()}
+        self.shipped = time.perf_counter()
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            name, chunk = item
+            try:
+                self.stores[name].append(chunk)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def ship(self):
+        """Hands every buffered row to the writer thread."""
+        for name, buffer in self.buffers.items():
+            if buffer.rows:
+                self.queue.put((name, buffer.take()))
+        self.shipped = time.perf_counter()
+
+    def update(self, sim):
+        if self.error is not None:
+            raise self.error
+
+        pops = sim.pops
+        population = sum(len(pop) for pop in pops)
+        mean = lambda name: sum(getattr(pop, name).sum() for pop in pops) / population if population else 0.0
+        self.buffers['ticks'].add({'step': sim.step, 'population': population,
+                                   'births': sum(pop.births for pop in pops), 'deaths': sum(pop.deaths for pop in pops),
+                                   'energy': mean('energy'), 'health': mean('health'), 'social': mean('social'),
+                                   'storms': len(sim.weather.storm_str),
+                                   'vegetation_total': np.sum(sim.terrain.vegetation, dtype=np.float64),
+                                   'sustenance_total': np.sum(sim.terrain.sustenance, dtype=np.float64)})
+
+        if self.trajectories and sim.step % self.trajectory_every == 0:
+            for i, pop in enumerate(pops):
+                sampled = np.flatnonzero(pop.id % self.trajectories == 0)
+                self.buffers['trajectories'].add({'step': np.full(len(sampled), sim.step), 'pop': np.full(len(sampled), i),
+                                                  'id': pop.id[sampled], 'x': pop.x[sampled], 'y': pop.y[sampled],
+                                                  'energy': pop.energy[sampled], 'health': pop.health[sampled],
+                                                  'social': pop.social[sampled]})
+
+        if (any(buffer.rows >= self.buffer for buffer in self.buffers.values())
+                or time.perf_counter() - self.shipped > self.interval):
+            self.ship()
+
+    def close(self, sim):
+        # wait for every row to be written, but keep the writer running, as
+        # the simulation may be run again
+        if self.thread is None:
+            return
+        self.ship()
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def finish(self):
+        """Stops the writer thread and closes the files of the recording."""
+        if self.thread is not None:
+            self.ship()
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            for store in self.stores.values():
+                store.close()
@@ -0,0 +1,310 @@
+# Live streaming of a running Terra^2 simulation to any number of clients.
+#
+# The simulation runs on a worker thread at its own pace while an asyncio
+# server sends its state to every connected client over TCP. A client
+# receives the static layers (heightmap, climates) and a full keyframe
+# when it connects, and afterwards only the cells of the vegetation,
+# sustenance and weathermap layers that changed since the last frame it
+# was sent, plus the Terran positions. Each client has its own frame-rate
+# cap and backpressure: while a client is slow to read, newer frames
+# replace the one waiting for it, so a slow client never holds up the
+# simulation or the other clients. A client that takes longer than the
+# timeout to read a frame is dropped.
+#
+# Every message is a pair of lengths (struct '!II'), a JSON header and the
+# raw bytes of the arrays the header lists.
+#
+#     python main.py --serve 8765 --size 128
+#     python server.py --port 8765 --fps 5
+
+import argparse
+import asyncio
+import json
+import struct
+
+import numpy as np
+
+from simulation import Observer
+
+# the layers sent as deltas
+LAYERS = ('vegetation', 'sustenance', 'weathermap')
+
+_LENGTHS = struct.Struct('!II')
+
+def snapshot(sim):
+    """Returns a copy of the state of a simulation sent to clients."""
+    return {'step': sim.step,
+            'layers': {'vegetation': np.array(sim.terrain.vegetation),
+                       'sustenance': np.array(sim.terrain.sustenance),
+                       'weathermap': np.ma.filled(sim.weather.weathermap, 0.0).copy()},
+            'pops': [(pop.x.astype(np.int32), pop.y.astype(np.int32)) for pop in sim.pops]}
+
+def encode(header, arrays):
+    """Returns a message holding a JSON header and the named arrays."""
+    payload, specs, offset = [], [], 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        specs.append([name, array.dtype.str, list(array.shape), offset])
+        payload.append(array.tobytes())
+        offset += array.nbytes
+    header = json.dumps(dict(header, arrays=specs)).encode()
+    return _LENGTHS.pack(len(header), offset) + header + b''.join(payload)
+
+async def read_message(reader):
+    """Reads one message from a stream, returning its header and arrays."""
+    header_len, payload_len = _LENGTHS.unpack(await reader.readexactly(_LENGTHS.size))
+    header = json.loads(await reader.readexactly(header_len))
+    payload = await reader.readexactly(payload_len)
+    arrays = {}
+    for name, dtype, shape, offset in header.pop('arrays', []):
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(payload, dtype=dtype, count=count, offset=offset).reshape(shape)
+    return header, arrays
+
+def delta(frame, base):
+    """Returns the arrays of a frame message: the flat indices and new values
+       of every cell of each layer that differs from base (every cell, as
+       a full layer, if base is None), and the positions of every Terran."""
+    arrays = {}
+    for name in LAYERS:
+        layer = frame['layers'][name]
+        if base is None:
+            arrays[name] = layer
+        else:
+            cells = np.flatnonzero(layer != base['layers'][name])
+            arrays[name + '.cells'] = cells.astype(np.int32)
+            arrays[name + '.values'] = layer.flat[cells]
+    for i, (x, y) in enumerate(frame['pops']):
+        arrays['pop%d.x' % i] = x
+        arrays['pop%d.y' % i] = y
+    return arrays
+
+class _Client:
+
+    def __init__(self, writer, fps):
+        self.writer = writer
+        self.interval = 1.0 / fps if fps else 0.0
+        self.latest = None
+        self.ending = False
+        self.ready = asyncio.Event()
+        self.base = None
+        self.last = 0.0
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, frame):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = frame
+        self.ready.set()
+
+    def end(self):
+        """Ends the stream once the waiting frame, if any, is sent."""
+        self.ending = True
+        self.ready.set()
+
+class StateServer(Observer):
+    """Serves the live state of a simulation to clients (see the module
+       comment). Start it with start() from the event loop, and attach it to
+       a simulation running on another thread, as serve does.
+
+       Keyword arguments:
+       host, port -- the address to listen on (any free port if 0).
+       max_fps -- the most frames per second taken from the simulation;
+                  state is only copied when at least one client is connected.
+       timeout -- the most seconds a client may take to read one message
+                  before it is dropped.
+       """
+
+    def __init__(self, host='127.0.0.1', port=0, max_fps=30, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.interval = 1.0 / max_fps
+        self.timeout = timeout
+        self.clients = set()
+        self.handlers = set()
+        self.static = None
+        self.loop = None
+        self.server = None
+        self.taken = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Ends every client's stream once it has been sent its last frame,
+           and stops listening. Connections still open after the timeout
+           (such as clients that never sent their hello) are closed."""
+        for client in list(self.clients):
+            client.end()
+        handlers = list(self.handlers)
+        if handlers:
+            # a stream ends after at most two more messages, each sent within the timeout
+            await asyncio.wait(handlers, timeout=2 * self.timeout)
+            for handler in handlers:
+                handler.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _publish(self, frame):
+        for client in self.clients:
+            client.offer(frame)
+
+    def update(self, sim):
+        # runs on the simulation's thread
+        if self.static is None:
+            self.static = {'size': sim.terrain.size, 'heightmap': np.asarray(sim.terrain.heightmap, dtype=np.float32),
+                           'climates': np.asarray(sim.terrain.climates, dtype=np.float32)}
+        if not self.clients:
+            return
+        now = self.loop.time()
+        if self.taken is not None and now - self.taken < self.interval:
+            return
+        self.taken = now
+        self.loop.call_soon_threadsafe(self._publish, snapshot(sim))
+
+    async def _send(self, writer, message):
+        writer.write(message)
+        # a slow client holds up only itself here, and only until the timeout
+        await asyncio.wait_for(writer.drain(), self.timeout)
+
+    async def _serve(self, reader, writer):
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        try:
+            hello, arrays = await read_message(reader)
+            while self.static is None:
+                await asyncio.sleep(0.01)
+            client = _Client(writer, hello.get('fps'))
+            await self._send(writer, encode({'type': 'hello', 'size': self.static['size']},
+                                             {'heightmap': self.static['heightmap'], 'climates': self.static['climates']}))
+            self.clients.add(client)
+
+            while True:
+                await client.ready.wait()
+                wait = client.last + client.interval - self.loop.time()
+                if wait > 0:
+                    # newer frames may arrive while waiting, and replace this one
+                    await asyncio.sleep(wait)
+                client.ready.clear()
+                frame, client.latest = client.latest, None
+                if frame is None:
+                    await self._send(writer, encode({'type': 'end', 'sent': client.sent, 'dropped': client.dropped}, {}))
+                    break
+
+                header = {'type': 'frame', 'step': frame['step'], 'pops': len(frame['pops']),
+                          'keyframe': client.base is None}
+                await self._send(writer, encode(header, delta(frame, client.base)))
+                client.base = frame
+                client.last = self.loop.time()
+                client.sent += 1
+                if client.ending:
+                    client.ready.set()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # the client stopped reading, so drop what is still buffered for it
+            writer.transport.abort()
+        finally:
+            self.clients = {c for c in self.clients if c.writer is not writer}
+            self.handlers.discard(handler)
+            writer.close()
+
+async def serve(sim, ticks=None, host='127.0.0.1', port=0, max_fps=30, started=None, fast=None, timeout=5.0):
+    """Runs a simulation on a worker thread while serving its state, and
+       returns the simulation once the run ends and every client has been
+       sent its last frame.
+
+       Keyword arguments:
+       sim -- the simulation to run.
+       ticks -- the number of ticks to run for (until stopped if None).
+       host, port, max_fps, timeout -- see StateServer.
+       started -- called with the StateServer once it is listening.
+       fast -- if supplied, idle stretches are fast-forwarded (see Simulation.run).
+       """
+    server = StateServer(host, port, max_fps, timeout)
+    await server.start()
+    sim.attach(server)
+    if started is not None:
+        started(server)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, sim.run, ticks, fast)
+    finally:
+        sim.stop()
+        # every client gets the final state, whatever the frame rate
+        if server.clients:
+            server._publish(snapshot(sim))
+        await server.stop()
+        sim.detach(server)
+    return sim
+
+class Client:
+
+    def __init__(self):
+        """A client of a StateServer, which rebuilds the state of the
+           simulation from the frames it is sent.
+
+           After each frame, step is the step the frame was taken at, layers
+           holds the vegetation, sustenance and weathermap layers, pops a
+           list of (x, y) Terran positions per population, and static the
+           heightmap and climates.
+           """
+        self.step = None
+        self.size = None
+        self.static = {}
+        self.layers = {}
+        self.pops = []
+        self.frames = 0
+        self.summary = None
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host='127.0.0.1', port=8765, fps=None):
+        """Connects to a server, asking for at most fps frames per second."""
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(encode({'type': 'hello', 'fps': fps}, {}))
+        await self.writer.drain()
+        header, arrays = await read_message(self.reader)
+        self.size = header['size']
+        self.static = {name: np.array(array) for name, array in arrays.items()}
+
+    async def receive(self):
+        """Receives and applies the next frame. Returns False once the
+           server has ended the stream."""
+        header, arrays = await read_message(self.reader)
+        if header['type'] == 'end':
+            self.summary = header
+            self.writer.close()
+            return False
+        for name in LAYERS:
+            if header['keyframe']:
+                self.layers[name] = np.array(arrays[name])
+            else:
+                self.layers[name].flat[arrays[name + '.cells']] = arrays[name + '.values']
+        self.pops = [(arrays['pop%d.x' % i], arrays['pop%d.y' % i]) for i in range(header['pops'])]
+        self.step = header['step']
+        self.frames += 1
+        return True
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+async def watch(host, port, fps):
+    client = Client()
+    await client.connect(host, port, fps)
+    while await client.receive():
+        print("step %d: %s terrans, %.1f vegetation, %.1f storm" %
+              (client.step, [len(x) for x, y in client.pops], client.layers['vegetation'].sum(), client.layers['weathermap'].sum()))
+    print("stream ended: %(sent)d frames sent, %(dropped)d dropped" % client.summary)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Watch a Terra^2 simulation served by `main.py --serve`.")
+    parser.add_argument('--host', default='127.0.0.1', help="the address of the server")
+    parser.add_argument('--port', type=int, default=8765, help="the port of the server")
+    parser.add_argument('--fps', type=float, default=None, help="the most frames per second to receive")
+    args = parser.parse_args()
+    asyncio.run(watch(args.host, args.port, args.fps))
@@ -0,0 +1,286 @@
+# Headless, seedable core of the Terra^2 simulation.
+
+import contextlib
+import sys
+import time
+
+import numpy as np
+
+import terrans, tiles, world, worldcache
+
+# the phase used when no profiler is attached
+_NO_PHASE = contextlib.nullcontext()
+
+class Observer:
+    """Base class for objects attached to a Simulation. Observers are
+       notified after every tick and once more when a run ends, and may
+       stop the run by calling sim.stop()."""
+
+    def update(self, sim):
+        pass
+
+    def close(self, sim):
+        pass
+
+class Simulation:
+
+    def __init__(self, size=32, points=None, delay=100, num_terrans=4, spawn_dist=2, temprange=(0.0, 1.0),
+                 storm_chance=0.01, storm_size=1, storm_int=0.2, storm_decay=0.05, storm_var=(0.8, 1.2), storm_speed=2.0,
+                 sex_th=0.3, decay=0.1, species=None, precision='float64', seed=None, cache=None, threads=None,
+                 tile=None, store=None, resident=None):
+        """A headless Terra^2 simulation. Every random draw comes from a
+           single numpy Generator, so two simulations built with the same
+           seed produce identical worlds and identical runs.
+
+           Keyword arguments:
+           size -- the size of the generated terrain.
+           points -- the number of high-altitude points in the terrain.
+           delay -- the amount of steps to pass before spawning in Terrans.
+           num_terrans -- the initial amount of Terrans to spawn.
+           spawn_dist -- the maximum distance from the spawn point a Terran may be placed.
+           temprange -- the survivable temperature range for Terrans.
+           storm_chance, storm_size, storm_int, storm_decay, storm_var, storm_speed -- the Weather parameters.
+           sex_th -- the energy threshold required for two Terrans to reproduce.
+           decay -- the decay rate of a Terran's energy.
+           species -- a list with one dict of TerranPop parameters (num_terrans, spawn_dist,
+                      temprange, decay, decay_h, decay_soc, sex_th) per population to
+                      spawn. Parameters left out are taken from the ones above. By default
+                      a single population is spawned.
+           precision -- the precision policy of the map layers: 'float64', 'float32'
+                        or 'quantized' (see util.PRECISIONS).
+           seed -- an integer seed, a numpy SeedSequence or a numpy random Generator.
+           cache -- an optional WorldCache directory. Worlds generated from an integer
+                    seed or SeedSequence are loaded from it rather than regenerated.
+           threads -- if supplied, Terran movement, eating and sustenance regrowth are
+                      split into this many bands of the map that run on a thread pool
+                      (see parallel.py). Runs are identical with any number of threads.
+           tile -- if supplied, every map layer is stored as tile x tile chunks that are
+                   only allocated when first written (see tiles.py), for maps too large
+                   to hold as dense arrays. Runs are identical to dense ones.
+           store -- with tile, a directory cold chunks are paged out to.
+           resident -- with store, the most chunks of each layer kept in memory.
+           """
+
+        if points is None:
+            points = size*12
+
+        self.delay = delay
+        self.num_terrans = num_terrans
+        self.spawn_dist = spawn_dist
+        self.temprange = temprange
+        self.sex_th = sex_th
+        self.decay = decay
+        self.cache = cache
+        self.threads = threads
+        self.precision = precision
+        defaults = {'num_terrans': num_terrans, 'spawn_dist': spawn_dist, 'temprange': temprange,
+                    'sex_th': sex_th, 'decay': decay}
+        self.species = [dict(defaults, **params) for params in (species or [{}])]
+
+        self.rng = np.random.default_rng(seed)
+        tiling = {'tile': tile, 'store': store, 'resident': resident}
+        self.terrain = world.Terrain(size, points=points, precision=precision, rng=self.rng, cache=self.world_cache(), seed=seed,
+                                     **tiling)
+        self.weather = world.Weather(size, storm_chance, storm_size, storm_int, storm_decay, storm_var=storm_var,
+                                     storm_speed=storm_speed, precision=precision, rng=self.rng, **tiling)
+        self.census = terrans.Census(size, **tiling)
+        self.pops = []
+        self.spawned = False
+        self.step = 0
+        self.observers = []
+        self.stopped = False
+        self.profiler = None
+
+    def attach(self, observer):
+        """Attaches an observer, which is notified after every tick."""
+        self.observers.append(observer)
+        return observer
+
+    def detach(self, observer):
+        self.observers.remove(observer)
+
+    def stop(self):
+        """Ends the current run after the tick in progress."""
+        self.stopped = True
+
+    def spawn(self):
+        """Spawns the initial population of every species."""
+        for params in self.species:
+            self.pops.append(terrans.TerranPop(self.terrain, self.weather, rng=self.rng, cache=self.world_cache(),
+                                               census=self.census, **params))
+        self.spawned = True
+
+    def world_cache(self):
+        return None if self.cache is None else worldcache.WorldCache(self.cache)
+
+    def phase(self, name):
+        """Returns a context manager timing the named phase of a tick if a
+           profiler is attached (see profiler.Profiler)."""
+        if self.profiler is None:
+            return _NO_PHASE
+        return self.profiler.phase(name)
+
+    def tick(self):
+        """Advances the world by a single step."""
+        if self.profiler is not None:
+            self.profiler.start_tick(self)
+
+        with self.phase('terrain'):
+            self.terrain.update(self.threads)
+        with self.phase('weather'):
+            self.weather.update()
+
+        if not self.spawned:
+            if self.step >= self.delay:
+                with self.phase('spawn'):
+                    self.spawn()
+        else:
+            # every population moves against the positions at the start of the tick
+            with self.phase('census'):
+                self.census.record(self.pops)
+            for pop in self.pops:
+                with self.phase('move'):
+                    pop.move_terrans(self.threads)
+                with self.phase('manage'):
+                    pop.manage_terrans(self.threads)
+
+        # increment step counter
+        self.step += 1
+
+        for observer in self.observers:
+            with self.phase(type(observer).__name__):
+                observer.update(self)
+
+        if self.profiler is not None:
+            self.profiler.end_tick(self)
+
+    def idle(self):
+        """Whether there are no Terrans (yet, or any more), so that only the
+           terrain and weather change from tick to tick."""
+        return not self.spawned or all(len(pop) == 0 for pop in self.pops)
+
+    def fast_forward(self, ticks):
+        """Advances an idle world by up to ticks steps at once (see
+           Terrain.fast_forward and Weather.fast_forward), stopping at the
+           step the Terrans spawn. Observers are notified once, after the
+           last step. Returns the number of steps advanced, which is 0 if
+           the world isn't idle."""
+        if not self.idle():
+            return 0
+        if not self.spawned:
+            ticks = min(ticks, self.delay - self.step)
+        if ticks <= 0:
+            return 0
+
+        if self.profiler is not None:
+            self.profiler.start_tick(self)
+        with self.phase('terrain'):
+            self.terrain.fast_forward(ticks)
+        with self.phase('weather'):
+            self.weather.fast_forward(ticks)
+        self.step += ticks
+        for observer in self.observers:
+            with self.phase(type(observer).__name__):
+                observer.update(self)
+        if self.profiler is not None:
+            self.profiler.end_tick(self)
+        return ticks
+
+    # the per-tick summary returned by metrics, in order
+    metric_names = ('step', 'population', 'energy', 'health', 'storms', 'vegetation')
+
+    def metrics(self, coverage_th=0.1):
+        """Returns a summary of the current state of the world: the step,
+           population, mean energy and health of the Terrans, the number of
+           storms and the fraction of the map covered by vegetation (above
+           coverage_th)."""
+        population = sum(len(pop) for pop in self.pops)
+        energy = sum(pop.energy.sum() for pop in self.pops) / population if population else 0.0
+        health = sum(pop.health.sum() for pop in self.pops) / population if population else 0.0
+        vegetation = self.terrain.coverage(coverage_th)
+        return {'step': self.step, 'population': population, 'energy': float(energy), 'health': float(health),
+                'storms': len(self.weather.storm_str), 'vegetation': vegetation}
+
+    def memory(self):
+        """Returns the dtype, shape and size in bytes of every array held by
+           the terrain, weather and populations, keyed by owner.name (e.g.
+           'terrain.heightmap'). Memory-mapped layers are included at their
+           mapped size, and tiled layers at the size of the chunks in memory."""
+        owners = [('terrain', self.terrain), ('weather', self.weather), ('census', self.census)]
+        owners += [('pop%d' % i, pop) for i, pop in enumerate(self.pops)]
+        report = {}
+        for owner, obj in owners:
+            for name, value in vars(obj).items():
+                if isinstance(value, (np.ndarray, tiles.ChunkedLayer)):
+                    report['%s.%s' % (owner, name)] = (value.dtype.name, value.shape, value.nbytes)
+        return report
+
+    def run(self, ticks=None, fast=None):
+        """Runs the simulation for the supplied number of ticks, or until
+           an observer stops it if ticks is None. If fast is supplied, idle
+           stretches (before the Terrans spawn, or after they die out) are
+           fast-forwarded up to fast ticks at a time."""
+        self.stopped = False
+        end = None if ticks is None else self.step + ticks
+        try:
+            while not self.stopped and (end is None or self.step < end):
+                if fast and self.fast_forward(fast if end is None else min(fast, end - self.step)):
+                    continue
+                self.tick()
+        finally:
+            for observer in self.observers:
+                observer.close(self)
+        return self
+
+class Pacer(Observer):
+    """Limits a simulation to at most rate ticks per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.last = None
+
+    def update(self, sim):
+        now = time.perf_counter()
+        if self.last is not None and now - self.last < self.interval:
+            time.sleep(self.interval - (now - self.last))
+        self.last = time.perf_counter()
+
+class KeyboardListener(Observer):
+    """Stops a simulation when the escape key is pressed in its console.
+       Uses msvcrt on Windows and a non-blocking read of stdin elsewhere
+       (where it does nothing if stdin isn't a terminal)."""
+
+    def __init__(self, key=27):
+        self.key = key
+        self.saved = None
+        try:
+            import msvcrt
+            self.msvcrt = msvcrt
+        except ImportError:
+            self.msvcrt = None
+            if sys.stdin.isatty():
+                import termios, tty
+                self.saved = termios.tcgetattr(sys.stdin)
+                tty.setcbreak(sys.stdin)
+
+    def pressed(self):
+        if self.msvcrt is not None:
+            return self.msvcrt.kbhit() and ord(self.msvcrt.getch()) == self.key
+        if self.saved is None:
+            return False
+
+        import select
+        if select.select([sys.stdin], [], [], 0)[0]:
+            return ord(sys.stdin.read(1)) == self.key
+        return False
+
+    def update(self, sim):
+        # check for terminating keystroke
+        if self.pressed():
+            sim.stop()
+
+    def close(self, sim):
+        if self.saved is not None:
+            import termios
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.saved)
+            self.saved = None
@@ -0,0 +1,272 @@
+# Spatial indices for batched neighbour queries on the (wrapping) Terra^2 map.
+
+import numpy as np
+
+import kernels
+
+def torus_dist(p1, p2, size):
+    """Returns the euclidean distance between p1 and p2 on a map of the
+       supplied size that wraps around at its edges.
+
+       Keyword arguments:
+       p1, p2 -- arrays of coordinates, with x and y in the last axis.
+       size -- the size of the map.
+       """
+    d = np.abs(np.asarray(p1, dtype=float) - np.asarray(p2, dtype=float))
+    d = np.minimum(d, size - d)
+    return np.hypot(d[..., 0], d[..., 1])
+
+def _first_k(qidx, pidx, dist, num_queries, k):
+    """Reduces flat (query, point, distance) candidates to the k closest per query."""
+    idx = np.full((num_queries, k), -1, dtype=np.intp)
+    dists = np.full((num_queries, k), np.inf)
+    if len(qidx) == 0:
+        return idx, dists
+
+    # ties are broken by point index so every index gives the same answer
+    order = np.lexsort((pidx, dist, qidx))
+    qidx, pidx, dist = qidx[order], pidx[order], dist[order]
+    starts = np.searchsorted(qidx, np.arange(num_queries))
+    rank = np.arange(len(qidx)) - starts[qidx]
+    keep = rank < k
+    idx[qidx[keep], rank[keep]] = pidx[keep]
+    dists[qidx[keep], rank[keep]] = dist[keep]
+    return idx, dists
+
+class SpatialIndex:
+    """Base class of the spatial indices. An index is rebuilt from a set of
+       points (usually once per tick) and then answers batched queries for
+       many query points at once.
+
+       Keyword arguments:
+       size -- the size of the map the points live on.
+       """
+
+    def __init__(self, size):
+        self.size = size
+        self.points = np.zeros((0, 2))
+        self.labels = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def rebuild(self, points, labels=None):
+        """Replaces the indexed points with the supplied (N, 2) coordinates,
+           optionally tagged with (N,) integer labels (e.g. the population
+           each point belongs to) that queries can be restricted to."""
+        self.points = np.mod(np.asarray(points, dtype=float).reshape(-1, 2), self.size)
+        self.labels = None if labels is None else np.asarray(labels)
+
+    def _keep(self, qidx, pidx, exclude, label):
+        """Returns which (query, point) candidates pass the exclude and label filters."""
+        keep = np.ones(len(pidx), dtype=bool)
+        if exclude is not None:
+            keep &= pidx != np.asarray(exclude)[qidx]
+        if label is not None:
+            keep &= self.labels[pidx] == np.asarray(label)[qidx]
+        return keep
+
+    def nearest(self, queries, k=1, exclude=None, label=None):
+        """Returns the indices of and distances to the k closest points for
+           every query point, as two (Q, k) arrays. Missing neighbours are
+           given the index -1 and an infinite distance.
+
+           Keyword arguments:
+           queries -- the (Q, 2) coordinates to search around.
+           k -- the number of neighbours to return.
+           exclude -- optional (Q,) indices of a point to ignore for each query
+                      (used so that a Terran isn't its own closest neighbour).
+           label -- optional (Q,) labels; each query only sees points with its label.
+           """
+        raise NotImplementedError
+
+    def within(self, queries, radius, exclude=None, label=None):
+        """Returns every (query, point) pair closer than or equal to radius
+           as three flat arrays: query indices, point indices and distances.
+           """
+        raise NotImplementedError
+
+    def nearest_within(self, queries, radius, exclude=None, label=None):
+        """Returns the index of and distance to the closest point within
+           radius of every query point, as two (Q,) arrays (-1 and an
+           infinite distance where there is none)."""
+        num_queries = len(np.asarray(queries).reshape(-1, 2))
+        qidx, pidx, dist = self.within(queries, radius, exclude, label)
+        idx, dists = _first_k(qidx, pidx, dist, num_queries, 1)
+        return idx[:, 0], dists[:, 0]
+
+class BruteForceIndex(SpatialIndex):
+    """Compares every query against every point. Only sensible for
+       small point sets, but useful as a reference."""
+
+    def _pairs(self, queries, exclude, label):
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        qidx = np.repeat(np.arange(len(queries)), len(self.points))
+        pidx = np.tile(np.arange(len(self.points)), len(queries))
+        dist = kernels.torus_dist(queries[qidx], self.points[pidx], self.size)
+        if exclude is not None or label is not None:
+            keep = self._keep(qidx, pidx, exclude, label)
+            qidx, pidx, dist = qidx[keep], pidx[keep], dist[keep]
+        return len(queries), qidx, pidx, dist
+
+    def nearest(self, queries, k=1, exclude=None, label=None):
+        num_queries, qidx, pidx, dist = self._pairs(queries, exclude, label)
+        return _first_k(qidx, pidx, dist, num_queries, k)
+
+    def within(self, queries, radius, exclude=None, label=None):
+        num_queries, qidx, pidx, dist = self._pairs(queries, exclude, label)
+        keep = dist <= radius
+        return qidx[keep], pidx[keep], dist[keep]
+
+class GridIndex(SpatialIndex):
+    """Buckets points into a uniform grid laid over the map lattice and only
+       compares queries against the points in nearby (wrapped) buckets.
+
+       With layers set, every label gets a grid of its own, so labelled
+       queries never even see the points of other labels. This suits many
+       labels that each hold a small share of the points, such as the
+       worlds of an ensemble.
+
+       Keyword arguments:
+       size -- the size of the map the points live on.
+       cell -- the minimum width of a bucket, in map cells.
+       layers -- the number of labels (0 to label-1) to keep separate grids for.
+       """
+
+    def __init__(self, size, cell=4, layers=None):
+        super().__init__(size)
+        self.buckets = max(1, int(size // cell))
+        self.width = size / self.buckets
+        self.layers = layers
+        self.rebuild(self.points, None if layers is None else np.zeros(0, dtype=np.intp))
+
+    def _bucket(self, points):
+        b = np.minimum((points / self.width).astype(np.intp), self.buckets - 1)
+        return b[:, 0], b[:, 1]
+
+    def rebuild(self, points, labels=None):
+        super().rebuild(points, labels)
+        bx, by = self._bucket(self.points)
+        ids = bx * self.buckets + by
+        if self.layers is not None:
+            ids += self.labels * self.buckets**2
+        self.order = np.argsort(ids, kind='stable')
+        self.counts = np.bincount(ids, minlength=self.buckets**2 * (self.layers or 1))
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+
+    def _offsets(self, reach):
+        """Returns the unique (wrapped) bucket offsets within reach buckets."""
+        r = np.arange(-reach, reach + 1)
+        off = np.stack(np.meshgrid(r, r, indexing='ij'), axis=-1).reshape(-1, 2)
+        return np.unique(np.mod(off, self.buckets), axis=0)
+
+    def _candidates(self, queries, reach, exclude, label):
+        """Gathers (query, point, distance) for every point in the buckets
+           within reach of each query."""
+        qbx, qby = self._bucket(queries)
+        off = self._offsets(reach)
+        nbx = (qbx[:, None] + off[None, :, 0]) % self.buckets
+        nby = (qby[:, None] + off[None, :, 1]) % self.buckets
+        bucket = nbx * self.buckets + nby
+        if self.layers is not None:
+            # only the grid of each query's own label is searched
+            bucket += label[:, None] * self.buckets**2
+            label = None
+        bucket = bucket.ravel()
+        counts = self.counts[bucket]
+        total = counts.sum()
+
+        qidx = np.repeat(np.repeat(np.arange(len(queries)), len(off)), counts)
+        first = np.repeat(self.starts[bucket], counts)
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        pidx = self.order[first + within]
+        dist = kernels.torus_dist(queries[qidx], self.points[pidx], self.size)
+
+        if exclude is not None or label is not None:
+            keep = self._keep(qidx, pidx, exclude, label)
+            qidx, pidx, dist = qidx[keep], pidx[keep], dist[keep]
+        return qidx, pidx, dist
+
+    def nearest(self, queries, k=1, exclude=None, label=None):
+        queries = np.mod(np.asarray(queries, dtype=float).reshape(-1, 2), self.size)
+        exclude = None if exclude is None else np.asarray(exclude)
+        label = None if label is None else np.asarray(label)
+        idx = np.full((len(queries), k), -1, dtype=np.intp)
+        dists = np.full((len(queries), k), np.inf)
+
+        todo = np.arange(len(queries))
+        reach = 1
+        while len(todo) > 0:
+            ex = None if exclude is None else exclude[todo]
+            lab = None if label is None else label[todo]
+            qidx, pidx, dist = self._candidates(queries[todo], reach, ex, lab)
+            found, found_dist = _first_k(qidx, pidx, dist, len(todo), k)
+            idx[todo], dists[todo] = found, found_dist
+
+            # every point closer than reach bucket widths has certainly been seen
+            if 2*reach + 1 >= self.buckets:
+                break
+            todo = todo[found_dist[:, -1] >= reach * self.width]
+            reach *= 2
+
+        return idx, dists
+
+    def within(self, queries, radius, exclude=None, label=None):
+        queries = np.mod(np.asarray(queries, dtype=float).reshape(-1, 2), self.size)
+        exclude = None if exclude is None else np.asarray(exclude)
+        label = None if label is None else np.asarray(label)
+        reach = int(np.ceil(radius / self.width))
+        qidx, pidx, dist = self._candidates(queries, reach, exclude, label)
+        keep = dist <= radius
+        return qidx[keep], pidx[keep], dist[keep]
+
+class KDTreeIndex(SpatialIndex):
+    """Wraps SciPy's periodic k-d tree."""
+
+    def rebuild(self, points, labels=None):
+        super().rebuild(points, labels)
+        # SciPy is only loaded by the k-d tree index
+        import scipy.spatial
+        # the periodic tree needs coordinates strictly below the box size
+        self.tree = scipy.spatial.cKDTree(np.minimum(self.points, np.nextafter(self.size, 0)), boxsize=self.size)
+
+    def nearest(self, queries, k=1, exclude=None, label=None):
+        queries = np.mod(np.asarray(queries, dtype=float).reshape(-1, 2), self.size)
+        extra = 0 if exclude is None else 1
+        kq = min(k + extra, len(self.points))
+        if kq == 0:
+            return (np.full((len(queries), k), -1, dtype=np.intp), np.full((len(queries), k), np.inf))
+
+        while True:
+            dist, pidx = self.tree.query(queries, k=kq)
+            dist, pidx = dist.reshape(len(queries), kq), pidx.reshape(len(queries), kq)
+            qidx = np.repeat(np.arange(len(queries)), kq)
+            pidx, dist = pidx.ravel(), dist.ravel()
+            keep = pidx < len(self.points)
+            keep[keep] = self._keep(qidx[keep], pidx[keep], exclude, label)
+            found = _first_k(qidx[keep], pidx[keep], dist[keep], len(queries), k)
+            # with labels, the k closest points may all be filtered out, so
+            # widen the search until every query is answered or all are seen
+            if label is None or kq == len(self.points) or (found[0][:, -1] >= 0).all():
+                return found
+            kq = min(kq * 2, len(self.points))
+
+    def within(self, queries, radius, exclude=None, label=None):
+        queries = np.mod(np.asarray(queries, dtype=float).reshape(-1, 2), self.size)
+        found = self.tree.query_ball_point(queries, radius, return_sorted=False)
+        counts = np.array([len(f) for f in found], dtype=np.intp)
+        qidx = np.repeat(np.arange(len(queries)), counts)
+        pidx = np.fromiter((p for f in found for p in f), dtype=np.intp, count=counts.sum())
+        if exclude is not None or label is not None:
+            keep = self._keep(qidx, pidx, exclude, label)
+            qidx, pidx = qidx[keep], pidx[keep]
+        return qidx, pidx, kernels.torus_dist(queries[qidx], self.points[pidx], self.size)
+
+indices = {'brute': BruteForceIndex, 'grid': GridIndex, 'kdtree': KDTreeIndex}
+
+def make_index(kind, size):
+    """Returns a new, empty spatial index of the named kind ('brute', 'grid'
+       or 'kdtree') for a map of the supplied size."""
+    if kind not in indices:
+        raise ValueError("Unknown spatial index '%s'" % kind)
+    return indices[kind](size)
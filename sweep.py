@@ -0,0 +1,194 @@
+# Parallel parameter sweeps of headless Terra^2 simulations.
+#
+# Example:
+#     python sweep.py --ticks 500 --workers 8 --out sweeps/storms \
+#         --grid "storm_chance=[0.01, 0.05, 0.1]" "sex_th=[0.3, 0.4]"
+
+import argparse
+import ast
+import csv
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from simulation import Observer, Simulation
+
+def grid(**params):
+    """Returns every combination of the supplied parameter values.
+
+       Keyword arguments:
+       params -- a list of values for each Simulation parameter to sweep.
+       """
+    names = list(params)
+    return [dict(zip(names, values)) for values in itertools.product(*params.values())]
+
+def sample(n, seed=None, **params):
+    """Returns n random parameter sets.
+
+       Keyword arguments:
+       n -- the number of parameter sets to draw.
+       seed -- the seed of the draw.
+       params -- for each Simulation parameter, either a (low, high) range to
+                 draw uniformly from (integers if both bounds are) or a list
+                 of values to choose between.
+       """
+    rng = np.random.default_rng(seed)
+    sets = [{} for i in range(n)]
+    for name, values in params.items():
+        if isinstance(values, tuple):
+            low, high = values
+            if isinstance(low, int) and isinstance(high, int):
+                drawn = rng.integers(low, high, n, endpoint=True).tolist()
+            else:
+                drawn = rng.uniform(low, high, n).tolist()
+        else:
+            drawn = [values[i] for i in rng.integers(0, len(values), n)]
+        for params_i, value in zip(sets, drawn):
+            params_i[name] = value
+    return sets
+
+class Summary:
+    """Running aggregates of the per-tick metrics of one run, so a run can
+       be summarized without keeping every row."""
+
+    def __init__(self):
+        self.ticks = self.alive = 0
+        self.final_population = self.peak_population = 0
+        self.population = self.energy = self.health = self.storms = 0.0
+        self.final_vegetation = 0.0
+        self.last_alive = -1
+
+    def add(self, row):
+        self.ticks += 1
+        self.final_population = int(row['population'])
+        self.peak_population = max(self.peak_population, self.final_population)
+        self.population += row['population']
+        self.storms += row['storms']
+        self.final_vegetation = row['vegetation']
+        if row['population'] > 0:
+            self.alive += 1
+            self.energy += row['energy']
+            self.health += row['health']
+            self.last_alive = row['step']
+
+    def result(self):
+        return {'ticks': self.ticks,
+                'final_population': self.final_population,
+                'peak_population': self.peak_population,
+                'mean_population': float(self.population / self.ticks) if self.ticks else 0.0,
+                'mean_energy': float(self.energy / self.alive) if self.alive else 0.0,
+                'mean_health': float(self.health / self.alive) if self.alive else 0.0,
+                'mean_storms': float(self.storms / self.ticks) if self.ticks else 0.0,
+                'final_vegetation': self.final_vegetation,
+                'last_alive': self.last_alive}
+
+class MetricsWriter(Observer):
+    """Streams the per-tick metrics of a simulation to a CSV file, keeping
+       only their running Summary in memory."""
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(Simulation.metric_names)
+        self.summary = Summary()
+
+    def update(self, sim):
+        row = sim.metrics()
+        self.writer.writerow([row[name] for name in Simulation.metric_names])
+        self.summary.add(row)
+
+    def close(self, sim):
+        self.file.close()
+
+def summarize(rows):
+    """Aggregates the per-tick metrics of one run into a single record."""
+    summary = Summary()
+    for row in rows:
+        summary.add(row)
+    return summary.result()
+
+def run_one(index, params, seed, ticks, out):
+    """Runs a single simulation of a sweep and returns its summary. This is
+       what each worker process executes."""
+    start = time.perf_counter()
+    sim = Simulation(seed=seed, **params)
+    writer = sim.attach(MetricsWriter(os.path.join(out, 'run%05d.csv' % index)))
+    sim.run(ticks)
+    summary = writer.summary.result()
+    summary['seconds'] = time.perf_counter() - start
+    return index, summary
+
+def sweep(param_sets, ticks, out, workers=None, seed=0, base=None):
+    """Runs a headless simulation for every parameter set in a pool of worker
+       processes and writes the per-tick metrics of each run to out/runNNNNN.csv
+       and a summary of all runs to out/summary.csv. Returns the summaries.
+
+       Workers are long-lived, so the simulation modules are imported once
+       per worker rather than once per run. Every run gets its own
+       independent seed, spawned from seed. Since the world cache (see
+       base['cache']) is keyed on the seed, runs of one sweep never hit
+       each other's worlds; the cache only pays off across sweeps that
+       share a seed.
+
+       Keyword arguments:
+       param_sets -- a list of dicts of Simulation parameters (see grid and sample).
+       ticks -- the number of ticks to run each simulation for.
+       out -- the directory to write results to.
+       workers -- the number of worker processes (one per CPU if None).
+       seed -- the seed all per-run seeds are spawned from.
+       base -- Simulation parameters shared by every run.
+       """
+    os.makedirs(out, exist_ok=True)
+    base = base or {}
+    seeds = np.random.SeedSequence(seed).spawn(len(param_sets))
+    summaries = [None] * len(param_sets)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_one, i, dict(base, **params), seeds[i], ticks, out) for i, params in enumerate(param_sets)]
+        for future in as_completed(futures):
+            index, summary = future.result()
+            summaries[index] = dict(param_sets[index], run=index, **summary)
+
+    names = ['run'] + sorted(set(name for params in param_sets for name in params)) + list(summarize([]))
+    with open(os.path.join(out, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=names + ['seconds'])
+        writer.writeheader()
+        writer.writerows(summaries)
+    return summaries
+
+def _parse(assignments):
+    params = {}
+    for assignment in assignments:
+        name, value = assignment.split('=', 1)
+        params[name.strip()] = ast.literal_eval(value.strip())
+    return params
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of headless Terra^2 simulations.")
+    parser.add_argument('--grid', nargs='+', default=[], metavar='NAME=VALUES',
+                        help="a list of values to sweep for a parameter, e.g. \"sex_th=[0.3, 0.4]\"")
+    parser.add_argument('--sample', type=int, default=0, help="draw this many random parameter sets instead of a grid")
+    parser.add_argument('--ranges', nargs='+', default=[], metavar='NAME=RANGE',
+                        help="a (low, high) range or list of values to sample a parameter from")
+    parser.add_argument('--set', nargs='+', default=[], metavar='NAME=VALUE', help="a parameter shared by every run")
+    parser.add_argument('--ticks', type=int, default=500, help="the number of ticks per run")
+    parser.add_argument('--workers', type=int, default=None, help="the number of worker processes")
+    parser.add_argument('--seed', type=int, default=0, help="the base seed of the sweep")
+    parser.add_argument('--out', default='sweep', help="the directory to write results to")
+    parser.add_argument('--cache', default=None, help="a world cache directory shared by every run")
+    args = parser.parse_args()
+
+    if args.sample:
+        param_sets = sample(args.sample, seed=args.seed, **_parse(args.ranges))
+    else:
+        param_sets = grid(**_parse(args.grid))
+
+    start = time.perf_counter()
+    base = _parse(args.set)
+    if args.cache:
+        base['cache'] = args.cache
+    summaries = sweep(param_sets, args.ticks, args.out, workers=args.workers, seed=args.seed, base=base)
+    print("%d runs in %.1fs, results in %s" % (len(summaries), time.perf_counter() - start, args.out))
@@ -1,34 +1,203 @@
 # Definition of the Terrans, the animal inhabitants of Terra^2.
 # Ethan Block, 10-3-2018
 
-from numba import jit
-from util import Struct
-import world, util
+import kernels, parallel, world, util, spatial, tiles, topology
 
 import numpy as np
-import random
-
-class Terran(Struct):
-    """The struct that contains variables controlling
-       the behavior of a Terran, a single animal inhabitant
-       of Terra^2."""
-    x = 0
-    y = 0
-    health = 1.0
-    energy = 1.0
-    social = 1.0
-    rogue = False
-    infected = False
-    temprange = (0.0, 1.0)
-    w_climate = 1.0 # how much the Terran cares about climate
-    w_vegetation = 1.0 # how much the Terran cares about vegetation
+
+def _column(name, col=None):
+    """Returns a property that reads and writes one row of a TerranPop column."""
+    def getter(self):
+        value = getattr(self.pop, name)[self.index]
+        if col is not None:
+            value = value[col]
+        return value.item() if np.ndim(value) == 0 else tuple(value.tolist())
+
+    def setter(self, value):
+        if col is None:
+            getattr(self.pop, name)[self.index] = value
+        else:
+            getattr(self.pop, name)[self.index, col] = value
+
+    return property(getter, setter)
+
+def _buffered(name):
+    """Returns a property exposing the live rows of one of the column
+       buffers of a TerranPop. Assigning to it replaces the column (and
+       sets the population size)."""
+    def getter(self):
+        return getattr(self, '_' + name)[:self.count]
+
+    def setter(self, value):
+        value = np.asarray(value)
+        self.reserve(len(value))
+        getattr(self, '_' + name)[:len(value)] = value
+        self.count = len(value)
+
+    return property(getter, setter)
+
+class Terran:
+    """A view onto a single Terran, an animal inhabitant of Terra^2.
+
+       The variables controlling the behavior of a Terran are stored
+       as columns of its TerranPop, so this is only a thin accessor
+       kept for compatibility - the population update never uses it.
+       """
+    id = _column('id')
+    x = _column('x')
+    y = _column('y')
+    health = _column('health')
+    energy = _column('energy')
+    social = _column('social')
+    rogue = _column('rogue')
+    infected = _column('infected')
+    temprange = _column('temprange')
+    w_climate = _column('weights', 0) # how much the Terran cares about climate
+    w_vegetation = _column('weights', 1) # how much the Terran cares about vegetation
+
+    def __init__(self, pop, index):
+        self.pop = pop
+        self.index = index
+
+def _contains(cells, cell):
+    """Whether cell is among the sorted flat cells."""
+    i = np.searchsorted(cells, cell)
+    return i < len(cells) and cells[i] == cell
+
+def climate_gradient_layers(climates, temprange, band=256):
+    """Returns the two layers of the climate gradient that Terrans move by:
+       the gradient at each cell itself and its mean over the 3x3 area.
+       The gradient is built a band of rows at a time, so the full
+       size x size x 9 gradient is never held in memory. Tiled climates
+       give tiled layers, built a tile at a time."""
+    if isinstance(climates, tiles.ChunkedLayer):
+        return _climate_gradient_tiles(climates, temprange)
+    size = climates.shape[0]
+    smoothed = world.proc_smooth(np.asarray(climates, dtype=np.float64), 3) - abs((temprange[1] - temprange[0])/2)
+    centre = np.empty((size, size))
+    mean = np.empty((size, size))
+    for start in range(0, size, band):
+        rows = slice(start, min(start + band, size))
+        gradient = util.get_gradient(smoothed, rows)
+        gradient = util.normalize(gradient, np.min(gradient, axis=2, keepdims=True), np.max(gradient, axis=2, keepdims=True))
+        centre[rows] = gradient[:, :, 4]
+        mean[rows] = np.mean(gradient, axis=2)
+    return {'gradient_c_centre': centre, 'gradient_c_mean': mean}
+
+def _climate_gradient_tiles(climates, temprange):
+    """climate_gradient_layers for tiled climates. Each tile of the smoothed
+       climates is read with a one-cell halo, wrapped around the map edges,
+       so the layers are identical to the dense ones."""
+    smoothed = world.proc_smooth(tiles.astype(climates, np.float64), 3)
+    offset = abs((temprange[1] - temprange[0])/2)
+    centre = smoothed.like(name='gradient_c_centre')
+    mean = smoothed.like(name='gradient_c_mean')
+    for key in smoothed.all_keys():
+        (x0, x1), (y0, y1) = smoothed.bounds(key)
+        width, height = x1 - x0, y1 - y0
+        window = smoothed.window(x0, y0, width, height, halo=1, wrap=True) - offset
+        gradient = np.empty((width, height, 9))
+        for z, (dx, dy) in enumerate(topology.OFFSETS):
+            np.subtract(window[1 + dx:1 + dx + width, 1 + dy:1 + dy + height], window[1:1 + width, 1:1 + height],
+                        out=gradient[:, :, z])
+        gradient = util.normalize(gradient, np.min(gradient, axis=2, keepdims=True), np.max(gradient, axis=2, keepdims=True))
+        centre.set_chunk(key, gradient[:, :, 4].copy())
+        mean.set_chunk(key, np.mean(gradient, axis=2))
+    return {'gradient_c_centre': centre, 'gradient_c_mean': mean}
+
+class Census:
+
+    def __init__(self, size, index='grid', tile=None, store=None, resident=None):
+        """The spatial state shared by every population on one world: a
+           single occupancy grid and spatial index over all their Terrans,
+           each point labelled with its population. Collision and proximity
+           checks across populations then cost no more than within one, and
+           recording positions costs the same however the Terrans are split
+           into populations.
+
+           It also caches the climate gradients Terrans follow by
+           temperature range, so species sharing a range share them.
+
+           Keyword arguments:
+           size -- the size of the map.
+           index -- the kind of spatial index used for neighbour queries ('grid', 'kdtree' or 'brute').
+           tile, store, resident -- if tile is supplied, the occupancy grid is tiled (see
+                                    world.Terrain). Only the tiles Terrans are in are allocated.
+           """
+        self.size = size
+        if tile is None:
+            self.occupancy = np.zeros((size, size), dtype=bool)
+        else:
+            self.occupancy = tiles.ChunkedLayer(size, tile, bool, False, store=store, resident=resident, name='occupancy')
+        self.coords = np.zeros((0, 2), dtype=np.intp)
+        self.labels = np.zeros(0, dtype=np.intp)
+        self.index = spatial.make_index(index, size)
+        self.populations = 0
+        self.gradients = {}
+
+    def register(self):
+        """Returns the label of a new population."""
+        self.populations += 1
+        return self.populations - 1
+
+    def record(self, pops):
+        """Records the current coordinates of every Terran in pops and
+           rebuilds the occupancy grid and spatial index over them. Each
+           population's Terrans are indexed from its offset on. Only the
+           cells Terrans left or entered are written, so the cost doesn't
+           grow with the map."""
+        lattice = self.topology
+        old = self.coords
+        lattice.scatter(self.occupancy, lattice.cells(old[:, 0], old[:, 1]), False)
+
+        offset = 0
+        coords, labels = [np.zeros((0, 2), dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+        for pop in pops:
+            pop.offset = offset
+            pop.terran_coords = np.column_stack((pop.x, pop.y))
+            coords.append(pop.terran_coords)
+            labels.append(np.full(len(pop), pop.label, dtype=np.intp))
+            offset += len(pop)
+        self.coords = np.concatenate(coords)
+        self.labels = np.concatenate(labels)
+
+        lattice.scatter(self.occupancy, lattice.cells(self.coords[:, 0], self.coords[:, 1]), True)
+        # free the tiles every Terran has left
+        tiles.release(self.occupancy, lattice.cells(old[:, 0], old[:, 1]))
+        self.index.rebuild(self.coords, self.labels)
+
+    @property
+    def topology(self):
+        """The (shared) Topology of the map."""
+        return topology.lattice(self.size)
+
+    def climate_gradients(self, terrain, temprange, cache=None):
+        """Returns the climate gradient layers (see climate_gradient_layers)
+           of a temperature range at the terrain's precision, computing them
+           (or loading them from a WorldCache) only the first time."""
+        key = tuple(float(t) for t in temprange)
+        if key not in self.gradients:
+            if cache is not None and terrain.cache_key is not None:
+                gradients = cache.fetch(cache.key(terrain=terrain.cache_key, temprange=temprange),
+                                        lambda: climate_gradient_layers(terrain.climates, temprange))
+            else:
+                gradients = climate_gradient_layers(terrain.climates, temprange)
+            # gradients are cached in float64 and stored at the terrain's precision
+            static = util.layer_dtypes(terrain.precision)[1]
+            self.gradients[key] = {name: tiles.astype(layer, static) for name, layer in gradients.items()}
+        return self.gradients[key]
 
 class TerranPop:
 
-    def __init__(self, terrain, weather, num_terrans, spawn_dist=2, temprange=(0.0, 1.0), decay=0.1, decay_h=0.25, decay_soc=0.005, sex_th=0.4):
+    def __init__(self, terrain, weather, num_terrans, spawn_dist=2, temprange=(0.0, 1.0), decay=0.1, decay_h=0.25, decay_soc=0.005, sex_th=0.4,
+                 index='grid', rng=None, cache=None, census=None):
         """The class that defines a population of Terrans and
            controls their behavior.
 
+           Every Terran variable is stored as a column (a numpy array
+           with one entry per Terran) so the population can be updated
+           with whole-array operations.
+
            Keyword arguments:
            terrain -- the world object these Terrans inhabit.
            weather --  the weather controller of the world.
@@ -39,136 +208,316 @@ class TerranPop:
            decay_h -- the decay rate of an individual's health when exhausted.
            decay_soc -- the decay rate of a Terran's social need.
            sex_th -- the energy threshold required for two Terrans to reproduce.
+           index -- the kind of spatial index used for neighbour queries ('grid', 'kdtree' or 'brute').
+           rng -- the numpy random Generator used to place the Terrans (a fresh one if None).
+           cache -- an optional WorldCache to load the climate gradient from (or save it to).
+           census -- the Census shared with the other populations on the world. It is
+                     then up to the owner to record it every tick, before any population
+                     moves (as Simulation does). If None, the population gets its own
+                     and records it itself.
            """
 
-        self.temprange = temprange
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
+
+        self.base_temprange = temprange
         self.decay = decay
         self.decay_h = decay_h
         self.decay_soc = decay_soc
         self.sex_th = sex_th
 
+        # the cells a population may spawn around, found in one pass rather
+        # than by reading the (possibly tiled) layers at every attempt
+        lush = np.max(terrain.vegetation)/2
+        suitable = tiles.flatnonzero(tiles.apply(
+            lambda climates, land, vegetation: (climates >= temprange[0]) & (climates <= temprange[1]) & land & (vegetation >= lush),
+            terrain.climates, terrain.land, terrain.vegetation))
         spawn_point = (int(terrain.size/2), int(terrain.size/2))
-        while (terrain.climates[spawn_point] < temprange[0] or
-               terrain.climates[spawn_point] > temprange[1] or
-               terrain.heightmap[spawn_point] <= terrain.water_level or
-               terrain.vegetation[spawn_point] < np.max(terrain.vegetation)/2):
-
-               spawn_point = (random.randint(0, terrain.size-1), random.randint(0, terrain.size-1))
+        while not _contains(suitable, spawn_point[0] * terrain.size + spawn_point[1]):
+               spawn_point = tuple(rng.integers(0, terrain.size, 2))
 
         self.terrain = terrain
         self.weather = weather
-        self.gradient_c = util.get_gradient(world.proc_smooth(terrain.climates, 3) - abs((temprange[1] - temprange[0])/2))
-        for x in range(self.terrain.size):
-            for y in range(self.terrain.size):
-                self.gradient_c[x,y] = util.normalize(self.gradient_c[x,y])
+        self.owns_census = census is None
+        self.census = Census(terrain.size, index) if census is None else census
+        self.label = self.census.register()
+        gradients = self.census.climate_gradients(terrain, temprange, cache)
+        self.gradient_c_centre = gradients['gradient_c_centre']
+        self.gradient_c_mean = gradients['gradient_c_mean']
+
+        # the columns are buffers with room to spare, of which the first
+        # count rows are live; the capacity doubles whenever births outgrow it
+        offsets = rng.integers(-spawn_dist, spawn_dist, (2, num_terrans), endpoint=True)
+        self.count = num_terrans
+        self._id = np.arange(num_terrans, dtype=np.int64) # unique within the population, in order of birth
+        self._x = ((spawn_point[0] + offsets[0]) % terrain.size).astype(np.intp)
+        self._y = ((spawn_point[1] + offsets[1]) % terrain.size).astype(np.intp)
+        self._health = np.ones(num_terrans)
+        self._energy = np.ones(num_terrans)
+        self._social = np.ones(num_terrans)
+        self._rogue = np.zeros(num_terrans, dtype=bool)
+        self._infected = np.zeros(num_terrans, dtype=bool)
+        self._temprange = np.tile(np.asarray(temprange, dtype=float), (num_terrans, 1))
+        self._weights = np.ones((num_terrans, 2)) # [w_climate, w_vegetation]
+        self._mated = np.zeros(0, dtype=np.int64) # the mating events of a tick
+        self.next_id = num_terrans
+        self.births = 0 # in the last tick
+        self.deaths = 0
+        self.offset = 0
+        self.terran_coords = np.zeros((0, 2), dtype=np.intp)
+        if self.owns_census:
+            self.record_positions()
+
+    # names of the per-Terran columns, in the order new Terrans are appended
+    columns = ('id', 'x', 'y', 'health', 'energy', 'social', 'rogue', 'infected', 'temprange', 'weights')
+
+    id = _buffered('id')
+    x = _buffered('x')
+    y = _buffered('y')
+    health = _buffered('health')
+    energy = _buffered('energy')
+    social = _buffered('social')
+    rogue = _buffered('rogue')
+    infected = _buffered('infected')
+    temprange = _buffered('temprange')
+    weights = _buffered('weights')
+
+    def __len__(self):
+        return self.count
 
-        self.terrans = [Terran(x=(spawn_point[0] + random.randint(-spawn_dist, spawn_dist)),
-                        y=(spawn_point[1] + random.randint(-spawn_dist, spawn_dist)),
-                        temprange=temprange) for x in range(num_terrans)]
-        self.terran_coords = np.array(self.get_positions()[1])
+    @property
+    def capacity(self):
+        """The number of Terrans the column buffers have room for."""
+        return len(self._x)
+
+    def reserve(self, n):
+        """Makes room for n Terrans in every column buffer, doubling their
+           capacity as many times as needed."""
+        capacity = self.capacity
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity = max(2 * capacity, 16)
+        for name in self.columns:
+            old = getattr(self, '_' + name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, '_' + name, new)
+
+    @property
+    def index(self):
+        """The spatial index shared by every population in the census."""
+        return self.census.index
+
+    @property
+    def occupancy(self):
+        """The occupancy grid shared by every population in the census."""
+        return self.census.occupancy
+
+    @property
+    def terrans(self):
+        """A list of Terran views onto every member of the population."""
+        return [Terran(self, i) for i in range(len(self))]
 
-    #@jit
     def get_positions(self):
-        pmap = np.zeros((self.terrain.size, self.terrain.size))
-        coords = []
-        for terran in self.terrans:
-            pmap[terran.x, terran.y] = 1.0
-            coords.append((terran.x, terran.y))
-        return pmap, coords
-
-    #@jit
+        pmap = np.zeros((self.terrain.size, self.terrain.size), dtype=bool)
+        pmap[self.x, self.y] = True
+        return pmap, np.column_stack((self.x, self.y))
+
+    def record_positions(self):
+        """Records the current coordinates of every Terran and rebuilds the
+           occupancy grid and spatial index over them (see Census.record).
+           This happens once per tick, before the Terrans move."""
+        self.census.record([self])
+
     def get_closest_terran(self, coords):
-        best = None
-        best_dist = 99999
-
-        for i in range(len(self.terran_coords)):
-            dist = util.eudist(coords, self.terran_coords[i])
-            if dist < best_dist:
-                best = self.terrans[i]
-                best_dist = dist
-
-        return best, best_dist
-
-    def manage_terrans(self):
-        newpops = []
-        for terran in self.terrans:
-            if terran.energy < 1.0:
-                # consume sustenance
-                if self.terrain.sustenance[terran.x, terran.y] > 0:
-                    self.terrain.sustenance[terran.x, terran.y] -= self.decay*2
-                    terran.energy += self.decay*2
-
-            # damage weak terrans
-            if terran.energy <= 0.0:
-                terran.health -= self.decay_h
-
-            # damage terrans in storm
-            if self.weather.weathermap[terran.x, terran.y] > 0:
-                terran.health -= self.weather.weathermap[terran.x, terran.y]
-
-            # remove dead terrans
-            if terran.health > 0.0:
-                newpops.append(terran)
-
-            # social and reproduction logic (woohoo)
-            closest, closest_dist = self.get_closest_terran([terran.x, terran.y])
-            if closest_dist <= 2:
-                terran.social += self.decay_soc
-                if closest.energy > self.sex_th and terran.energy > self.sex_th:
-                    self.terrans.append(Terran(x=terran.x, y=closest.y, temprange=self.temprange))
-                    closest.energy -= self.sex_th
-                    terran.energy -= self.sex_th
-            else:
-                terran.social -= self.decay_soc
-
-            if terran.social <= 0.0:
-                terran.energy -= self.decay_h
-
-            terran.energy -= self.decay
-
-        self.terrans = newpops
-
-    def move_terrans(self):
-        self.terran_coords = np.array(self.get_positions()[1])
-        # TODO: calculate area gradients for each terran, move accordingly
-        for terran in self.terrans:
-            txy = np.array([terran.x, terran.y])
-            closest = self.get_closest_terran(txy)[0]
-            closest_coords = (closest.x ,closest.y)
-            area = util.get_area(txy, self.terrain.size)
-            grad = np.zeros(9)
-
-            for i in range(len(area)):
-                g_sust = self.terrain.sustenance[area[i][0], area[i][1]] - self.terrain.sustenance[txy[0], txy[1]]
-                g_cli = np.average(self.gradient_c[area[i][0], area[i][1]]) - self.gradient_c[txy[0], txy[1]][4]
-                grad[i] = (g_sust + g_cli) / 2
-
-            dest = area[grad.tolist().index(max(grad))]
-            dest = np.asarray(dest)
-
-            if terran.social < 0.2:
-                dest_soc = util.path(closest_coords, area)
-                dest = (dest + dest_soc) / 2
-            elif terran.social > 0.8:
-                dest_soc = util.path_away(closest_coords, area)
-                dest = (dest + dest_soc) / 2
-
-            if len(self.weather.storms) > 0:
-                if self.weather.weathermap[txy[0], txy[1]] > 0:
-                    storm = self.weather.get_closest_storm(txy)[0][0]
-                    g_storm = util.path_away(storm, area)
-                    dest = (dest + g_storm) / 2
-
-            dest = np.ndarray.astype(np.asarray(dest), 'int32')
-
-            # find a spot near destination that isn't occupied or below sea level
-            dest_area = util.get_area(dest, self.terrain.size)
-            for i in range(len(dest_area)):
-                if dest_area[i] not in self.terran_coords:
-                    if self.terrain.heightmap[dest_area[i][0], dest_area[i][1]] > self.terrain.water_level:
-                        terran.x = dest[0]
-                        terran.y = dest[1]
-                        break
+        closest, closest_dist = self.index.nearest([coords], label=[self.label])
+        if closest[0, 0] < 0:
+            return None, 99999
+        return Terran(self, closest[0, 0] - self.offset), closest_dist[0, 0]
+
+    def get_closest_terrans(self, radius=None, rows=None):
+        """Returns the index of and distance to the closest other Terran (from
+           the recorded coordinates) for every Terran in the population (or
+           those at the supplied indices). Where there is none (within radius,
+           if supplied) the index is -1.
+           """
+        if rows is None:
+            rows = np.arange(len(self))
+        queries = np.column_stack((self.x[rows], self.y[rows]))
+        exclude = self.offset + rows
+        label = np.full(len(rows), self.label)
+        if radius is None:
+            closest, closest_dist = self.index.nearest(queries, exclude=exclude, label=label)
+            closest, closest_dist = closest[:, 0], closest_dist[:, 0]
+        else:
+            closest, closest_dist = self.index.nearest_within(queries, radius, exclude=exclude, label=label)
+        return np.where(closest >= 0, closest - self.offset, -1), closest_dist
+
+    def add_terrans(self, x, y):
+        """Appends newly born Terrans at the supplied coordinates, in place
+           (the buffers only grow when they run out of room)."""
+        n = len(x)
+        if n == 0:
+            return
+        start, end = self.count, self.count + n
+        self.reserve(end)
+        self._id[start:end] = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        self._x[start:end] = x
+        self._y[start:end] = y
+        self._health[start:end] = 1.0
+        self._energy[start:end] = 1.0
+        self._social[start:end] = 1.0
+        self._rogue[start:end] = False
+        self._infected[start:end] = False
+        self._temprange[start:end] = self.base_temprange
+        self._weights[start:end] = 1.0
+        self.count = end
+
+    def cull_terrans(self, keep):
+        """Removes every Terran not selected by the boolean mask keep,
+           compacting the survivors in place (in their original order)."""
+        n = np.count_nonzero(keep)
+        if n == self.count:
+            return
+        for name in self.columns:
+            column = getattr(self, '_' + name)
+            column[:n] = column[:self.count][keep]
+        self.count = n
+
+    def mating_buffer(self, n):
+        """Returns the buffer mating events are written to, with room for at
+           least n, doubling its capacity as many times as needed."""
+        capacity = len(self._mated)
+        if capacity < n:
+            while capacity < n:
+                capacity = max(2 * capacity, 16)
+            self._mated = np.empty(capacity, dtype=np.int64)
+        return self._mated
+
+    def manage_terrans(self, threads=None):
+        """Updates the energy, health and social need of every Terran and
+           resolves births and deaths, as a pipeline of whole-population
+           stages. Deaths and births are only collected as events while the
+           stages run, and applied at the end in one step: the dead are
+           compacted out and the newborns appended behind the survivors.
+
+           Mating pairs are resolved in order of the index of the Terran
+           that initiates them (its closest neighbour being its partner), so
+           who mates with whom is the same on every run. Survivors keep
+           their order and newborns are appended in the order their parents
+           mated, so this order is also the order of birth.
+
+           With threads, Terrans eat band by band on a thread pool (see
+           parallel.py), each band only writing to its own rows. They eat
+           serially from tiled sustenance, whose chunks are paged as they go."""
+        sustenance = self.terrain.sustenance
+        weathermap = self.weather.weathermap
+        x, y = self.x, self.y
+
+        # consume sustenance; every Terran eating from a cell is in the same band, in order
+        eating = np.flatnonzero((self.energy < 1.0) & (sustenance[x, y] > 0))
+        parts = [eating]
+        if threads and not isinstance(sustenance, tiles.ChunkedLayer):
+            parts = [eating[part] for part in parallel.partition(x[eating], self.terrain.size, threads)]
+        parallel.run(lambda part: tiles.consume(sustenance, x[part], y[part], self.decay*2), parts, threads)
+        self.terrain.touch(x[eating], y[eating])
+        self.energy[eating] += self.decay*2
+
+        # damage weak terrans
+        self.health[self.energy <= 0.0] -= self.decay_h
+
+        # damage terrans in storm
+        storm = weathermap[x, y]
+        self.health -= np.where(storm > 0, storm, 0.0)
+
+        # remove dead terrans (after they've had their chance to reproduce)
+        alive = self.health > 0.0
+
+        # social and reproduction logic (woohoo)
+        closest, closest_dist = self.get_closest_terrans(radius=2)
+        near = closest >= 0
+        self.social[near] += self.decay_soc
+        self.social[~near] -= self.decay_soc
+
+        # energy is spent as Terrans mate, so pairs are resolved in order
+        energy = self.energy
+        candidates = np.flatnonzero(near & (energy > self.sex_th))
+        mated = self.mating_buffer(len(candidates))
+        parents = mated[:kernels.mate(candidates, closest, energy, self.sex_th, mated)]
+        born_x, born_y = x[parents], y[closest[parents]]
+
+        energy[self.social <= 0.0] -= self.decay_h
+        energy -= self.decay
+
+        self.births, self.deaths = len(parents), len(alive) - np.count_nonzero(alive)
+        self.cull_terrans(alive)
+        self.add_terrans(born_x, born_y)
+
+    def move_terrans(self, threads=None):
+        """Moves every Terran one step, all at once. Each Terran heads up the
+           combined sustenance/climate gradient of its 3x3 area, pulled towards
+           or away from its closest neighbour by its social need and away from
+           the closest storm when caught in one.
+
+           Every move is worked out from the positions at the start of the
+           tick, so with threads the Terrans are split by band (see
+           parallel.py), each band's moves are worked out on a thread, and
+           they are applied in band order with the same result."""
+        if self.owns_census:
+            self.record_positions()
+        coords = self.terran_coords
+        if len(coords) == 0:
+            return
+
+        parts = [np.arange(len(coords))]
+        if threads:
+            parts = parallel.partition(coords[:, 0], self.terrain.size, threads)
+        for rows, (dest, move) in zip(parts, parallel.run(self.plan_moves, parts, threads)):
+            self.x[rows[move]] = dest[move, 0]
+            self.y[rows[move]] = dest[move, 1]
+
+    def plan_moves(self, rows):
+        """Returns where the Terrans at the supplied indices head for this
+           tick, and whether each of them can move there, without moving them."""
+        lattice = self.census.topology
+        coords = self.terran_coords[rows]
+        index = np.arange(len(rows))
+        cells = lattice.cells(coords[:, 0], coords[:, 1])
+        area = lattice.areas(cells)
+
+        # follow the sustenance and climate gradients
+        sustenance = self.terrain.sustenance
+        g_sust = lattice.gather(sustenance, area) - lattice.gather(sustenance, cells)[:, None]
+        g_cli = lattice.gather(self.gradient_c_mean, area) - lattice.gather(self.gradient_c_centre, cells)[:, None]
+        grad = (g_sust + g_cli) / 2
+        area = lattice.coords(area)
+        dest = area[index, np.argmax(grad, axis=1)].astype(float)
+
+        # seek out or avoid company
+        closest = self.get_closest_terrans(rows=rows)[0]
+        target = self.terran_coords[closest]
+        social = self.social[rows]
+        lonely = (closest >= 0) & (social < 0.2)
+        crowded = (closest >= 0) & (social > 0.8)
+        dest[lonely] = (dest[lonely] + util.paths(target[lonely], area[lonely])) / 2
+        dest[crowded] = (dest[crowded] + util.paths_away(target[crowded], area[crowded])) / 2
+
+        # flee storms
+        in_storm = np.flatnonzero(lattice.gather(self.weather.weathermap, cells) > 0)
+        storm = self.weather.get_closest_storms(coords[in_storm])[0]
+        in_storm, storm = in_storm[storm >= 0], storm[storm >= 0]
+        if len(storm) > 0:
+            dest[in_storm] = (dest[in_storm] + util.paths_away(self.weather.storm_pos[storm], area[in_storm])) / 2
+
+        dest = dest.astype(np.int32)
+
+        # only move if there's a spot near the destination that isn't occupied or below sea level
+        dest_area = lattice.areas(lattice.cells(dest[:, 0], dest[:, 1]))
+        free = ~lattice.gather(self.occupancy, dest_area) & lattice.gather(self.terrain.land, dest_area)
+        return dest, free.any(axis=1)
 
     def update(self):
         self.move_terrans()
@@ -0,0 +1,46 @@
+# An Ensemble must keep stepping its worlds exactly as Simulation does (see ensemble.py).
+
+import numpy as np
+import pytest
+
+import ensemble, simulation
+
+SIZE = 64
+PARAMS = {'delay': 0, 'num_terrans': 400, 'spawn_dist': 32, 'storm_chance': 0.2}
+
+def member_simulation(members, i):
+    """Returns the Simulation of world i of an ensemble."""
+    return simulation.Simulation(size=SIZE, points=members.points, seed=members.seeds[i], **PARAMS)
+
+def test_members_are_simulation_worlds():
+    members = ensemble.Ensemble(3, size=SIZE, seed=5, **PARAMS)
+    for i in range(3):
+        sim = member_simulation(members, i)
+        for name in ('heightmap', 'climates', 'vegetation', 'sustenance', 'land', 'fertile'):
+            np.testing.assert_array_equal(getattr(members, name)[i], getattr(sim.terrain, name), err_msg=name)
+
+def test_single_member_matches_simulation():
+    # a single member draws from its Generator in the same order as a
+    # Simulation, so starting it from the same state gives the same run
+    members = ensemble.Ensemble(1, size=SIZE, seed=7, **PARAMS)
+    sim = member_simulation(members, 0)
+    members.rng.bit_generator.state = sim.rng.bit_generator.state
+
+    peak = 0
+    for i in range(80):
+        sim.tick()
+        members.tick()
+        metrics = sim.metrics()
+        # means are summed in a different order, so only match to rounding
+        assert metrics == pytest.approx({name: values[0] for name, values in members.metrics().items()}), "tick %d" % i
+        peak = max(peak, metrics['population'])
+
+        pop = sim.pops[0]
+        for name in ('x', 'y', 'health', 'energy', 'social'):
+            np.testing.assert_array_equal(getattr(members, name), getattr(pop, name), err_msg="%s on tick %d" % (name, i))
+        np.testing.assert_array_equal(members.weathermap[0], sim.weather.weathermap)
+        np.testing.assert_array_equal(members.storm_pos, sim.weather.storm_pos)
+    np.testing.assert_array_equal(members.vegetation[0], sim.terrain.vegetation)
+    np.testing.assert_array_equal(members.sustenance[0], sim.terrain.sustenance)
+    # the run went through births, deaths and storms
+    assert peak > PARAMS['num_terrans']
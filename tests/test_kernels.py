@@ -0,0 +1,97 @@
+# The Numba and NumPy kernel backends must give identical results (see kernels.py).
+
+import numpy as np
+import pytest
+
+import kernels, simulation, util, world
+
+pytest.importorskip('numba')
+
+SIZE = 64
+N = 500
+
+@pytest.fixture
+def backend():
+    """Restores the kernel backend a test switches."""
+    before = kernels.BACKEND
+    yield kernels.use
+    kernels.use(before)
+
+def inputs(dtype=np.float64):
+    """Returns seeded random inputs for every kernel, with layers of dtype."""
+    rng = np.random.default_rng(0)
+    coords = rng.integers(0, SIZE, (N, 2))
+    return {'coords': coords, 'dests': rng.random((N, 2)) * SIZE, 'areas': util.get_areas(coords, SIZE),
+            'layer': rng.random((SIZE, SIZE)).astype(dtype), 'cells': rng.integers(0, SIZE * SIZE, N),
+            'weights': rng.random(N).astype(dtype), 'energy': rng.random(N) * 2,
+            'closest': rng.integers(0, N, N), 'candidates': rng.permutation(N)[:N // 2]}
+
+def nearest_cells(dtype):
+    data = inputs(dtype)
+    return kernels.paths(data['dests'], data['areas']), kernels.paths_away(data['dests'], data['areas'])
+
+def torus_dist(dtype):
+    data = inputs(dtype)
+    return kernels.torus_dist(data['coords'], data['dests'], SIZE)
+
+def consume(dtype):
+    data = inputs(dtype)
+    # repeat cells, so amounts accumulate
+    kernels.consume(data['layer'], data['coords'][:, 0] % 8, data['coords'][:, 1] % 8, 0.01)
+    return data['layer']
+
+def mate(dtype):
+    data = inputs(dtype)
+    out = np.empty(len(data['candidates']), dtype=np.int64)
+    n = kernels.mate(data['candidates'], data['closest'], data['energy'], 0.6, out)
+    return out[:n], data['energy']
+
+def stamp(dtype):
+    data = inputs(dtype)
+    stamp_x, stamp_y, stamp_w = world.gaussian_stamp(2)
+    return kernels.stamp(data['coords'][:, 0], data['coords'][:, 1], data['weights'], stamp_x, stamp_y, stamp_w,
+                         SIZE, data['cells'])
+
+def splat(dtype):
+    data = inputs(dtype)
+    touched = kernels.splat(data['layer'], data['cells'] % 97, data['weights'])
+    return data['layer'], touched
+
+CASES = {'nearest_cells': nearest_cells, 'torus_dist': torus_dist, 'consume': consume, 'mate': mate,
+         'stamp': stamp, 'splat': splat}
+
+def test_every_kernel_is_covered():
+    assert set(CASES) == set(kernels.LOOPS)
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_backends_match(name, dtype, backend):
+    results = {}
+    for which in ('numpy', 'numba'):
+        backend(which)
+        result = CASES[name](dtype)
+        results[which] = result if isinstance(result, tuple) else (result,)
+    for a, b in zip(results['numpy'], results['numba']):
+        assert a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+
+def test_simulation_matches(backend):
+    states = {}
+    for which in ('numpy', 'numba'):
+        backend(which)
+        sim = simulation.Simulation(size=SIZE, delay=0, species=[{'num_terrans': 400, 'spawn_dist': SIZE // 2}],
+                                    storm_chance=0.2, seed=3)
+        metrics = []
+        for i in range(60):
+            sim.tick()
+            metrics.append(sim.metrics())
+        pop = sim.pops[0]
+        states[which] = (metrics, {name: np.copy(getattr(pop, name)) for name in pop.columns},
+                         [np.copy(layer) for layer in (sim.terrain.vegetation, sim.terrain.sustenance, sim.weather.weathermap)])
+    metrics, columns, layers = states['numpy']
+    assert metrics[-1]['population'] > 0
+    assert metrics == states['numba'][0]
+    for name in columns:
+        np.testing.assert_array_equal(columns[name], states['numba'][1][name])
+    for a, b in zip(layers, states['numba'][2]):
+        np.testing.assert_array_equal(a, b)
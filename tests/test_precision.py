@@ -0,0 +1,50 @@
+# Every precision policy must leave the outcome of a run within tolerance of
+# float64 (see util.PRECISIONS and benchmark.py precision).
+
+import numpy as np
+import pytest
+
+import simulation, util
+
+SEEDS = range(3)
+TICKS = 50
+# every tick rounds each vegetation cell a few times (regrowth, grazing,
+# planting) at the precision of the policy, so the maps may drift apart by
+# a few float32 epsilons a tick; every other difference is a real divergence
+MAP_TOLERANCE = 4 * TICKS * np.finfo(np.float32).eps
+POPULATION_TOLERANCE = 0.02
+
+def run(precision, seed):
+    """Returns the population and the vegetation (as float64) after every
+       tick of a short seeded run."""
+    sim = simulation.Simulation(size=64, delay=5, num_terrans=200, spawn_dist=32, precision=precision, seed=seed)
+    population, vegetation = [], []
+    for i in range(TICKS):
+        sim.tick()
+        population.append(sim.metrics()['population'])
+        vegetation.append(sim.terrain.vegetation.astype(np.float64))
+    return np.array(population), np.array(vegetation)
+
+@pytest.fixture(scope='module')
+def reference():
+    return [run('float64', seed) for seed in SEEDS]
+
+@pytest.mark.parametrize('precision', [p for p in util.PRECISIONS if p != 'float64'])
+def test_outcomes_match_float64(precision, reference):
+    for seed, (reference_population, reference_vegetation) in zip(SEEDS, reference):
+        population, vegetation = run(precision, seed)
+        assert np.abs(vegetation - reference_vegetation).max() <= MAP_TOLERANCE
+        assert np.abs(population - reference_population).max() <= POPULATION_TOLERANCE * reference_population.max()
+
+@pytest.mark.parametrize('precision', list(util.PRECISIONS))
+def test_layer_dtypes(precision):
+    height, static, dynamic = util.layer_dtypes(precision)
+    sim = simulation.Simulation(size=32, precision=precision, seed=0)
+    assert sim.terrain.heightmap.dtype == height
+    assert sim.terrain.climates.dtype == static
+    assert sim.terrain.vegetation.dtype == dynamic
+    assert sim.weather.weathermap.dtype == dynamic
+
+def test_unknown_precision():
+    with pytest.raises(ValueError):
+        util.layer_dtypes('float8')
@@ -0,0 +1,70 @@
+# Tiled worlds (see tiles.py) must generate and run exactly as dense ones,
+# while only allocating the tiles that are used.
+
+import numpy as np
+import pytest
+
+import checkpoint, simulation, tiles
+
+PARAMS = dict(size=96, delay=10, species=[{'num_terrans': 500, 'spawn_dist': 30}], storm_chance=0.3, seed=7)
+TICKS = 30
+
+def tiled(store):
+    # the tiles don't divide the map evenly, and few stay in memory, so every layer is paged
+    return simulation.Simulation(tile=40, store=str(store), resident=3, **PARAMS)
+
+def assert_same_world(dense, sim):
+    for name in ('heightmap', 'climates', 'vegetation', 'sustenance', 'land', 'fertile'):
+        assert np.array_equal(getattr(dense.terrain, name), np.asarray(getattr(sim.terrain, name))), name
+    assert np.array_equal(dense.weather.weathermap, np.asarray(sim.weather.weathermap))
+    assert np.array_equal(dense.census.occupancy, np.asarray(sim.census.occupancy))
+    for dense_pop, pop in zip(dense.pops, sim.pops):
+        for name in ('id', 'x', 'y', 'energy', 'health', 'social'):
+            assert np.array_equal(getattr(dense_pop, name), getattr(pop, name)), name
+
+def test_tiled_run_matches_dense(tmp_path):
+    dense, sim = simulation.Simulation(**PARAMS), tiled(tmp_path)
+    assert isinstance(sim.terrain.vegetation, tiles.ChunkedLayer)
+    assert_same_world(dense, sim)
+    # fast-forward to the spawn, then tick
+    dense.run(PARAMS['delay'], fast=PARAMS['delay'])
+    sim.run(PARAMS['delay'], fast=PARAMS['delay'])
+    for i in range(TICKS):
+        dense.tick()
+        sim.tick()
+        assert dense.metrics() == sim.metrics()
+    assert_same_world(dense, sim)
+    for name in ('gradient_c_centre', 'gradient_c_mean'):
+        assert np.array_equal(getattr(dense.pops[0], name), np.asarray(getattr(sim.pops[0], name)))
+
+def test_checkpoint_resumes_tiled_run(tmp_path):
+    sim = tiled(tmp_path / 'store')
+    sim.run(PARAMS['delay'] + 10)
+    checkpoint.save(sim, tmp_path / 'checkpoint')
+    resumed = checkpoint.load(tmp_path / 'checkpoint')
+    assert isinstance(resumed.terrain.sustenance, tiles.ChunkedLayer)
+    for i in range(10):
+        sim.tick()
+        resumed.tick()
+    assert_same_world(sim, resumed)
+
+def test_layers_are_lazy():
+    sim = simulation.Simulation(size=256, delay=0, num_terrans=50, spawn_dist=4, storm_chance=0.0, seed=1, tile=32)
+    sim.run(5)
+    # the Terrans spawned in one spot, and there are no storms
+    assert len(sim.census.occupancy.keys()) < sim.census.occupancy.count**2 // 4
+    assert sim.weather.weathermap.keys() == []
+
+@pytest.mark.parametrize('wrap', [False, True])
+def test_smooth_matches_dense(wrap):
+    scipy_ndimage = pytest.importorskip('scipy.ndimage')
+    rng = np.random.default_rng(0)
+    dense = np.zeros((100, 100))
+    dense.flat[rng.choice(dense.size, 30)] = rng.random(30)
+    smoothed = tiles.smooth(tiles.ChunkedLayer.from_array(dense, chunk=16), 3, wrap=wrap)
+    assert np.array_equal(np.asarray(smoothed), scipy_ndimage.gaussian_filter(dense, 3, mode='wrap' if wrap else 'constant'))
+
+def test_choice_matches_dense():
+    mask = np.random.default_rng(0).random((50, 50)) < 0.1
+    drawn = tiles.choice(tiles.ChunkedLayer.from_array(mask, chunk=16), 200, np.random.default_rng(1))
+    assert np.array_equal(drawn, np.random.default_rng(1).choice(np.flatnonzero(mask), size=200))
@@ -0,0 +1,532 @@
+# Chunked storage of Terra^2 map layers, for worlds too large to hold as
+# single dense arrays.
+#
+# A ChunkedLayer splits a size x size layer into chunk x chunk tiles that
+# are only allocated when first written (unwritten tiles read as the fill
+# value) and, with a store directory, paged out to disk once more than a
+# set number are in memory. The simulation reads and writes layers by flat
+# cell index (see topology.py), which a ChunkedLayer groups by chunk, so
+# only the chunks around Terrans, storms and new vegetation are ever
+# touched during a run. Operations that need the neighbours of a tile,
+# like Gaussian smoothing and the climate gradient, read it with a halo of
+# cells borrowed from the surrounding tiles - wrapped around the map edges
+# or filled, to match scipy's 'wrap' and 'constant' modes - so tiled
+# results are identical to working on the whole map at once.
+#
+#     sim = Simulation(size=16384, tile=256, store='/scratch/terra', resident=512)
+
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+import kernels, util
+
+def chunks_near(points, radius, chunk, size):
+    """Returns the (K, 2) keys of every chunk within radius (in each axis)
+       of any of the supplied points, wrapping around the map edges.
+
+       Keyword arguments:
+       points -- an (N, 2) array of map coordinates.
+       radius -- the distance around each point to cover.
+       chunk -- the chunk size.
+       size -- the map size.
+       """
+    count = -(-size // chunk)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) == 0:
+        return np.zeros((0, 2), dtype=np.intp)
+    low = np.floor((points - radius) / chunk).astype(np.intp)
+    high = np.floor((points + radius) / chunk).astype(np.intp)
+    span = min(int((high - low).max()) + 1, count)
+    steps = np.arange(span)
+    kx = (low[:, 0, None] + steps)[:, :, None]
+    ky = (low[:, 1, None] + steps)[:, None, :]
+    valid = (kx <= high[:, 0, None, None]) & (ky <= high[:, 1, None, None])
+    kx, ky = np.broadcast_arrays(kx % count, ky % count)
+    keys = np.unique(kx[valid] * count + ky[valid])
+    return np.column_stack(np.divmod(keys, count))
+
+class ChunkedLayer:
+
+    def __init__(self, size, chunk=256, dtype=np.float64, fill=0.0, store=None, resident=None, name='layer'):
+        """A size x size map layer stored as lazily allocated chunks.
+
+           Keyword arguments:
+           size -- the size of the layer.
+           chunk -- the size of each (square) chunk.
+           dtype -- the dtype of the layer.
+           fill -- the value of cells in chunks that were never written.
+           store -- a directory cold chunks are paged out to (kept in memory if
+                    None). Each layer pages to a directory of its own inside
+                    it, which is removed along with the layer.
+           resident -- the most chunks kept in memory before the least
+                       recently used are paged out (unlimited if None).
+           name -- the name of the layer, which prefixes its directory in store.
+           """
+        self.size = size
+        self.chunk = chunk
+        self.dtype = np.dtype(dtype)
+        self.fill = self.dtype.type(fill).item()
+        self.count = -(-size // chunk)
+        self.store = store
+        self.resident = resident
+        self.name = name
+        self.chunks = collections.OrderedDict() # in least recently used order
+        self.paged = set()
+        # chunks still to be read from a checkpoint (see load_chunks)
+        self.source = None
+        self.sourced = set()
+        self.path = None
+        if store is not None:
+            os.makedirs(store, exist_ok=True)
+            self.path = tempfile.mkdtemp(prefix=name + '-', dir=store)
+            weakref.finalize(self, shutil.rmtree, self.path, True)
+        # threads may read a layer at once (see parallel.py); the LRU order is shared
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_array(cls, array, chunk=256, **kwargs):
+        """Returns a ChunkedLayer holding a copy of a dense square array."""
+        layer = cls(array.shape[0], chunk=chunk, dtype=array.dtype, **kwargs)
+        for key in layer.all_keys():
+            (x0, x1), (y0, y1) = layer.bounds(key)
+            layer.get_chunk(key)[:] = array[x0:x1, y0:y1]
+        return layer
+
+    def like(self, dtype=None, fill=None, name=None):
+        """Returns a new, empty layer of the same size, chunks and paging."""
+        return ChunkedLayer(self.size, self.chunk, self.dtype if dtype is None else dtype,
+                            self.fill if fill is None else fill, self.store, self.resident, name or self.name)
+
+    @property
+    def shape(self):
+        return (self.size, self.size)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def all_keys(self):
+        return [(i, j) for i in range(self.count) for j in range(self.count)]
+
+    def keys(self):
+        """The keys of every allocated chunk, in memory, paged out or still
+           in a checkpoint."""
+        with self._lock:
+            return sorted(set(self.chunks) | self.paged | self.sourced)
+
+    def bounds(self, key):
+        """Returns the ((x0, x1), (y0, y1)) map cells covered by a chunk."""
+        i, j = key
+        return ((i * self.chunk, min((i + 1) * self.chunk, self.size)),
+                (j * self.chunk, min((j + 1) * self.chunk, self.size)))
+
+    @property
+    def nbytes(self):
+        """The memory used by the chunks currently in memory."""
+        return sum(chunk.nbytes for chunk in list(self.chunks.values()))
+
+    def _path(self, key):
+        return os.path.join(self.path, '%d_%d.npy' % key)
+
+    def get_chunk(self, key, create=True):
+        """Returns the array of a chunk, loading it back from the store (or
+           the checkpoint it was loaded from) if it isn't in memory. A chunk
+           that was never written is allocated if create is set, and None is
+           returned otherwise."""
+        key = (int(key[0]), int(key[1]))
+        with self._lock:
+            if key in self.chunks:
+                self.chunks.move_to_end(key)
+                return self.chunks[key]
+            if key in self.paged:
+                array = np.load(self._path(key))
+                self.paged.discard(key)
+            elif key in self.sourced:
+                array = np.load(os.path.join(self.source, '%d_%d.npy' % key))
+                self.sourced.discard(key)
+            elif create:
+                (x0, x1), (y0, y1) = self.bounds(key)
+                array = np.full((x1 - x0, y1 - y0), self.fill, dtype=self.dtype)
+            else:
+                return None
+            self.chunks[key] = array
+            self.page_out()
+            return array
+
+    def set_chunk(self, key, array):
+        """Replaces a whole chunk with a (correctly shaped) array."""
+        key = (int(key[0]), int(key[1]))
+        with self._lock:
+            self.paged.discard(key)
+            self.sourced.discard(key)
+            self.chunks[key] = np.asarray(array, dtype=self.dtype)
+            self.chunks.move_to_end(key)
+            self.page_out()
+
+    def peek(self, key):
+        """Returns a chunk (None if it was never written) without bringing
+           it into memory: chunks that are paged out are memory-mapped."""
+        key = (int(key[0]), int(key[1]))
+        with self._lock:
+            if key in self.chunks:
+                return self.chunks[key]
+            if key in self.paged:
+                return np.load(self._path(key), mmap_mode='r')
+            if key in self.sourced:
+                return np.load(os.path.join(self.source, '%d_%d.npy' % key), mmap_mode='r')
+        return None
+
+    def page_out(self, keep=None):
+        """Writes the least recently used chunks to the store until at most
+           keep (by default, resident) chunks remain in memory."""
+        keep = self.resident if keep is None else keep
+        if self.path is None or keep is None:
+            return
+        with self._lock:
+            while len(self.chunks) > max(keep, 1):
+                key, array = self.chunks.popitem(last=False)
+                np.save(self._path(key), array)
+                self.paged.add(key)
+
+    def release(self, cells):
+        """Frees the chunks holding any of the supplied flat cells that hold
+           nothing but the fill value, e.g. after the storms or Terrans that
+           were there have left."""
+        with self._lock:
+            for key, group, cx, cy in self._group(cells):
+                if key in self.chunks and not np.any(self.chunks[key] != self.fill):
+                    del self.chunks[key]
+
+    def _runs(self, cells):
+        """Splits an array of map cells (or -1 for cells off the map) into
+           runs that fall within one chunk, as (chunk index, slice, offsets)."""
+        runs = []
+        start = 0
+        ids = np.where(cells < 0, -1, cells // self.chunk)
+        for end in np.append(np.flatnonzero(ids[1:] != ids[:-1]) + 1, len(cells)):
+            runs.append((ids[start], slice(start, end), cells[start:end] % self.chunk))
+            start = end
+        return runs
+
+    def _cells(self, start, length, wrap):
+        cells = np.arange(start, start + length)
+        if wrap:
+            return cells % self.size
+        return np.where((cells >= 0) & (cells < self.size), cells, -1)
+
+    def window(self, x0, y0, width, height, halo=0, wrap=True, cval=None):
+        """Returns a dense copy of the cells [x0, x0+width) x [y0, y0+height)
+           padded by halo cells on every side. Cells beyond the map edges
+           are wrapped around if wrap is set, and cval (by default the fill
+           value) otherwise."""
+        out = np.full((width + 2*halo, height + 2*halo), self.fill if cval is None else cval, dtype=self.dtype)
+        row_runs = self._runs(self._cells(x0 - halo, width + 2*halo, wrap))
+        col_runs = self._runs(self._cells(y0 - halo, height + 2*halo, wrap))
+        for i, rows, row_offsets in row_runs:
+            for j, cols, col_offsets in col_runs:
+                if i < 0 or j < 0:
+                    continue
+                chunk = self.get_chunk((i, j), create=False)
+                if chunk is not None:
+                    out[rows, cols] = chunk[np.ix_(row_offsets, col_offsets)]
+                else:
+                    out[rows, cols] = self.fill
+        return out
+
+    def write(self, x0, y0, array):
+        """Writes a dense array into the layer with its corner at (x0, y0).
+           Chunks that were never written are left unallocated where the
+           array only holds the fill value."""
+        for i, rows, row_offsets in self._runs(np.arange(x0, x0 + array.shape[0])):
+            for j, cols, col_offsets in self._runs(np.arange(y0, y0 + array.shape[1])):
+                part = array[rows, cols]
+                if self.peek((i, j)) is None and not np.any(part != self.fill):
+                    continue
+                self.get_chunk((i, j))[np.ix_(row_offsets, col_offsets)] = part
+
+    def assign_rows(self, rows, value):
+        """Sets every cell in a slice of rows of the layer to value."""
+        rows = range(self.size)[rows]
+        if len(rows) == 0:
+            return
+        start, stop = rows[0], rows[-1] + 1
+        for i in range(start // self.chunk, -(-stop // self.chunk)):
+            (x0, x1), (y0, y1) = self.bounds((i, 0))
+            for j in range(self.count):
+                self.get_chunk((i, j))[max(start, x0) - x0:min(stop, x1) - x0] = value
+
+    def _group(self, cells):
+        """Yields, for every chunk holding any of the supplied flat cells,
+           its key, the positions of those cells (within the flattened
+           cells) and their row and column within the chunk."""
+        x, y = np.divmod(np.asarray(cells, dtype=np.intp).reshape(-1), self.size)
+        keys = (x // self.chunk) * self.count + y // self.chunk
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else keys
+        for start, end in zip(starts, np.append(starts[1:], len(keys))):
+            group = order[start:end]
+            i, j = divmod(int(keys[start]), self.count)
+            yield (i, j), group, x[group] - i * self.chunk, y[group] - j * self.chunk
+
+    def take(self, cells):
+        """Returns the values of the layer at flat cell indices of any shape."""
+        out = np.full(np.shape(cells), self.fill, dtype=self.dtype)
+        flat = out.reshape(-1)
+        for key, group, cx, cy in self._group(cells):
+            chunk = self.get_chunk(key, create=False)
+            if chunk is not None:
+                flat[group] = chunk[cx, cy]
+        return out
+
+    def put(self, cells, values):
+        """Writes values into the layer at flat cell indices."""
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), np.shape(cells)).reshape(-1)
+        for key, group, cx, cy in self._group(cells):
+            if self.peek(key) is None and not np.any(values[group] != self.fill):
+                continue
+            self.get_chunk(key)[cx, cy] = values[group]
+
+    def splat(self, cells, weights):
+        """Adds weights to the flat cells of the layer, accumulating repeated
+           cells in order (see kernels.splat), and returns the sorted unique
+           cells that were touched."""
+        cells = np.asarray(cells, dtype=np.intp)
+        weights = np.asarray(weights)
+        for key, group, cx, cy in self._group(cells):
+            chunk = self.get_chunk(key)
+            kernels.splat(chunk, cx * chunk.shape[1] + cy, weights[group])
+        return np.unique(cells)
+
+    def consume(self, x, y, amount):
+        """Subtracts amount from the layer at every cell (x, y), once per
+           repeat (see kernels.consume)."""
+        cells = np.asarray(x, dtype=np.intp) * self.size + np.asarray(y, dtype=np.intp)
+        for key, group, cx, cy in self._group(cells):
+            kernels.consume(self.get_chunk(key), cx, cy, amount)
+
+    def __getitem__(self, index):
+        """Reads the cells (x, y) of the layer, for integer or integer array
+           coordinates, as a dense layer would."""
+        if not isinstance(index, tuple) or len(index) != 2:
+            raise TypeError("ChunkedLayer can only be indexed by (x, y) coordinates")
+        x, y = index
+        if np.ndim(x) == 0 and np.ndim(y) == 0:
+            x, y = int(x) % self.size, int(y) % self.size
+            chunk = self.get_chunk((x // self.chunk, y // self.chunk), create=False)
+            return self.dtype.type(self.fill) if chunk is None else chunk[x % self.chunk, y % self.chunk]
+        return self.take(np.asarray(x, dtype=np.intp) * self.size + np.asarray(y, dtype=np.intp))
+
+    def _reduce(self, func, chunk_func):
+        """Reduces every chunk with chunk_func, and the fill value too if any
+           chunk was never written, combining the results with func."""
+        keys = self.keys()
+        results = [chunk_func(self.peek(key)) for key in keys]
+        if len(keys) < self.count**2:
+            results.append(chunk_func(np.full((1, 1), self.fill, dtype=self.dtype)))
+        return func(results)
+
+    def min(self, axis=None, out=None, **kwargs):
+        return self.dtype.type(self._reduce(min, np.min))
+
+    def max(self, axis=None, out=None, **kwargs):
+        return self.dtype.type(self._reduce(max, np.max))
+
+    def sum(self, axis=None, dtype=None, out=None, **kwargs):
+        dtype = np.dtype(dtype or self.dtype)
+        total = sum(np.sum(self.peek(key), dtype=dtype) for key in self.keys())
+        unwritten = self.size**2 - sum(self.peek(key).size for key in self.keys())
+        return dtype.type(total + dtype.type(self.fill) * unwritten)
+
+    def count_where(self, predicate):
+        """Returns the number of cells whose value satisfies predicate, which
+           maps an array of values to booleans."""
+        keys = self.keys()
+        counted = sum(int(np.count_nonzero(predicate(self.peek(key)))) for key in keys)
+        unwritten = self.size**2 - sum(self.peek(key).size for key in keys)
+        if unwritten and predicate(np.full(1, self.fill, dtype=self.dtype))[0]:
+            counted += unwritten
+        return counted
+
+    def to_array(self, out=None):
+        """Returns the whole layer as a dense array (written into out if supplied)."""
+        if out is None:
+            out = np.full((self.size, self.size), self.fill, dtype=self.dtype)
+        for key in self.keys():
+            (x0, x1), (y0, y1) = self.bounds(key)
+            out[x0:x1, y0:y1] = self.peek(key)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def save(self, path):
+        """Writes the whole layer to a .npy file one chunk at a time, so it
+           never has to be held in memory at once."""
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(self.size, self.size))
+        out[:] = self.fill
+        self.to_array(out)
+        out.flush()
+        del out
+
+    def save_chunks(self, path):
+        """Writes every allocated chunk to a .npy file of its own in the
+           directory at path (see load_chunks)."""
+        os.makedirs(path)
+        for key in self.keys():
+            np.save(os.path.join(path, '%d_%d.npy' % key), self.peek(key))
+
+    def load_chunks(self, path):
+        """Makes the chunks saved by save_chunks in the directory at path the
+           chunks of this layer. Each is only read when first used."""
+        self.source = path
+        self.sourced = {tuple(int(k) for k in name[:-4].split('_'))
+                        for name in os.listdir(path) if name.endswith('.npy')}
+
+def smooth(layer, sigma, wrap=False, truncate=4.0, name=None):
+    """Gaussian-smooths a ChunkedLayer tile by tile, exchanging a halo of
+       neighbouring cells so the result is identical to scipy's
+       gaussian_filter over the whole map (in 'wrap' or 'constant' mode,
+       with cells beyond the map edges 0). Returns a new layer.
+
+       While layer's fill value is 0, only the chunks within reach of an
+       allocated chunk are smoothed (the rest stay 0); otherwise all are.
+
+       Keyword arguments:
+       layer -- the layer to smooth.
+       sigma -- the smoothing factor.
+       wrap -- whether the map wraps around its edges.
+       truncate -- the kernel radius, in standard deviations.
+       name -- the name of the new layer.
+       """
+    halo = int(truncate * float(sigma) + 0.5)
+    if layer.fill == 0:
+        out = layer.like(name=name, fill=0)
+        allocated = np.array(layer.keys(), dtype=float).reshape(-1, 2) * layer.chunk + layer.chunk / 2
+        keys = chunks_near(allocated, halo + layer.chunk / 2, layer.chunk, layer.size)
+    else:
+        out = layer.like(name=name)
+        keys = layer.all_keys()
+
+    # SciPy is only loaded once a map is first smoothed
+    import scipy.ndimage
+    for key in keys:
+        (x0, x1), (y0, y1) = layer.bounds(key)
+        tile = layer.window(x0, y0, x1 - x0, y1 - y0, halo=halo, wrap=wrap, cval=0)
+        tile = scipy.ndimage.gaussian_filter(tile, sigma, mode='constant', truncate=truncate)
+        out.write(x0, y0, tile[halo:halo + x1 - x0, halo:halo + y1 - y0])
+    return out
+
+def apply(func, *layers, dtype=None, name=None):
+    """Returns a new layer holding func applied chunk by chunk to the
+       matching chunks of the supplied layers (which must share their
+       chunks), e.g. apply(lambda h: h > 0.5, heightmap, dtype=bool). func
+       must work cell by cell. Chunks where func gives the new fill value
+       (func of the fill values) are left unallocated. Dense layers are
+       simply passed to func."""
+    first = layers[0]
+    if not isinstance(first, ChunkedLayer):
+        result = func(*layers)
+        return result if dtype is None else result.astype(dtype, copy=False)
+    fills = [np.full((1, 1), layer.fill, dtype=layer.dtype) for layer in layers]
+    fill = func(*fills)
+    out = first.like(dtype=dtype or fill.dtype, fill=fill[0, 0], name=name)
+    keys = sorted(set().union(*(layer.keys() for layer in layers)))
+    for key in keys:
+        (x0, x1), (y0, y1) = first.bounds(key)
+        arrays = [layer.peek(key) for layer in layers]
+        arrays = [np.full((x1 - x0, y1 - y0), layer.fill, dtype=layer.dtype) if array is None else array
+                  for layer, array in zip(layers, arrays)]
+        result = np.asarray(func(*arrays), dtype=out.dtype)
+        if np.any(result != out.fill):
+            out.set_chunk(key, result.copy() if any(result is array for array in arrays) else result)
+    return out
+
+def normalize(layer, bounds=(0, 1), name=None):
+    """Returns a layer normalized to bounds over its whole range, as
+       util.normalize does for a dense map."""
+    dmin, dmax = layer.min(), layer.max()
+    return apply(lambda values: util.normalize(values, dmin, dmax, bounds), layer, name=name or layer.name)
+
+def choice(mask, n, rng):
+    """Draws n flat cells, with replacement, from the cells where the boolean
+       layer mask is set, exactly as rng.choice(np.flatnonzero(dense), n)
+       would for the dense mask. Returns no cells (and draws nothing) if no
+       cell is set."""
+    size, chunk = mask.size, mask.chunk
+    per_row = np.zeros(size, dtype=np.int64)
+    for key in mask.all_keys():
+        (x0, x1), (y0, y1) = mask.bounds(key)
+        values = mask.peek(key)
+        per_row[x0:x1] += (y1 - y0) * int(bool(mask.fill)) if values is None else np.count_nonzero(values, axis=1)
+    ends = np.cumsum(per_row)
+    if len(ends) == 0 or ends[-1] == 0:
+        return np.zeros(0, dtype=np.intp)
+
+    # the index of each draw among the set cells, in row-major order
+    drawn = rng.choice(int(ends[-1]), size=n)
+    rows = np.searchsorted(ends, drawn, side='right')
+    ranks = drawn - (ends[rows] - per_row[rows])
+    cells = np.empty(n, dtype=np.intp)
+    for band in np.unique(rows // chunk):
+        x0 = band * chunk
+        block = mask.window(x0, 0, min(chunk, size - x0), size)
+        for row in np.unique(rows[rows // chunk == band]):
+            these = np.flatnonzero(rows == row)
+            cells[these] = row * size + np.flatnonzero(block[row - x0])[ranks[these]]
+    return cells
+
+def flatnonzero(layer):
+    """np.flatnonzero for a dense or chunked layer: the sorted flat cells
+       where it is set."""
+    if not isinstance(layer, ChunkedLayer):
+        return np.flatnonzero(layer)
+    if layer.fill:
+        return np.flatnonzero(layer.to_array())
+    cells = []
+    for key in layer.keys():
+        (x0, x1), (y0, y1) = layer.bounds(key)
+        x, y = np.nonzero(layer.peek(key))
+        cells.append((x + x0) * layer.size + (y + y0))
+    return np.sort(np.concatenate(cells)) if cells else np.zeros(0, dtype=np.intp)
+
+def astype(layer, dtype):
+    """Returns a dense or chunked layer at the supplied dtype (itself if it
+       already is)."""
+    if layer.dtype == dtype:
+        return layer
+    if isinstance(layer, ChunkedLayer):
+        return apply(lambda values: values.astype(dtype), layer, dtype=dtype)
+    return layer.astype(dtype)
+
+def splat(layer, cells, weights):
+    """kernels.splat for a dense or chunked layer."""
+    if isinstance(layer, ChunkedLayer):
+        return layer.splat(cells, weights)
+    return kernels.splat(layer, cells, weights)
+
+def consume(layer, x, y, amount):
+    """kernels.consume for a dense or chunked layer."""
+    if isinstance(layer, ChunkedLayer):
+        layer.consume(x, y, amount)
+    else:
+        kernels.consume(layer, x, y, amount)
+
+def count(layer, predicate):
+    """Returns the number of cells of a dense or chunked layer whose value
+       satisfies predicate (see ChunkedLayer.count_where)."""
+    if isinstance(layer, ChunkedLayer):
+        return layer.count_where(predicate)
+    return int(np.count_nonzero(predicate(layer)))
+
+def release(layer, cells):
+    """ChunkedLayer.release, for a dense or chunked layer (a no-op if dense)."""
+    if isinstance(layer, ChunkedLayer):
+        layer.release(cells)
@@ -0,0 +1,82 @@
+# The toroidal lattice the Terra^2 map lives on.
+#
+# Everything that looks at the 3x3 area around a cell (gradients, Terran
+# movement, occupancy and terrain checks) goes through the Topology of its
+# map size. Cells are addressed by their flat index x * size + y, so reading
+# a layer over the areas of a batch of cells is a single gather. The wrapped
+# neighbour indices are computed for each batch (of Terrans, or of rows of
+# the map), so no per-cell table is ever held. Layers may be dense arrays
+# or tiled (see tiles.py); gather and scatter read and write either.
+
+import numpy as np
+
+import tiles
+
+# offsets of the cells of a 3x3 area, in the order areas (and util.get_area) list them
+OFFSETS = np.array([[-1, -1], [0, -1], [1, -1],
+                    [-1, 0], [0, 0], [1, 0],
+                    [-1, 1], [0, 1], [1, 1]], dtype=np.int64)
+
+class Topology:
+
+    def __init__(self, size):
+        """The neighbourhoods of a square map of the supplied size that wraps
+           around at its edges. Use lattice(size) to share one per size."""
+        self.size = size
+        # the wrapped index of every row and column from -1 to size, the
+        # rows premultiplied into flat offsets (a few KB, not a per-cell table)
+        line = np.arange(-1, size + 1) % size
+        self._rows = line * size
+        self._cols = line
+
+    def cells(self, x, y):
+        """Returns the flat indices of the cells (x, y)."""
+        return np.asarray(x, dtype=np.intp) * self.size + np.asarray(y, dtype=np.intp)
+
+    def coords(self, cells):
+        """Returns the (x, y) coordinates of flat cell indices, in a new last axis."""
+        x, y = np.divmod(np.asarray(cells, dtype=np.intp), self.size)
+        return np.stack((x, y), axis=-1)
+
+    def areas(self, cells):
+        """Returns the flat indices of the 3x3 areas around the supplied
+           cells, with a new last axis of 9."""
+        x, y = np.divmod(np.asarray(cells, dtype=np.intp)[..., None], self.size)
+        return self._rows[x + (OFFSETS[:, 0] + 1)] + self._cols[y + (OFFSETS[:, 1] + 1)]
+
+    def gather(self, layer, cells):
+        """Returns the values of a (size, size) layer at flat cell indices of
+           any shape (e.g. the (N, 9) areas)."""
+        if isinstance(layer, tiles.ChunkedLayer):
+            return layer.take(cells)
+        return np.ravel(layer)[cells]
+
+    def scatter(self, layer, cells, values):
+        """Writes values into a (size, size) layer at flat cell indices."""
+        if isinstance(layer, tiles.ChunkedLayer):
+            layer.put(cells, values)
+        else:
+            layer.reshape(-1)[cells] = values
+
+    def gradient(self, layer, rows=None):
+        """Returns, for every cell of layer (of a selection of rows only, if
+           supplied), the difference between each cell of its 3x3 area and
+           itself, as a (rows, size, 9) array."""
+        size = self.size
+        rows = np.arange(size) if rows is None else np.asarray(rows)
+        layer = np.asarray(layer, dtype=np.float64)
+        centre = layer[rows]
+        gradient = np.empty((len(rows), size, 9))
+        for z, (dx, dy) in enumerate(OFFSETS):
+            # the rows, shifted so each cell lines up with its neighbour
+            np.subtract(np.roll(layer[(rows + dx) % size], -dy, axis=1), centre, out=gradient[:, :, z])
+        return gradient
+
+_lattices = {}
+
+def lattice(size):
+    """Returns the Topology of a map of the supplied size, creating it only
+       the first time."""
+    if size not in _lattices:
+        _lattices[size] = Topology(size)
+    return _lattices[size]
@@ -1,9 +1,10 @@
 # Common utilities class for the Terra^2 simulation.
 # Ethan Block, 9-3-2018
 
-from numba import jit
 import numpy as np
 
+import kernels, topology
+
 # abstract Struct class
 class Struct:
     def __init__ (self, *argv, **argd):
@@ -27,12 +28,27 @@ def normalize(x, dmin=None, dmax=None, bounds=(0, 1)):
 def denormalize(x, dmin, dmax, bounds=(0, 1)):
     return ((x - bounds[0]) * (dmax-dmin)/(bounds[1]-bounds[0]))+dmin
 
+# the dtypes map layers are stored in under each precision policy, as
+# (the heightmap, the other layers that never change once generated - the
+# climates and climate gradients - and the layers updated every tick).
+# 'quantized' stores the heightmap as half floats: the simulation only reads
+# it through the land mask, which is computed before it is quantized.
+# Terrans steer by small climate differences, which half floats lose.
+PRECISIONS = {'float64': (np.float64, np.float64, np.float64),
+              'float32': (np.float32, np.float32, np.float32),
+              'quantized': (np.float16, np.float32, np.float32)}
+
+def layer_dtypes(precision):
+    """Returns the (heightmap, static, dynamic) layer dtypes of a precision policy."""
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision %r, expected one of %s" % (precision, ", ".join(PRECISIONS)))
+    return PRECISIONS[precision]
+
 def mask(to_mask, threshold):
     if(np.max(to_mask) > threshold):
         to_mask = np.ma.masked_where(to_mask < threshold, to_mask)
     return to_mask
 
-@jit
 def get_area(coords, size):
     """Returns a 3x3 area around the supplied coordinates.
 
@@ -40,39 +56,33 @@ def get_area(coords, size):
        coords -- the coordinates to calculate the area around.
        size -- the size of the terrain map (for wrapping).
        """
+    return get_areas([coords], size)[0].tolist()
 
-    area = [[coords[0]-1, coords[1]-1], [coords[0], coords[1]-1], [coords[0]+1, coords[1]-1],
-            [coords[0]-1, coords[1]], [coords[0], coords[1]], [coords[0]+1, coords[1]],
-            [coords[0]-1, coords[1]+1], [coords[0], coords[1]+1], [coords[0]+1, coords[1]+1]]
+def get_areas(coords, size):
+    """Returns the 3x3 areas around each of the supplied coordinates as an
+       (N, 9, 2) array, ordered and wrapped exactly as get_area does.
 
-    # wrap area around map
-    for i in range(len(area)):
-        for j in range(2):
-            if area[i][j] < 0:
-                area[i][j] = size - area[i][j]
-            if area[i][j] >= size:
-                area[i][j] = area[i][j] - size
-
-    return area
+       Keyword arguments:
+       coords -- an (N, 2) array of coordinates to calculate the areas around.
+       size -- the size of the terrain map (for wrapping).
+       """
+    lattice = topology.lattice(size)
+    coords = np.asarray(coords).reshape(-1, 2)
+    return lattice.coords(lattice.areas(lattice.cells(coords[:, 0], coords[:, 1])))
 
-@jit
-def get_gradient(inmap):
-    """Returns a 3D map describing the gradient of the input map.
+def get_gradient(inmap, rows=None):
+    """Returns a 3D map describing the gradient of the input map: for every
+       cell, the difference between each cell of its 3x3 area (as ordered
+       and wrapped by get_area) and itself.
 
        Keyword arguments:
        inmap -- the map to create a gradient from.
+       rows -- if supplied, a slice of the rows to return the gradient of.
        """
+    if rows is not None:
+        rows = np.arange(inmap.shape[0])[rows]
+    return topology.lattice(inmap.shape[0]).gradient(inmap, rows)
 
-    size = inmap.shape[0]
-    gradient = np.zeros((size, size, 9))
-    for x in range(size):
-        for y in range(size):
-            area = get_area((x, y), size)
-            for z in range(9):
-                gradient[x, y, z] = ((inmap[area[z][0], area[z][1]]-inmap[x,y]))
-    return gradient
-
-@jit
 def path(dest, area):
     best = 99999
     best_index = -1
@@ -85,7 +95,6 @@ def path(dest, area):
 
     return area[best_index]
 
-@jit
 def path_away(ndest, area):
     best = 0
     best_index = -1
@@ -98,7 +107,16 @@ def path_away(ndest, area):
 
     return area[best_index]
 
-@jit
+def paths(dests, areas):
+    """Vectorized path - returns, for every row, the cell of the (N, 9, 2)
+       areas closest to the matching row of the (N, 2) destinations."""
+    return kernels.paths(dests, areas)
+
+def paths_away(ndests, areas):
+    """Vectorized path_away - returns, for every row, the cell of the (N, 9, 2)
+       areas furthest from the matching row of the (N, 2) destinations."""
+    return kernels.paths_away(ndests, areas)
+
 def shift(arr, num, fill_value=np.nan):
     result = np.empty_like(arr)
     if num > 0:
@@ -111,7 +129,6 @@ def shift(arr, num, fill_value=np.nan):
         result = arr
     return result
 
-#@jit DEBUG: was causing crashes cause of JIT
 def eudist(v1, v2):
     if not len(v1) == len(v2):
         raise Exception("Inequal vector lengths")
@@ -2,37 +2,61 @@
 # Ethan Block, 9-3-2018
 
 import numpy as np
-import scipy as sp
-import scipy.ndimage
 
-from numba import jit
-import random
-import util
+import kernels, parallel, util, spatial, tiles, topology, worldcache
 
-@jit
-def proc_gen(size, points, sigma):
+def proc_gen(size, points, sigma, rng=None, like=None):
     """Generate a square map of smoothed random points.
 
        Keyword arguments:
        size -- the size of the map (final map will be size squared)
        points -- the number of maximum points on the map. The higher this is, the higher the average value will be.
        sigma -- factor that determines how much the points are smoothed.
+       rng -- the numpy random Generator to draw from (a fresh one if None).
+       like -- if supplied, a tiles.ChunkedLayer the map is generated like,
+               tile by tile (see tiles.py), instead of as a dense array.
        """
+    if rng is None:
+        rng = np.random.default_rng()
+    gpoints = rng.choice(size * size, size=int(points))
+    if like is not None:
+        generated = like.like(dtype=np.float64, fill=0.0)
+        generated.put(gpoints, 1.0)
+        return tiles.normalize(proc_smooth(generated, sigma))
     generated = np.zeros((size, size))
-    gpoints = np.random.choice(range(0, size * size), size=int(points))
     for i in gpoints:
         generated[int(i / size), int(i % size)] = 1.0
     generated = proc_smooth(generated, sigma)
     generated = util.normalize(generated)
     return generated
 
-@jit
 def proc_smooth(map1, sigma):
-    generated = sp.ndimage.filters.gaussian_filter(map1, [sigma, sigma], mode='constant')
+    if isinstance(map1, tiles.ChunkedLayer):
+        return tiles.smooth(map1, sigma)
+    # SciPy is only loaded once a map is first smoothed
+    from scipy import ndimage
+    generated = ndimage.gaussian_filter(map1, [sigma, sigma], mode='constant')
     return generated
 
-@jit
+def gaussian_stamp(sigma, truncate=4.0):
+    """Returns the x offsets, y offsets and weights of the 2D Gaussian kernel
+       that proc_smooth applies, so that smoothing a map of isolated points
+       can be done by stamping the kernel at each point instead.
+
+       Keyword arguments:
+       sigma -- the smoothing factor.
+       truncate -- the kernel radius, in standard deviations (as in SciPy).
+       """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / float(sigma)**2 * x**2)
+    kernel /= kernel.sum()
+    dx, dy = np.meshgrid(x, x, indexing='ij')
+    return dx.ravel(), dy.ravel(), np.outer(kernel, kernel).ravel()
+
 def proc_filter(map1, map2, threshold):
+    if isinstance(map1, tiles.ChunkedLayer):
+        return tiles.apply(lambda a, b: proc_filter(a.copy(), b, threshold), map1, map2)
     if type(threshold) == tuple:
         map1[np.where(map2 < threshold[0])] = 0.0
         map1[np.where(map2 > threshold[1])] = 0.0
@@ -40,10 +64,38 @@ def proc_filter(map1, map2, threshold):
         map1[np.where(map2 <= threshold)] = 0.0
     return map1
 
+def generate_layers(size, points, sigma, num_climates, v_bounds, rng, like=None):
+    """Generates the layers of a terrain that never change once made: the
+       heightmap and the climates.
+
+       Keyword arguments:
+       size, points, sigma, num_climates, v_bounds -- as for Terrain.
+       rng -- the numpy random Generator to draw from.
+       like -- if supplied, a tiles.ChunkedLayer to generate the layers like (see proc_gen).
+       """
+    # generate the heightmap
+    heightmap = proc_gen(size, points, sigma, rng, like)
+
+    if like is not None:
+        climates = tiles.apply(lambda c: c*4, proc_gen(size, num_climates, sigma, rng, like))
+        climates.assign_rows(slice(0, int(size/4)), 0.0)
+        climates.assign_rows(slice(-int(size/4), -1), 0.0)
+        climates = tiles.normalize(proc_smooth(climates, sigma*4), bounds=(v_bounds[0]*0.75, v_bounds[1]*1.25))
+        return {'heightmap': heightmap, 'climates': climates}
+
+    climates = proc_gen(size, num_climates, sigma, rng)*4
+
+    # here we set the polar regions to freezing
+    climates[0:int(size/4)] = 0.0
+    climates[-int(size/4):-1] = 0.0
+    climates = proc_smooth(climates, sigma*4)
+    climates = util.normalize(climates, bounds=(v_bounds[0]*0.75, v_bounds[1]*1.25))
+    return {'heightmap': heightmap, 'climates': climates}
+
 class Terrain:
 
     def __init__(self, size, points=None, sigma=4, num_climates=10, v_sparsity=0.02, v_bounds=(0.2, 0.8), water_level=0.5,
-                 s_rate=0.05):
+                 s_rate=0.05, chunk=64, precision='float64', rng=None, cache=None, seed=None, tile=None, store=None, resident=None):
         """A terrain object, which contains all information about the simulated world.
 
            Keyword arguments:
@@ -55,72 +107,214 @@ class Terrain:
            v_bounds -- the minimum and maximum climate values (temperatures) that vegetation can grow in.
            water_level -- the level of water on the map.
            s_rate -- the rate at which consumed vegetation (sustenance) is regrown.
+           chunk -- the size of the chunks sustenance regrowth is tracked in. Only
+                    chunks where vegetation grew or was eaten are updated.
+           precision -- the precision policy of the map layers (see util.PRECISIONS).
+           rng -- the numpy random Generator driving generation and growth (a fresh one if None).
+           cache -- an optional WorldCache to load the generated layers from (or save them to).
+           seed -- the seed rng was made from, which identifies the generated layers in the cache.
+           tile -- if supplied, every layer is stored as tile x tile chunks that
+                   are only allocated when first written (see tiles.py), and
+                   regrowth is tracked in the same chunks. Tiled worlds are
+                   generated tile by tile and never use the cache.
+           store -- with tile, a directory cold chunks are paged out to.
+           resident -- with store, the most chunks of each layer kept in memory.
            """
 
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
+
         self.size = size
         self.sigma = sigma
         self.v_sparsity = v_sparsity
         self.v_bounds = v_bounds
         self.water_level = water_level
         self.s_rate = s_rate
+        self.chunk = chunk if tile is None else tile
+        self.tile = tile
+        self.precision = precision
+        height, static, dynamic = util.layer_dtypes(precision)
 
         if points is None:
-            points = random.randint(size*10, size*20)
+            points = int(rng.integers(size*10, size*20, endpoint=True))
 
         self.points = points
 
-        # generate the heightmap
-        heightmap = proc_gen(size, points, sigma)
-        self.heightmap = heightmap
-
-        climates = proc_gen(size, num_climates, sigma)*4
+        like = None if tile is None else tiles.ChunkedLayer(size, tile, store=store, resident=resident)
 
-        # here we set the polar regions to freezing
-        climates[0:int(size/4)] = 0.0
-        climates[-int(size/4):-1] = 0.0
-        climates = proc_smooth(climates, sigma*4)
-        climates = util.normalize(climates, bounds=(v_bounds[0]*0.75, v_bounds[1]*1.25))
-        self.climates = climates
-        self.gradient_c = util.get_gradient(climates)
+        def generate():
+            return generate_layers(size, points, sigma, num_climates, v_bounds, rng, like)
 
-        # spawn vegetation seeds across the map, but not in water or unsuitable climates
-
-        vegetation = np.zeros((size, size))
+        self.cache_key = None
+        if cache is not None and worldcache.seed_key(seed) is not None and tile is None:
+            self.cache_key = cache.key(size=size, points=points, sigma=sigma, num_climates=num_climates,
+                                       v_bounds=v_bounds, seed=worldcache.seed_key(seed))
+            layers = cache.fetch(self.cache_key, generate, rng)
+        else:
+            layers = generate()
 
-        for i in range(int(points * v_sparsity)):
-            veg_seed = (0, 0)
+        # layers are generated (and cached) in float64 and only stored at
+        # a lower precision, so every policy sees the same world
+        heightmap = layers['heightmap']
+        climates = layers['climates']
+        self.heightmap = tiles.astype(heightmap, height)
+        self.climates = tiles.astype(climates, static)
 
-            while (climates[veg_seed] < v_bounds[0] or
-                   climates[veg_seed] > v_bounds[1] or
-                   heightmap[veg_seed] < water_level):
-                   veg_seed = (random.randint(0, size-1), random.randint(0, size-1))
-
-            vegetation[veg_seed] = 1.0
+        # spawn vegetation seeds across the map, but not in water or unsuitable climates
+        if like is None:
+            vegetation = np.zeros((size, size))
+
+            suitable = np.flatnonzero((climates >= v_bounds[0]) & (climates <= v_bounds[1]) & (heightmap >= water_level))
+            if len(suitable) > 0:
+                vegetation.flat[rng.choice(suitable, size=int(points * v_sparsity))] = 1.0
+        else:
+            # the same draws as the dense seeds, from the suitable cells in the same order
+            suitable = tiles.apply(lambda c, h: (c >= v_bounds[0]) & (c <= v_bounds[1]) & (h >= water_level), climates, heightmap)
+            vegetation = like.like(fill=0.0)
+            vegetation.put(tiles.choice(suitable, int(points * v_sparsity), rng), 1.0)
 
         vegetation = proc_smooth(vegetation, sigma/2)
-        self.vegetation = proc_filter(vegetation, heightmap, water_level)
-        self.sustenance = np.copy(vegetation) # we want changes to the vegetation to affect sustenance map
-
-    def update(self):
+        self.vegetation = tiles.astype(proc_filter(vegetation, heightmap, water_level), dynamic)
+        # we want changes to the vegetation to affect sustenance map
+        self.sustenance = np.copy(self.vegetation) if like is None else tiles.apply(np.copy, self.vegetation)
+
+        # the climates and heightmap never change, so neither does where vegetation can take root
+        if like is None:
+            self.land = heightmap > water_level
+            self.fertile = (climates >= v_bounds[0]) & (climates <= v_bounds[1]) & (heightmap > water_level+0.2)
+        else:
+            self.land = tiles.apply(lambda h: h > water_level, heightmap)
+            self.fertile = tiles.apply(lambda c, h: (c >= v_bounds[0]) & (c <= v_bounds[1]) & (h > water_level+0.2),
+                                       climates, heightmap)
+        self.stamp_x, self.stamp_y, self.stamp_w = gaussian_stamp(sigma/2)
+
+        # the chunks where sustenance may be below vegetation, and so regrow
+        chunk = self.chunk
+        count = -(-size // chunk)
+        self.active = np.zeros((count, count), dtype=bool)
+        self._regrow = np.zeros((chunk, chunk), dtype=bool)
+        self._below = np.zeros((chunk, chunk), dtype=bool)
+
+    @property
+    def gradient_c(self):
+        """The gradient of the climates (see util.get_gradient). Nothing in
+           the simulation reads it, so it is computed on demand rather than
+           kept alongside the climates."""
+        return util.get_gradient(np.asarray(self.climates, dtype=np.float64))
+
+    @property
+    def lattice(self):
+        """The (shared) Topology of the map, through which layers are read
+           and written by flat cell index whether they are dense or tiled."""
+        return topology.lattice(self.size)
+
+    def coverage(self, threshold):
+        """Returns the fraction of the map covered by vegetation above threshold."""
+        return tiles.count(self.vegetation, lambda values: values > threshold) / self.size**2
+
+    def touch(self, x, y):
+        """Marks the chunks holding the cells (x, y) as needing regrowth,
+           after the vegetation or sustenance there changed."""
+        self.active[np.asarray(x) // self.chunk, np.asarray(y) // self.chunk] = True
+
+    def update(self, threads=None):
         """Master update function for the terrain map."""
-        self.grow_vegetation()
-
-    def grow_vegetation(self):
-        """Grow vegetation on the terrain map."""
-        new_vegetation = proc_gen(self.size, int(self.points*self.v_sparsity), 0)
-        new_vegetation = proc_filter(new_vegetation, self.climates, self.v_bounds)
-        new_vegetation = proc_filter(new_vegetation, self.heightmap, self.water_level+0.2)
-        new_vegetation = proc_smooth(new_vegetation, self.sigma/2)
-        new_vegetation = proc_filter(new_vegetation, self.heightmap, self.water_level)
-        self.vegetation += new_vegetation
-        self.vegetation[np.where(self.vegetation > 1.0)] = 1.0
-
-        # regrow consumed vegetation
-        self.sustenance[np.where((self.sustenance > 0.1) & (self.sustenance < self.vegetation))] += self.s_rate
+        self.grow_vegetation(threads)
+
+    def grow_vegetation(self, threads=None):
+        """Grow vegetation on the terrain map. Seeds land at random but only
+           take root on fertile ground, where they spread out as a Gaussian
+           stamp (the same as smoothing the seed map by sigma/2). Only the
+           cells around new seeds are touched. With threads, sustenance
+           regrows band by band (see regrow)."""
+        size = self.size
+        seeds = self.rng.choice(size * size, size=int(self.points*self.v_sparsity))
+        seeds = np.unique(seeds[self.lattice.gather(self.fertile, seeds)])
+        self.plant(seeds)
+        self.regrow(threads=threads)
+
+    def fast_forward(self, ticks):
+        """Advances the terrain by ticks steps at once. The seeds of every
+           step are drawn together and stamped in one pass, and sustenance
+           regrowth is applied in closed form. This matches ticks calls to
+           update in distribution (not draw for draw), except that
+           sustenance regrows towards the vegetation at the end of the
+           period rather than as it grows."""
+        size = self.size
+        seeds = self.rng.choice(size * size, size=(ticks, int(self.points*self.v_sparsity)))
+        fertile = self.lattice.gather(self.fertile, seeds)
+        steps = np.broadcast_to(np.arange(ticks)[:, None], seeds.shape)
+        # seeds are unique within a step, but may land on the same cell in different steps
+        self.plant(np.unique(steps[fertile] * size**2 + seeds[fertile]) % size**2)
+        self.regrow(ticks)
+
+    def plant(self, seeds):
+        """Stamps vegetation around the supplied (flat) map cells, once per
+           repeat, where it is on land, and caps it at 1."""
+        size = self.size
+        if len(seeds) > 0:
+            sx, sy = np.divmod(seeds, size)
+            cells, weights = kernels.stamp(sx, sy, np.ones(len(seeds)), self.stamp_x, self.stamp_y, self.stamp_w, size)
+            lattice = self.lattice
+            on_land = lattice.gather(self.land, cells)
+
+            cells = tiles.splat(self.vegetation, cells[on_land], weights[on_land])
+            lattice.scatter(self.vegetation, cells, np.minimum(lattice.gather(self.vegetation, cells), 1.0))
+            self.touch(*np.divmod(cells, size))
+
+    def regrow(self, ticks=1, threads=None):
+        """Regrows consumed vegetation (sustenance) by s_rate per step for
+           ticks steps, wherever it is above 0.1 and below the vegetation.
+           With threads, the chunks are split into bands of chunk rows (see
+           parallel.py) that regrow on a thread pool. Tiled layers page
+           chunks in and out as they go, so they always regrow serially."""
+        # regrow chunk by chunk; a chunk is left alone once nothing in it
+        # regrows, until it is touched again
+        chunks = np.argwhere(self.active)
+        if not threads or self.tile is not None:
+            self.regrow_chunks(chunks, ticks, self._regrow, self._below)
+            return
+        parts = parallel.partition(chunks[:, 0], len(self.active), threads)
+        parallel.run(lambda part: self.regrow_chunks(chunks[part], ticks), parts, threads)
+
+    def regrow_chunks(self, chunks, ticks=1, regrow=None, below=None):
+        """Regrows the supplied (i, j) chunks (see regrow), using the supplied
+           chunk-sized boolean scratch buffers or new ones."""
+        chunk = self.chunk
+        if regrow is None:
+            regrow = np.zeros((chunk, chunk), dtype=bool)
+            below = np.zeros((chunk, chunk), dtype=bool)
+        for i, j in chunks:
+            if self.tile is not None:
+                # the regrowth chunks are the tiles; one never written holds no sustenance to regrow
+                sustenance = self.sustenance.get_chunk((i, j), create=False)
+                vegetation = self.vegetation.get_chunk((i, j), create=False)
+                if sustenance is None or vegetation is None:
+                    self.active[i, j] = False
+                    continue
+            else:
+                rows, cols = slice(i*chunk, (i + 1)*chunk), slice(j*chunk, (j + 1)*chunk)
+                sustenance = self.sustenance[rows, cols]
+                vegetation = self.vegetation[rows, cols]
+            part = regrow[:sustenance.shape[0], :sustenance.shape[1]]
+            under = below[:sustenance.shape[0], :sustenance.shape[1]]
+            np.greater(sustenance, 0.1, out=part)
+            np.less(sustenance, vegetation, out=under)
+            part &= under
+            if not part.any():
+                self.active[i, j] = False
+            elif ticks == 1:
+                np.add(sustenance, self.s_rate, out=sustenance, where=part)
+            else:
+                # each cell regrows until it reaches the vegetation, or for every step
+                steps = np.minimum(np.ceil((vegetation - sustenance) / self.s_rate), ticks)
+                np.add(sustenance, steps * self.s_rate, out=sustenance, where=part)
 
 class Weather:
 
-    def __init__(self, size, storm_chance, storm_size, storm_int, storm_decay, storm_var=(0.75, 1.25), storm_speed=1.0, sigma=2):
+    def __init__(self, size, storm_chance, storm_size, storm_int, storm_decay, storm_var=(0.75, 1.25), storm_speed=1.0, sigma=2,
+                 index='grid', precision='float64', rng=None, tile=None, store=None, resident=None):
         """A weather object, which controls the appearance and movement
            of storms in the simulation.
 
@@ -133,8 +327,17 @@ class Weather:
            storm_var -- the min/max variance of a storm's size.
            storm_speed -- the average speed of a newly formed storm.
            sigma -- the smoothing factor.
+           index -- the kind of spatial index used to find the closest storms.
+           precision -- the precision policy of the weathermap (see util.PRECISIONS).
+           rng -- the numpy random Generator that spawns storms (a fresh one if None).
+           tile, store, resident -- if tile is supplied, the weathermap is tiled (see Terrain).
+                                    Only the tiles storms are over are allocated.
            """
 
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
+
         self.size = size
         self.storm_chance = storm_chance
         self.storm_size = storm_size
@@ -143,56 +346,147 @@ class Weather:
         self.storm_var = storm_var
         self.storm_speed = storm_speed
         self.sigma = sigma
-        self.weathermap = np.zeros((size, size))
-        self.storms = [] # storms are stored in the format [location, velocity, strength]
+        self.precision = precision
+
+        # storms are stored as parallel arrays of location, velocity and strength
+        self.storm_pos = np.zeros((0, 2))
+        self.storm_vel = np.zeros((0, 2))
+        self.storm_str = np.zeros(0)
+
+        # the weathermap is reused every tick; only the cells under the
+        # storms' smoothing kernels (recorded in storm_cells) are ever touched
+        dynamic = util.layer_dtypes(precision)[2]
+        if tile is None:
+            self.weathermap = np.zeros((size, size), dtype=dynamic)
+        else:
+            self.weathermap = tiles.ChunkedLayer(size, tile, dynamic, store=store, resident=resident, name='weathermap')
+        self.storm_cells = np.zeros(0, dtype=np.intp)
+        self.stamp_x, self.stamp_y, self.stamp_w = gaussian_stamp(sigma)
+        self.index = spatial.make_index(index, size)
+
+    @property
+    def storms(self):
+        """The storms in the format [location, velocity, strength]."""
+        return [[pos, vel, strength] for pos, vel, strength in
+                zip(self.storm_pos.tolist(), self.storm_vel.tolist(), self.storm_str.tolist())]
 
     def update(self):
         """Master update function for the weather map."""
-        self.weathermap = np.zeros((self.size, self.size))
+        # clear last tick's storms from the map
+        self.clear()
 
         # update storms & add them to map
-        if(len(self.storms) > 0):
-            new_storms = []
-            for i in range(len(self.storms)):
-                self.storms[i][0][0] += self.storms[i][1][0]
-                self.storms[i][0][1] += self.storms[i][1][1]
-
-                # wrap storms around map
-                if self.storms[i][0][0] >= self.size:
-                    self.storms[i][0][0] = 0
-                if self.storms[i][0][1] >= self.size:
-                    self.storms[i][0][1] = 0
-
-                if self.storms[i][0][0] < 0:
-                    self.storms[i][0][0] = self.size - 1
-                if self.storms[i][0][1] < 0:
-                    self.storms[i][0][1] = self.size - 1
-
-                self.storms[i][2] *= (1 - self.storm_decay)
-                if self.storms[i][2] > 0.1:
-                    new_storms.append(self.storms[i])
-                self.weathermap[int(self.storms[i][0][0]), int(self.storms[i][0][1])] = self.storms[i][2]
-
+        if len(self.storm_str) > 0:
+            # move storms, wrapping them around the map
+            self.storm_pos += self.storm_vel
+            np.mod(self.storm_pos, self.size, out=self.storm_pos)
+            self.storm_pos[self.storm_pos >= self.size] = 0.0
 
-            self.storms = new_storms
-            self.weathermap = proc_smooth(self.weathermap, self.sigma)
-            self.weathermap = util.mask(self.weathermap, np.average(self.weathermap)*1.2)
+            self.storm_str *= (1 - self.storm_decay)
+            self.rasterize()
 
+            alive = self.storm_str > 0.1
+            self.storm_pos = self.storm_pos[alive]
+            self.storm_vel = self.storm_vel[alive]
+            self.storm_str = self.storm_str[alive]
 
-        if random.random() < self.storm_chance:
+        if self.rng.random() < self.storm_chance:
             # generate random position vector for storm
-            coords = [random.randint(0, self.size-1), random.randint(0, self.size-1)]
+            coords = self.rng.integers(0, self.size, 2)
             # generate random movement vector for storm
-            direction = [random.uniform(-self.storm_speed, self.storm_speed), random.uniform(-self.storm_speed, self.storm_speed)]
-            self.storms.append([coords, direction, 1.0])
+            direction = self.rng.uniform(-self.storm_speed, self.storm_speed, 2)
+            self.storm_pos = np.vstack((self.storm_pos, coords))
+            self.storm_vel = np.vstack((self.storm_vel, direction))
+            self.storm_str = np.append(self.storm_str, 1.0)
+
+        self.reindex()
+
+    def fast_forward(self, ticks):
+        """Advances the weather by ticks steps at once. Storms move and decay
+           in closed form, and the steps at which new storms form are drawn
+           from a geometric distribution on storm_chance, so the cost does
+           not grow with ticks. The storms and weathermap afterwards match
+           ticks calls to update in distribution (not draw for draw)."""
+        self.clear()
+
+        # the storms formed during the period, and the updates each then goes through
+        coords, directions, ages = [], [], []
+        step = 0
+        while self.storm_chance > 0:
+            step += int(self.rng.geometric(self.storm_chance))
+            if step > ticks:
+                break
+            coords.append(self.rng.integers(0, self.size, 2))
+            directions.append(self.rng.uniform(-self.storm_speed, self.storm_speed, 2))
+            ages.append(ticks - step)
+        pos = np.vstack([self.storm_pos] + coords)
+        vel = np.vstack([self.storm_vel] + directions)
+        strength = np.append(self.storm_str, np.ones(len(ages)))
+        age = np.append(np.full(len(self.storm_str), ticks), ages)
+
+        pos += vel * age[:, None]
+        np.mod(pos, self.size, out=pos)
+        pos[pos >= self.size] = 0.0
+        before = strength * (1 - self.storm_decay)**np.maximum(age - 1, 0)
+        strength = strength * (1 - self.storm_decay)**age
+
+        # the last step draws every storm that lived to see it, and then
+        # removes the ones that faded, before a new storm may form
+        drawn = (age > 0) & (before > 0.1)
+        if drawn.any():
+            self.storm_pos, self.storm_vel, self.storm_str = pos[drawn], vel[drawn], strength[drawn]
+            self.rasterize()
+        alive = (age == 0) | (drawn & (strength > 0.1))
+        self.storm_pos, self.storm_vel, self.storm_str = pos[alive], vel[alive], strength[alive]
+        self.reindex()
+
+    def clear(self):
+        """Clears the storms drawn last from the weathermap."""
+        if len(self.storm_cells) > 0:
+            topology.lattice(self.size).scatter(self.weathermap, self.storm_cells, 0.0)
+            tiles.release(self.weathermap, self.storm_cells)
+            self.storm_cells = np.zeros(0, dtype=np.intp)
+
+    def reindex(self):
+        """Rebuilds the storm index over the current storms. Rebuilding the
+           grid costs time in the area of the map, so an index that was
+           empty and stays empty (most ticks, with rare storms) is left be."""
+        if len(self.storm_pos) > 0 or len(self.index.points) > 0:
+            self.index.rebuild(self.storm_pos)
+
+    def rasterize(self):
+        """Draws the storms onto the weathermap: each storm's strength is
+           placed at its cell and smoothed by sigma, and everything below
+           1.2 times the map average is cleared. The smoothing kernel is
+           stamped around each storm rather than smoothing the whole map."""
+        size = self.size
+        cells = self.storm_pos.astype(np.intp)
+        ids = cells[:, 0] * size + cells[:, 1]
+
+        # when storms share a cell, the last one wins
+        last = len(ids) - 1 - np.unique(ids[::-1], return_index=True)[1]
+        stamped, weights = kernels.stamp(cells[last, 0], cells[last, 1], self.storm_str[last],
+                                         self.stamp_x, self.stamp_y, self.stamp_w, size)
+
+        lattice = topology.lattice(size)
+        stamped = tiles.splat(self.weathermap, stamped, weights)
+
+        # the map average, from the total strength stamped onto it
+        threshold = weights.sum() / size**2 * 1.2
+        values = lattice.gather(self.weathermap, stamped)
+        if values.max() > threshold:
+            lattice.scatter(self.weathermap, stamped[values < threshold], 0.0)
+        self.storm_cells = stamped
 
-    #@jit
     def get_closest_storm(self, coords):
-        best_dist = self.size**2
-        best = None
-        for storm in self.storms:
-            dist = util.eudist(storm[0], coords)
-            if dist < best_dist:
-                best_dist = dist
-                best = storm
-        return best, best_dist
+        closest, closest_dist = self.get_closest_storms([coords])
+        if closest[0] < 0:
+            return None, self.size**2
+        return self.storms[closest[0]], closest_dist[0]
+
+    def get_closest_storms(self, points):
+        """Returns the index (into the storm arrays) of and distance to the
+           closest storm for every point in the supplied (N, 2) array, or -1
+           where there are no storms."""
+        closest, closest_dist = self.index.nearest(points)
+        return closest[:, 0], closest_dist[:, 0]
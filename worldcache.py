@@ -0,0 +1,84 @@
+# Content-addressed on-disk cache of generated Terra^2 worlds.
+#
+# Generating a large terrain (and the climate gradients Terrans follow) is
+# far more expensive than loading it, so generated layers are saved under
+# a hash of every parameter that went into them. Repeat runs and sweep
+# workers with the same parameters and seed then memory-map the saved
+# layers instead of regenerating them.
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+# bump this whenever generation changes, so stale worlds are never loaded
+VERSION = 2
+
+def seed_key(seed):
+    """Returns a JSON-able identity for a seed, or None if the seed can't
+       identify a world (no seed, or an already-used Generator)."""
+    if isinstance(seed, (int, np.integer)):
+        return int(seed)
+    if isinstance(seed, np.random.SeedSequence):
+        return [seed.entropy, list(seed.spawn_key)]
+    return None
+
+class WorldCache:
+
+    def __init__(self, root):
+        """A directory of generated layers, keyed by the parameters that
+           generated them.
+
+           Keyword arguments:
+           root -- the cache directory (created if missing).
+           """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, **params):
+        """Returns the cache key for a set of generation parameters."""
+        content = json.dumps(dict(params, version=VERSION), sort_keys=True)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def fetch(self, key, generate, rng=None):
+        """Returns the arrays stored under key, memory-mapped read-only. If
+           there are none yet, they are made by calling generate() (which
+           returns a dict of arrays) and saved first.
+
+           Generating usually draws from a random Generator; pass it as rng
+           and its state after generation is saved too, then restored on
+           every later fetch, so a run is identical whether or not its world
+           came from the cache.
+           """
+        path = os.path.join(self.root, key)
+        if os.path.exists(path):
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            if rng is not None:
+                rng.bit_generator.state = meta['rng']
+            return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+
+        arrays = generate()
+        meta = {'arrays': sorted(arrays), 'rng': None if rng is None else rng.bit_generator.state}
+
+        # write next to the entry and move it into place, so concurrent
+        # workers never see a half-written entry
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        os.makedirs(tmp)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        return arrays
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        shutil.rmtree(self.root)
+        os.makedirs(self.root)